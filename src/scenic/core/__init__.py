@@ -7,17 +7,23 @@
 .. autosummary::
    :toctree:
 
+   batch
    distributions
    errors
    external_params
    geometry
    lazy_eval
    object_types
+   profiling
    pruning
    regions
+   resultcache
    scenarios
    simulators
+   smt
+   solvers
    specifiers
+   templates
    type_support
    utils
    vectors
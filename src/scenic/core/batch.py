@@ -0,0 +1,129 @@
+"""Running queries over many frames of a dataset in parallel.
+
+Matching a scenario against a dataset checks each frame independently, so the
+frames can be split among several processes. Each worker process builds its own
+state once, when it starts (e.g. compiling the scenario and loading the map data,
+which would be expensive to send to it), and then checks every frame it is given::
+
+	def makeState(dataroot, scenarioPath):
+		query = NuscQueryAPI(version='v1.0-mini', dataroot=dataroot)
+		return query, scenic.scenarioFromFile(scenarioPath)
+
+	def checkFrame(state, filename):
+		query, scenario = state
+		return matches(scenario, query.get_img_data(filename))
+
+	runner = BatchQueryRunner(makeState, checkFrame, initargs=(dataroot, path),
+	                          workers=8, chunksize=16)
+	for filename, matched in runner.run(query.get_img_filenames()):
+		...
+
+Results are streamed back in the order of the frames. Since the state function
+and the check function are sent to the workers, they must be picklable, i.e.
+defined at the top level of a module.
+"""
+
+import multiprocessing
+import os
+import sys
+import time
+
+# State of the current worker process, built by _initializeWorker
+_workerState = None
+_workerCheck = None
+
+def _initializeWorker(makeState, check, initargs):
+	global _workerState, _workerCheck
+	_workerState = makeState(*initargs)
+	_workerCheck = check
+
+def _checkFrame(frame):
+	return frame, _workerCheck(_workerState, frame)
+
+class BatchQueryRunner:
+	"""Checks frames of a dataset in parallel, using a pool of worker processes.
+
+	Args:
+		makeState: function building the state of a worker (e.g. a compiled scenario
+		  and map data), called once in each worker with **initargs**.
+		check: function called as ``check(state, frame)`` to check a frame, returning
+		  the result to report for it.
+		initargs (tuple): arguments for **makeState**.
+		workers (int): number of worker processes; defaults to the number of CPUs.
+		  If 1, frames are checked in the current process, which is useful for
+		  debugging.
+		chunksize (int): number of frames sent to a worker at a time. Larger chunks
+		  reduce communication overhead, but results of a chunk are only reported
+		  once the whole chunk is done.
+		progress: function called as ``progress(done, total)`` after each frame is
+		  reported, or :obj:`True` to print progress to standard error. The total
+		  is :obj:`None` if the number of frames is not known in advance.
+		mpContext (str): multiprocessing start method to use (e.g. ``'spawn'``), or
+		  :obj:`None` for the platform default.
+	"""
+	def __init__(self, makeState, check, initargs=(), workers=None, chunksize=1,
+	             progress=None, mpContext=None):
+		if workers is None:
+			workers = os.cpu_count() or 1
+		if workers < 1:
+			raise RuntimeError(f'invalid number of workers {workers}')
+		if chunksize < 1:
+			raise RuntimeError(f'invalid chunk size {chunksize}')
+		self.makeState = makeState
+		self.check = check
+		self.initargs = tuple(initargs)
+		self.workers = workers
+		self.chunksize = chunksize
+		self.progress = ProgressPrinter() if progress is True else progress
+		self.mpContext = mpContext
+
+	def run(self, frames):
+		"""Check the given frames, yielding pairs (frame, result) in order.
+
+		Frames are checked as the results are consumed, up to the capacity of the
+		pool; if the generator is closed early, the remaining work is cancelled.
+		Exceptions raised while checking a frame are propagated.
+		"""
+		try:
+			total = len(frames)
+		except TypeError:
+			total = None
+		if self.workers == 1:
+			state = self.makeState(*self.initargs)
+			results = ((frame, self.check(state, frame)) for frame in frames)
+			yield from self._reportProgress(results, total)
+			return
+		context = multiprocessing.get_context(self.mpContext)
+		with context.Pool(self.workers, initializer=_initializeWorker,
+		                  initargs=(self.makeState, self.check, self.initargs)) as pool:
+			results = pool.imap(_checkFrame, frames, chunksize=self.chunksize)
+			yield from self._reportProgress(results, total)
+
+	def matching(self, frames):
+		"""Get the list of frames for which the check returned a true value."""
+		return [frame for frame, result in self.run(frames) if result]
+
+	def _reportProgress(self, results, total):
+		if self.progress is None:
+			yield from results
+			return
+		for done, item in enumerate(results, start=1):
+			self.progress(done, total)
+			yield item
+
+class ProgressPrinter:
+	"""Progress reporter printing the number of frames checked and the rate."""
+	def __init__(self, stream=None):
+		self.stream = sys.stderr if stream is None else stream
+		self.startTime = None
+
+	def __call__(self, done, total):
+		now = time.monotonic()
+		if self.startTime is None or done == 1:
+			self.startTime = now
+		elapsed = now - self.startTime
+		rate = f', {done / elapsed:.1f} frames/s' if elapsed > 0 else ''
+		count = f'{done}/{total}' if total is not None else str(done)
+		end = '\n' if done == total else ''
+		self.stream.write(f'\r  Checked {count} frames{rate}' + end)
+		self.stream.flush()
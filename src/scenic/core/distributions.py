@@ -12,68 +12,89 @@ import wrapt
 
 from scenic.core.lazy_eval import (LazilyEvaluable,
     requiredProperties, needsLazyEvaluation, valueInContext, makeDelayedFunctionCall)
-from scenic.core.utils import argsToString, areEquivalent, cached, sqrt2
+from scenic.core.utils import argsToString, areEquivalent, cached, cached_property, sqrt2
 from scenic.core.errors import RuntimeParseError
+from scenic.core.smt import EncodingContext, EncodingCache, Term, isTerm, toSMTLIB
+from scenic.core.profiling import profiledEncoding
 
 def smt_add(var1, var2):
-	assert(isinstance(var1, str))
-	assert(isinstance(var2, str))
-	return "(+ "+var1+" "+var2+")"
+	assert(isTerm(var1))
+	assert(isTerm(var2))
+	return Term("+", var1, var2)
 
 def smt_subtract(var1, var2):
-	assert(isinstance(var1, str))
-	assert(isinstance(var2, str))
-	return "(- "+var1+" "+var2+")"
+	assert(isTerm(var1))
+	assert(isTerm(var2))
+	return Term("-", var1, var2)
 
 def smt_multiply(var1, var2):
-	assert(isinstance(var1, str))
-	assert(isinstance(var2, str))
-	return "(* "+var1+" "+var2+")"
+	assert(isTerm(var1))
+	assert(isTerm(var2))
+	return Term("*", var1, var2)
 
 def smt_divide(var1, var2):
-	assert(isinstance(var1, str))
-	assert(isinstance(var2, str))
-	return "(div "+var1+" "+var2+")"
+	assert(isTerm(var1))
+	assert(isTerm(var2))
+	return Term("div", var1, var2)
 
 def smt_and(var1, var2):
-	assert(isinstance(var1, str))
-	assert(isinstance(var2, str))
-	return "(and "+var1+" "+var2+")"
+	assert(isTerm(var1))
+	assert(isTerm(var2))
+	return Term("and", var1, var2)
 
 def smt_or(var1, var2):
-	assert(isinstance(var1, str))
-	assert(isinstance(var2, str))
-	return "(or "+var1+" "+var2+")"
+	assert(isTerm(var1))
+	assert(isTerm(var2))
+	return Term("or", var1, var2)
 
 def smt_equal(var1, var2):
-	assert(isinstance(var1, str))
-	assert(isinstance(var2, str))
-	return "(= "+var1+" "+var2+")"
+	assert(isTerm(var1))
+	assert(isTerm(var2))
+	return Term("=", var1, var2)
+
+def smt_junction(op, terms):
+	"""Conjunction or disjunction (for **op** 'and' or 'or') of any number of terms."""
+	terms = list(terms)
+	for term in terms:
+		assert(isTerm(term))
+	if not terms:
+		return 'true' if op == 'and' else 'false'
+	elif len(terms) == 1:
+		return terms[0]
+	return Term(op, *terms)
 
 def smt_mod(var1, var2):
-	assert(isinstance(var1, str))
-	assert(isinstance(var2, str))
-	return "(mod "+var1+" "+var2+")"
+	assert(isTerm(var1))
+	assert(isTerm(var2))
+	return Term("mod", var1, var2)
 
 def smt_lessThan(var1, var2):
-	assert(isinstance(var1, str))
-	assert(isinstance(var2, str))
-	return "(< "+var1+" "+var2+")"
+	assert(isTerm(var1))
+	assert(isTerm(var2))
+	return Term("<", var1, var2)
 
 def smt_lessThanEq(var1, var2):
-	assert(isinstance(var1, str))
-	assert(isinstance(var2, str))
-	return "(<= "+var1+" "+var2+")"
+	assert(isTerm(var1))
+	assert(isTerm(var2))
+	return Term("<=", var1, var2)
 
 def smt_ite(predicate, output1, output2):
-	assert(isinstance(predicate, str))
-	assert(isinstance(output1, str))
-	assert(isinstance(output2, str))
-	return "(ite "+predicate+" "+output1+" "+output2+")"
+	assert(isTerm(predicate))
+	assert(isTerm(output1))
+	assert(isTerm(output2))
+	return Term("ite", predicate, output1, output2)
+
+def smt_cos(var):
+	assert(isTerm(var))
+	return Term("cos", var)
+
+def smt_sin(var):
+	assert(isTerm(var))
+	return Term("sin", var)
 
 def smt_assert(operation_type, var1, var2=None):
-	assert(isinstance(var1, str))
-	assert(isinstance(var2, str) or var2==None)
+	assert(isTerm(var1))
+	assert(isTerm(var2) or var2==None)
 
 	if operation_type == "add":
 		op_encoding = smt_add(var1, var2)
@@ -99,20 +120,20 @@ def smt_assert(operation_type, var1, var2=None):
 		print("SMT_ASSERT() UNIDENTIFIED OPERATION")
 		raise NotImplementedError
 
-	return "(assert "+ op_encoding +")"
+	return Term("assert", op_encoding)
 
 def vector_operation_smt(vector1, operation, vector2):
 	""" vector1, vector2 := (x, y) from triangle := shapely.geometry.polygon.Polygon
 	x, y are floats"""
 	
-	x1 = str(vector1[0])
-	y1 = str(vector1[1])
+	x1 = vector1[0] if isTerm(vector1[0]) else str(vector1[0])
+	y1 = vector1[1] if isTerm(vector1[1]) else str(vector1[1])
 
 	if isinstance(vector2, tuple):
-		x2 = str(vector2[0])
-		y2 = str(vector2[1])
+		x2 = vector2[0] if isTerm(vector2[0]) else str(vector2[0])
+		y2 = vector2[1] if isTerm(vector2[1]) else str(vector2[1])
 	else: # scalar operation to a vector case
-		assert(isinstance(vector2, str))
+		assert(isTerm(vector2))
 		x2 = y2 = vector2
 
 	if operation == "add":	
@@ -157,15 +178,17 @@ def findVariableName(cached_variables, smt_file_path, variable_list, class_name,
 	""" for smt encoding, to avoid duplicate naming, add a number at then end for differentiation 
 		returns the next available name """
 
-	cached_var = [variable for variable in variable_list if variable.startswith(class_name)]
-	var_name = class_name+str(len(cached_var)+1) 
-
-	if class_type == None:
-		declare_var= "(declare-fun "+var_name+" () Real)\n"
+	if isinstance(smt_file_path, EncodingContext):
+		sort = 'Real' if class_type is None else class_type
+		var_name = smt_file_path.declareFresh(class_name, sort, avoid=variable_list)
 	else:
-		declare_var= "(declare-fun "+var_name+" () "+class_type+"\n)"
-
-	writeSMTtoFile(smt_file_path, declare_var)
+		cached_var = [variable for variable in variable_list if variable.startswith(class_name)]
+		var_name = class_name+str(len(cached_var)+1) 
+		if class_type == None:
+			declare_var= "(declare-fun "+var_name+" () Real)\n"
+		else:
+			declare_var= "(declare-fun "+var_name+" () "+class_type+"\n)"
+		writeSMTtoFile(smt_file_path, declare_var)
 	cached_variables['variables'].append(var_name)
 	return var_name
 
@@ -176,7 +199,7 @@ def checkAndEncodeSMT(smt_file_path, cached_variables, obj, debug=False):
 		return obj.encodeToSMT(smt_file_path, cached_variables, debug=debug)
 	elif isinstance(obj, int) or isinstance(obj, float):
 		return str(obj)
-	elif isinstance(obj, str):
+	elif isTerm(obj):
 		# this covers case in regions.py, PointInRegionDist's encodeToSMT where
 		# a Vector is instantiated with string variable names
 		return obj
@@ -186,38 +209,80 @@ def checkAndEncodeSMT(smt_file_path, cached_variables, obj, debug=False):
 	return None
 
 def writeSMTtoFile(smt_file_path, smt_encoding):
-	if isinstance(smt_encoding, str):
+	""" writes an encoding to smt_file_path, which is either the path of a file to append to
+	or an EncodingContext buffering the encoding in memory """
+	if isinstance(smt_file_path, EncodingContext):
+		smt_file_path.write(smt_encoding)
+
+	elif isTerm(smt_encoding):
 		with open(smt_file_path, "a+") as smt_file:
-			smt_file.write(smt_encoding+"\n")
+			smt_file.write(toSMTLIB(smt_encoding)+"\n")
 
 	elif isinstance(smt_encoding, tuple) and len(smt_encoding) == 2:
 		with open(smt_file_path, "a+") as smt_file:
-			smt_file.write(smt_encoding[0]+"\n")
-			smt_file.write(smt_encoding[1]+"\n")
+			smt_file.write(toSMTLIB(smt_encoding[0])+"\n")
+			smt_file.write(toSMTLIB(smt_encoding[1])+"\n")
 	else :
 		raise NotImplementedError
 
 	return None
 
+def encodeAssertions(smt_file_path, cached_variables, encoder):
+	"""Run an encoder, collecting the assertions it makes instead of writing them.
+
+	The encoder is called with a temporary `EncodingContext`; the constants it
+	declares (and any commands other than assertions) are passed on to
+	**smt_file_path**. Returns the result of the encoder and the list of terms it
+	asserted, e.g. to be combined into a disjunction.
+
+	Since the assertions may not end up holding, the values which the encoder added
+	to **cached_variables** are removed again, so that later uses encode them anew.
+	"""
+	if isinstance(smt_file_path, EncodingContext):
+		context = smt_file_path.subcontext()
+	else:
+		context = EncodingContext(logic=None)
+	cachedBefore = set(id(key) for key in cached_variables.keys())
+	result = encoder(context)
+	for key in [key for key in cached_variables.keys() if id(key) not in cachedBefore]:
+		if not isinstance(key, str):
+			del cached_variables[key]
+	if isinstance(smt_file_path, EncodingContext):
+		smt_file_path.declarations.extend(context.declarations)
+	else:
+		for declaration in context.declarations:
+			writeSMTtoFile(smt_file_path, declaration)
+	assertions = []
+	for command in context.body:
+		if isinstance(command, Term) and command.op == 'assert':
+			assertions.append(command.args[0])
+		elif command.startswith('(assert'):
+			assertions.append(command[len('(assert'):-1].strip())
+		elif not command.startswith(';'):
+			writeSMTtoFile(smt_file_path, command)
+	return result, assertions
+
+def isCached(cached_variables, obj):
+	""" checks whether obj itself (not merely an equal object) is a key of cached_variables """
+	if isinstance(cached_variables, EncodingCache):
+		return obj in cached_variables
+	for key in cached_variables.keys():
+		if obj is key:
+			return True
+	return False
+
 def cacheVarName(cached_variables, obj, var_names):
 	""" caches variable names.
 	type : var_names := tuple """
 
-	# if obj in cached_variables.keys():
-	# 	return cached_variables[obj]
 	if not isinstance(var_names, tuple):
-		var_names = (var_names)
-
-	key_exists = False
-	for key in list(cached_variables.keys()):
-		if obj is key:
-			key_exists = True
+		var_names = (var_names,)
 
-	if key_exists:
+	if isCached(cached_variables, obj):
 		return cached_variables[obj]
 
 	for var in var_names:
-		if var not in cached_variables['variables']:
+		if isinstance(var, str) and var not in cached_variables['variables']:
 			cached_variables['variables'].append(var)
 
 	if len(var_names) == 1:
@@ -238,7 +303,14 @@ def needsSampling(thing):
 	return isinstance(thing, Distribution) or dependencies(thing)
 
 def supportInterval(thing):
-	"""Lower and upper bounds on this value, if known."""
+	"""Lower and upper bounds on this value, if known.
+
+	If the value has been conditioned (see `Samplable.conditionTo`), the bounds are
+	those of the conditioned value.
+	"""
+	conditioned = getattr(thing, '_conditioned', thing)
+	if conditioned is not thing and isinstance(conditioned, (Samplable, int, float)):
+		return supportInterval(conditioned)
 	if hasattr(thing, 'supportInterval'):
 		return thing.supportInterval()
 	elif isinstance(thing, (int, float)):
@@ -302,6 +374,12 @@ class Samplable(LazilyEvaluable):
 		self._dependencies = tuple(deps)	# fixed order for reproducibility
 		self._conditioned = self	# version (partially) conditioned on requirements
 
+	def __init_subclass__(cls, **kwargs):
+		super().__init_subclass__(**kwargs)
+		# instrument SMT encoders for profiling (see scenic.core.profiling)
+		if 'encodeToSMT' in cls.__dict__:
+			cls.encodeToSMT = profiledEncoding(cls.__dict__['encodeToSMT'])
+
 	@staticmethod
 	def sampleAll(quantities):
 		"""Sample all the given Samplables, which may have dependencies in common.
@@ -1026,6 +1104,17 @@ class OperatorDistribution(Distribution):
 				else:
 					l, r = None, None 	# TODO improve
 			return l, r
+		elif self.operator in ('__mul__', '__rmul__'):
+			assert len(self.operands) == 1
+			l1, r1 = supportInterval(self.object)
+			l2, r2 = supportInterval(self.operands[0])
+			if l1 is None or l2 is None or r1 is None or r2 is None:
+				return None, None
+			products = (l1 * l2, l1 * r2, r1 * l2, r1 * r2)
+			return min(products), max(products)
+		elif self.operator == '__neg__':
+			l, r = supportInterval(self.object)
+			return (None if r is None else -r), (None if l is None else -l)
 		return None, None
 
 	def isEquivalentTo(self, other):
@@ -1090,8 +1179,44 @@ class MultiplexerDistribution(Distribution):
 		return (areEquivalent(self.index, other.index)
 		        and areEquivalent(self.options, other.options))
 
+	def supportInterval(self):
+		mins, maxes = zip(*(supportInterval(opt) for opt in self.options))
+		l = None if any(sl is None for sl in mins) else min(mins)
+		r = None if any(sr is None for sr in maxes) else max(maxes)
+		return l, r
+
 ## Simple distributions
 
+class Constant(Distribution):
+	"""Distribution with a single fixed value, for conditioning values to known ones."""
+	def __init__(self, value):
+		if needsSampling(value):
+			raise RuntimeError(f'Constant value {value} is random')
+		super().__init__(valueType=type(value))
+		self.value = value
+
+	def encodeToSMT(self, smt_file_path, cached_variables, debug=False):
+		if debug:
+			writeSMTtoFile(smt_file_path, "Constant")
+		return checkAndEncodeSMT(smt_file_path, cached_variables, self.value, debug=debug)
+
+	def sampleGiven(self, value):
+		return self.value
+
+	def supportInterval(self):
+		return supportInterval(self.value)
+
+	def clone(self):
+		return type(self)(self.value)
+
+	def isEquivalentTo(self, other):
+		if not type(other) is Constant:
+			return False
+		return areEquivalent(self.value, other.value)
+
+	def __str__(self):
+		return f'Constant({self.value})'
+
 class Range(Distribution):
 	"""Uniform distribution over a range"""
 	def __init__(self, low, high):
@@ -1163,6 +1288,11 @@ class Range(Distribution):
 		high = valueInContext(self.high, context)
 		return Range(low, high)
 
+	def supportInterval(self):
+		l, _ = supportInterval(self.low)
+		_, r = supportInterval(self.high)
+		return l, r
+
 	def isEquivalentTo(self, other):
 		if not type(other) is Range:
 			return False
@@ -1316,6 +1446,9 @@ class TruncatedNormal(Normal):
 	def clone(self):
 		return type(self)(self.mean, self.stddev, self.low, self.high)
 
+	def supportInterval(self):
+		return self.low, self.high
+
 	def bucket(self, buckets=None):
 		if not isinstance(self.stddev, float):		# TODO relax restriction?
 			raise RuntimeError('Cannot bucket TruncatedNormal with '
@@ -1436,6 +1569,9 @@ class DiscreteRange(Distribution):
 	def bucket(self, buckets=None):
 		return self.clone()		# already bucketed
 
+	def supportInterval(self):
+		return self.low, self.high
+
 	def sampleGiven(self, value):
 		return random.choices(self.options, cum_weights=self.cumulativeWeights)[0]
 
@@ -1478,35 +1614,99 @@ class Options(MultiplexerDistribution):
 		super().__init__(index, options)
 
 	def encodeToSMT(self, smt_file_path, cached_variables, obj=None, debug=False):
+		"""Encode the disjunction of the options which may be visible from the ego.
+
+		Options which are regions not intersecting the ego's visible region are
+		pruned using a spatial index (see `visibleOptions`). The assertions made when
+		encoding each remaining option are collected and combined into a single
+		disjunction, so that only one option need hold. If all options are regions,
+		they constrain the current object; otherwise, a new variable is equated to
+		the value of the chosen option.
+		"""
+		import scenic.core.regions as regions
 		if debug:
 			writeSMTtoFile(smt_file_path, "Options class")
 			writeSMTtoFile(smt_file_path, str(self.options))
-		if isinstance(obj, Samplable):
-			obj = self
-		if obj in cached_variables.keys():
-			return cached_variables[obj]
-		
-		if self != self._conditioned:
-			options = self._conditioned
-		else:
-			options = self.options
+		if isCached(cached_variables, self):
+			return cached_variables[self]
 
-		if len(self.options!=0):
+		options = self.visibleOptions(smt_file_path, cached_variables, debug=debug)
+		allRegions = all(isinstance(opt, regions.Region) for opt in self.options)
+		def encodeOption(opt, context):
+			if isinstance(opt, Samplable):
+				return opt.encodeToSMT(context, cached_variables, debug=debug)
+			elif isinstance(opt, (tuple, list)):
+				return tuple(str(coord) for coord in opt)
+			return str(opt)
+		if allRegions and 'ego_visibleRegion' in cached_variables.keys():
+			# each region is intersected with the visible region: encode that only once
+			sector = cached_variables['ego_visibleRegion']
+			sector.encodeToSMT(smt_file_path, cached_variables, debug=debug)
+		encodings = []
+		for opt in options:
+			encodings.append(encodeAssertions(smt_file_path, cached_variables,
+			                                  lambda context: encodeOption(opt, context)))
+
+		if allRegions:
+			output = cached_variables['current_obj']
+		elif encodings and not isinstance(encodings[0][0], tuple):
+			output = findVariableName(cached_variables, smt_file_path,
+			                          cached_variables['variables'], "options")
+		else:
 			x = findVariableName(cached_variables, smt_file_path, cached_variables['variables'], "x")
 			y = findVariableName(cached_variables, smt_file_path, cached_variables['variables'], "y")
-			output = (x,y)
-			for opt in options:
-				point = opt.encodeToSMT(smt_file_path, cached_variables, obj=None, debug=False)
-				(x_cond, y_cond) = vector_operation_smt(point, "equal", output)
-				writeSMTtoFile(smt_file_path, x_cond)
-				writeSMTtoFile(smt_file_path, y_cond)
-		else:
-			raise NotImplementedError
+			output = (x, y)
+
+		disjuncts = []
+		for value, assertions in encodings:
+			if not allRegions:
+				if isinstance(output, tuple):
+					assertions.extend(smt_equal(v, o) for v, o in zip(value, output))
+				else:
+					assertions.append(smt_equal(value, output))
+			disjuncts.append(smt_junction('and', assertions))
+		writeSMTtoFile(smt_file_path, smt_assert(None, smt_junction('or', disjuncts)))
+
+		if allRegions:
+			return output
+		return cacheVarName(cached_variables, self, output)
 
+	def visibleOptions(self, smt_file_path, cached_variables, debug=False):
+		"""The options which may intersect the ego's visible region.
 
-		return output
-		# import scenic.domains.driving.roads as road_library
-		# if isinstance(options[0], road_library.LinearElement):
+		Options which are not fixed regions are always kept.
+		"""
+		import scenic.core.regions as regions
+		conditioned = self._conditioned
+		if conditioned is not self and isinstance(conditioned, (list, tuple)):
+			options = conditioned		# see conditionforSMT
+		else:
+			options = self.options
+		if not all(isinstance(opt, regions.Region) for opt in options):
+			return list(options)
+		sector = regions.visibleSectorPolygon(smt_file_path, cached_variables, debug=debug)
+		if sector is None:
+			return list(options)
+		if options is not self.options:
+			return [opt for opt in options
+			        if regions.toPolygon(opt) is None or regions.toPolygon(opt).intersects(sector)]
+		prunable, prunableSet, index = self._optionIndex
+		visible = set(prunable[i] for i in index.intersectingIndices(sector))
+		return [opt for i, opt in enumerate(options) if i in visible or i not in prunableSet]
+
+	@cached_property
+	def _optionIndex(self):
+		"""Spatial index over the options with known shapes, and their positions (as a
+		list in index order and as a set)."""
+		import scenic.core.regions as regions
+		from scenic.core.geometry import SpatialIndex
+		prunable, polygons = [], []
+		for i, opt in enumerate(self.options):
+			polygon = regions.toPolygon(opt)
+			if polygon is not None:
+				prunable.append(i)
+				polygons.append(polygon)
+		return prunable, frozenset(prunable), SpatialIndex(polygons)
 
 	def conditionforSMT(self, condition, conditioned_bool):
 		import scenic.domains.driving.roads as roads
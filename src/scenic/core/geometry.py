@@ -2,11 +2,15 @@
 
 import math
 import itertools
+import collections
 import warnings
 
 import numpy as np
+import shapely.errors
 import shapely.geometry
 import shapely.ops
+import shapely.prepared
+import shapely.strtree
 
 from scenic.core.distributions import (needsSampling, distributionFunction,
                                        monotonicDistributionFunction)
@@ -361,6 +365,73 @@ def triangulatePolygon_mapbox(polygon):
 		triangles.append(shapely.geometry.Polygon(triple))
 	return triangles
 
+def convexPieces(triangles, tolerance=1e-9):
+	"""Merge the triangles of a triangulation into a smaller set of convex polygons.
+
+	A greedy variant of the Hertel-Mehlhorn algorithm: each piece grows from a
+	triangle by absorbing neighboring triangles (sharing an edge with the piece)
+	as long as the result stays convex. Since the triangles do not overlap, this
+	is the case exactly when the convex hull of the piece has the same area as
+	the sum of its triangles.
+	"""
+	triangles = list(triangles)
+	corners = [tuple(tri.exterior.coords)[:3] for tri in triangles]
+	edgeOwners = collections.defaultdict(list)
+	for i, pts in enumerate(corners):
+		for j in range(3):
+			edgeOwners[frozenset((pts[j], pts[(j+1) % 3]))].append(i)
+	neighbors = [[] for tri in triangles]
+	for owners in edgeOwners.values():
+		for i, j in itertools.permutations(owners, 2):
+			neighbors[i].append(j)
+
+	used = [False] * len(triangles)
+	pieces = []
+	for start, triangle in enumerate(triangles):
+		if used[start]:
+			continue
+		used[start] = True
+		points, area = list(corners[start]), triangle.area
+		frontier = collections.deque(neighbors[start])
+		while frontier:
+			i = frontier.popleft()
+			if used[i]:
+				continue
+			newPoints = points + list(corners[i])
+			newArea = area + triangles[i].area
+			hull = shapely.geometry.MultiPoint(newPoints).convex_hull
+			if hull.area - newArea <= tolerance * newArea:
+				used[i] = True
+				points, area = newPoints, newArea
+				frontier.extend(neighbors[i])
+		if len(points) == 3:
+			pieces.append(triangle)
+		else:
+			pieces.append(shapely.geometry.MultiPoint(points).convex_hull)
+	return pieces
+
+def pointsIntersecting(geometry, points):
+	"""Test which of the given points lie in or on **geometry**, in bulk.
+
+	Equivalent to ``geometry.intersects(Point(point))`` for each point, but much faster
+	for many points. The geometry may be prepared. Returns a boolean NumPy array.
+	"""
+	points = np.asarray(points, dtype=float).reshape(-1, 2)
+	xs, ys = points[:, 0], points[:, 1]
+	if hasattr(shapely, 'intersects_xy'):		# Shapely 2.0
+		if isinstance(geometry, shapely.prepared.PreparedGeometry):
+			geometry = geometry.context
+		return shapely.intersects_xy(geometry, xs, ys)
+	from shapely import vectorized
+	if len(points) == 0:
+		return np.zeros(0, dtype=bool)
+	if isinstance(geometry, shapely.prepared.PreparedGeometry):
+		prepared = geometry
+	else:
+		prepared = shapely.prepared.prep(geometry)
+	inside = vectorized.contains(prepared, xs, ys)
+	return inside | vectorized.touches(prepared, xs, ys)
+
 def plotPolygon(polygon, plt, style='r-', **kwargs):
 	def plotCoords(chain):
 		x, y = chain.xy
@@ -385,6 +456,49 @@ def plotPolygon(polygon, plt, style='r-', **kwargs):
 		else:
 			raise RuntimeError(f'unknown kind of shapely geometry {polygon}')
 
+class SpatialIndex:
+	"""Spatial index over a fixed sequence of Shapely geometries.
+
+	Queries first find the geometries whose bounding boxes meet that of the query
+	geometry using an STR-packed R-tree, and then test only those exactly.
+	Results are always given in the order of the original sequence.
+	"""
+	def __init__(self, geometries):
+		self.geometries = tuple(geometries)
+		with warnings.catch_warnings():
+			# Shapely 1.8 warns about the API change in 2.0, which we handle below
+			warnings.simplefilter('ignore', category=getattr(shapely.errors,
+			                      'ShapelyDeprecationWarning', DeprecationWarning))
+			self._tree = shapely.strtree.STRtree(self.geometries)
+		self._indices = {id(geom): i for i, geom in enumerate(self.geometries)}
+
+	def candidates(self, geometry):
+		"""Indices of the geometries whose bounding boxes intersect that of **geometry**."""
+		result = self._tree.query(geometry)
+		if isinstance(result, np.ndarray):	# Shapely 2.0 returns indices directly
+			return sorted(result.tolist())
+		return sorted(self._indices[id(geom)] for geom in result)
+
+	def intersectingIndices(self, geometry):
+		"""Indices of the geometries which intersect **geometry**."""
+		prepared = shapely.prepared.prep(geometry)
+		geoms = self.geometries
+		return [i for i in self.candidates(geometry) if prepared.intersects(geoms[i])]
+
+	def intersecting(self, geometry):
+		"""The geometries which intersect **geometry**."""
+		geoms = self.geometries
+		return [geoms[i] for i in self.intersectingIndices(geometry)]
+
+	def __len__(self):
+		return len(self.geometries)
+
+	def __getstate__(self):
+		return self.geometries		# the tree itself is rebuilt when unpickling
+
+	def __setstate__(self, state):
+		self.__init__(state)
+
 class _RotatedRectangle:
 	"""mixin providing collision detection for rectangular objects and regions"""
 	def containsPoint(self, point):
@@ -0,0 +1,184 @@
+"""Profiling the construction of SMT encodings.
+
+To find out where the time goes when encoding a scenario, attach an
+`EncodingProfiler` to the `EncodingContext` being encoded into::
+
+	profiler = EncodingProfiler()
+	context = EncodingContext(profiler=profiler)
+	obj.position.encodeToSMT(context, cached_variables)
+	print(profiler.summary())
+	profiler.writeFlamegraph('encoding.folded')
+
+Every call to an ``encodeToSMT`` method is recorded (the methods of `Samplable`
+subclasses are instrumented automatically, and others with `profiledEncoding`),
+together with other expensive steps such as pruning, marked with `profileSection`.
+For each call site, i.e. chain of nested calls, the profiler records the number of
+calls, the wall time, and the numbers of variables declared, assertions made, and
+bytes of SMT-LIB emitted. When no profiler is attached the instrumentation costs
+only an attribute lookup per call.
+"""
+
+import contextlib
+import functools
+import json
+import time
+
+_metrics = ('time', 'variables', 'assertions', 'bytes')
+
+class _Frame:
+	__slots__ = ('name', 'start', 'children')
+
+	def __init__(self, name, start):
+		self.name = name
+		self.start = start				# counter values on entry
+		self.children = [0] * len(_metrics)	# totals of nested frames
+
+class EncodingProfiler:
+	"""Collects statistics on the construction of SMT encodings.
+
+	Attributes:
+		stats (dict): maps each call site, as a tuple of names from the outermost
+		  call inward, to a dictionary of statistics: the number of ``calls``, and for
+		  each metric (``time`` in seconds, ``variables``, ``assertions``, and
+		  ``bytes``) the inclusive total and the ``self_`` total excluding nested
+		  calls.
+	"""
+	def __init__(self):
+		self.stats = {}
+		self.variables = self.assertions = self.bytes = 0
+		self._stack = []
+
+	## Hooks called by EncodingContext
+
+	def declared(self, declaration):
+		self.variables += 1
+		self.bytes += len(declaration) + 1
+
+	def emitted(self, text, assertion=False):
+		if assertion:
+			self.assertions += 1
+		self.bytes += len(text) + 1
+
+	## Recording
+
+	def _counters(self):
+		return (time.perf_counter(), self.variables, self.assertions, self.bytes)
+
+	@contextlib.contextmanager
+	def section(self, name):
+		"""Context manager recording its body as a call named **name**."""
+		frame = _Frame(name, self._counters())
+		self._stack.append(frame)
+		try:
+			yield
+		finally:
+			self._stack.pop()
+			totals = [end - start for end, start in zip(self._counters(), frame.start)]
+			site = tuple(f.name for f in self._stack) + (name,)
+			entry = self.stats.get(site)
+			if entry is None:
+				entry = { 'calls': 0 }
+				for metric in _metrics:
+					entry[metric] = entry['self_' + metric] = 0
+				self.stats[site] = entry
+			entry['calls'] += 1
+			for metric, total, nested in zip(_metrics, totals, frame.children):
+				entry[metric] += total
+				entry['self_' + metric] += total - nested
+			if self._stack:
+				parent = self._stack[-1].children
+				for i, total in enumerate(totals):
+					parent[i] += total
+
+	def reset(self):
+		"""Discard all statistics collected so far.
+
+		Not allowed while a section is open, since its statistics would be wrong.
+		"""
+		if self._stack:
+			names = ', '.join(frame.name for frame in self._stack)
+			raise RuntimeError(f'cannot reset profiler inside sections {names}')
+		self.stats.clear()
+		self.variables = self.assertions = self.bytes = 0
+
+	## Reporting
+
+	def byName(self):
+		"""Statistics aggregated over call sites, by the name of the innermost call.
+
+		Inclusive totals only count calls not nested inside another call of the
+		same name, so that recursive encoders are not counted twice.
+		"""
+		totals = {}
+		for site, entry in self.stats.items():
+			name = site[-1]
+			total = totals.setdefault(name, dict.fromkeys(entry, 0))
+			outermost = name not in site[:-1]
+			for key, value in entry.items():
+				if key.startswith('self_') or key == 'calls' or outermost:
+					total[key] += value
+		return totals
+
+	def summary(self, metric='time', limit=20):
+		"""A table of the names with the largest self totals of the given metric."""
+		totals = sorted(self.byName().items(), key=lambda item: -item[1]['self_' + metric])
+		lines = [f'{"name":40} {"calls":>8} {"self " + metric:>14} {"total " + metric:>14}']
+		for name, total in totals[:limit]:
+			selfValue, value = total['self_' + metric], total[metric]
+			if metric == 'time':
+				selfValue, value = f'{selfValue:.4f}', f'{value:.4f}'
+			lines.append(f'{name:40} {total["calls"]:8} {selfValue:>14} {value:>14}')
+		return '\n'.join(lines)
+
+	def toJSON(self):
+		"""Get the statistics as a JSON-serializable list, one entry per call site."""
+		return [dict(stack=list(site), **entry) for site, entry in self.stats.items()]
+
+	def writeJSON(self, path):
+		with open(path, 'w') as outFile:
+			json.dump(self.toJSON(), outFile, indent=1)
+
+	def flamegraphStacks(self, metric='time'):
+		"""Get the statistics in the folded-stacks format used by flame graph tools.
+
+		Each line gives a call site, with names separated by semicolons, followed by
+		its self total of the given metric (times are in microseconds).
+		"""
+		lines = []
+		for site, entry in self.stats.items():
+			value = entry['self_' + metric]
+			if metric == 'time':
+				value = round(value * 1e6)
+			if value > 0:
+				lines.append(';'.join(site) + f' {value}')
+		return lines
+
+	def writeFlamegraph(self, path, metric='time'):
+		with open(path, 'w') as outFile:
+			for line in self.flamegraphStacks(metric):
+				outFile.write(line + '\n')
+
+def profileSection(smt_file_path, name):
+	"""Context manager recording its body in the profiler of an `EncodingContext`, if any."""
+	profiler = getattr(smt_file_path, 'profiler', None)
+	if profiler is None:
+		return contextlib.nullcontext()
+	return profiler.section(name)
+
+def profiledEncoding(method):
+	"""Decorator recording calls of an ``encodeToSMT`` method in the profiler, if any.
+
+	Calls are named after the class of the object being encoded.
+	"""
+	if getattr(method, '_profiledEncoding', False):
+		return method
+
+	@functools.wraps(method)
+	def wrapper(self, smt_file_path, *args, **kwargs):
+		profiler = getattr(smt_file_path, 'profiler', None)
+		if profiler is None:
+			return method(self, smt_file_path, *args, **kwargs)
+		with profiler.section(type(self).__name__):
+			return method(self, smt_file_path, *args, **kwargs)
+	wrapper._profiledEncoding = True
+	return wrapper
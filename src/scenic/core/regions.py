@@ -13,12 +13,17 @@ from scenic.core.distributions import (Samplable, RejectionException, needsSampl
                                        distributionMethod, smt_add, smt_subtract, smt_multiply, 
                                        smt_divide, smt_and, smt_equal, smt_mod, smt_assert, findVariableName,
                                        checkAndEncodeSMT, writeSMTtoFile, cacheVarName, smt_lessThan, smt_lessThanEq,
-                                       smt_ite, normalizeAngle_SMT, smt_or, vector_operation_smt, Options, isNotConditioned)
+                                       smt_ite, normalizeAngle_SMT, smt_or, vector_operation_smt, Options, isNotConditioned,
+                                       isCached, smt_junction, smt_cos, smt_sin)
 from scenic.core.lazy_eval import valueInContext
 from scenic.core.vectors import Vector, OrientedVector, VectorDistribution, VectorField, VectorOperatorDistribution
+from scenic.core.vectors import unboundedBox
 from scenic.core.geometry import _RotatedRectangle
 from scenic.core.geometry import sin, cos, hypot, findMinMax, pointIsInCone, averageVectors
 from scenic.core.geometry import headingOfSegment, triangulatePolygon, plotPolygon, polygonUnion
+from scenic.core.geometry import SpatialIndex, convexPieces
+from scenic.core.profiling import profileSection
+from scenic.core.smt import numeral, Term
 from scenic.core.type_support import toVector
 from scenic.core.utils import cached, cached_property, areEquivalent
 import matplotlib.pyplot as plt
@@ -28,31 +33,19 @@ from scenic.core.type_support import TypecheckedDistribution
 def VectorToTuple(vector):
 	return (vector.x, vector.y)
 
-def pruneValidLines(smt_file_path, cached_variables, lineString, debug=False):
-	""" 
-	Output = outputs a list of triangle polygons in `region_polygon` that intersects with ego's visible region (=sector region)
-
-	Input : 
-	ego_position := Vector as defined in Scenic
-	lineString := Shapely lineString or MultilineString
-	view_angle := view cone angle in degrees
-	radius := meters
-	resolution := in degrees, with how many points to approximate a circle
+def visibleSectorPolygon(smt_file_path, cached_variables, debug=False):
+	"""Polygon of the ego's visible region, which is cached if not already present.
 
+	Returns :obj:`None` if the visible region is not known in advance (as for a
+	`ParametricSectorRegion` without a workspace), in which case nothing can be pruned.
 	"""
-	if debug:
-		writeSMTtoFile(smt_file_path, "pruneValidLines")
-
-	oriented_vector = cached_variables['ego']
-	heading = oriented_vector.heading
-
 	if not 'ego_visibleRegion' in cached_variables.keys():
 		if debug:
 			writeSMTtoFile(smt_file_path, "ego_visibleRegion not in cached_variables.keys()")
 		center = cached_variables['ego']
 		radius = cached_variables['ego_view_radius']
 		heading = cached_variables['ego'].heading
-		angle = cached_variables['ego_viewAngle'] * math.pi/180
+		angle = cached_variables['ego_viewAngle'] * math.pi / 180
 		sectorRegion = SectorRegion(center, radius, heading, angle)
 		cached_variables['ego_visibleRegion'] = sectorRegion
 		sector = sectorRegion.polygon
@@ -61,9 +54,40 @@ def pruneValidLines(smt_file_path, cached_variables, lineString, debug=False):
 		if debug:
 			writeSMTtoFile(smt_file_path, "ego_visibleRegion already in cached_variables.keys()")
 		sector = cached_variables['ego_visibleRegion'].polygon
+	return sector
+
+def pruneValidLines(smt_file_path, cached_variables, lineString, debug=False):
+	""" 
+	Output = outputs a list of triangle polygons in `region_polygon` that intersects with ego's visible region (=sector region)
+
+	Input : 
+	ego_position := Vector as defined in Scenic
+	lineString := Shapely lineString or MultilineString, or a SpatialIndex over line segments
+	view_angle := view cone angle in degrees
+	radius := meters
+	resolution := in degrees, with how many points to approximate a circle
+
+	"""
+	if debug:
+		writeSMTtoFile(smt_file_path, "pruneValidLines")
+
+	sector = visibleSectorPolygon(smt_file_path, cached_variables, debug=debug)
 
 	lineString_list = []
-	if isinstance(lineString, shapely.geometry.LineString):
+	if sector is None:		# visible region unknown in advance: nothing can be pruned
+		if isinstance(lineString, SpatialIndex):
+			return list(lineString.geometries)
+		return list(getattr(lineString, 'geoms', [lineString]))
+	if isinstance(lineString, SpatialIndex):
+		# only clip the segments near the sector, as found by the index
+		for segment in lineString.intersecting(sector):
+			intersection = segment & sector
+			if isinstance(intersection, shapely.geometry.LineString):
+				lineString_list.append(intersection)
+			elif isinstance(intersection, shapely.geometry.base.BaseMultipartGeometry):
+				lineString_list.extend(geom for geom in intersection.geoms
+				                       if isinstance(geom, shapely.geometry.LineString))
+	elif isinstance(lineString, shapely.geometry.LineString):
 		lineString_list.append(lineString)
 	elif isinstance(lineString, shapely.geometry.MultiLineString):
 		for line in list(lineString.geoms):
@@ -119,7 +143,7 @@ def pruneValidRegion(smt_file_path, cached_variables, region_polygon, debug=Fals
 
 	Input : 
 	ego_position := Vector as defined in Scenic
-	region_polygon := Shapely polygon or Multipolygon 
+	region_polygon := Shapely polygon or Multipolygon, or a SpatialIndex over triangles
 	view_angle := view cone angle in degrees
 	radius := meters
 	resolution := in degrees, with how many points to approximate a circle
@@ -128,24 +152,14 @@ def pruneValidRegion(smt_file_path, cached_variables, region_polygon, debug=Fals
 	if debug:
 		writeSMTtoFile(smt_file_path, "pruneValidRegion")
 
-	oriented_vector = cached_variables['ego']
-	heading = oriented_vector.heading
+	sector = visibleSectorPolygon(smt_file_path, cached_variables, debug=debug)
 
-	if not 'ego_visibleRegion' in cached_variables.keys():
-		if debug:
-			writeSMTtoFile(smt_file_path, "ego_visibleRegion not in cached_variables.keys()")
-		center = cached_variables['ego']
-		radius = cached_variables['ego_view_radius']
-		heading = cached_variables['ego'].heading
-		angle = cached_variables['ego_viewAngle'] * math.pi / 180
-		sectorRegion = SectorRegion(center, radius, heading, angle)
-		cached_variables['ego_visibleRegion'] = sectorRegion
-		sector = sectorRegion.polygon
-		cached_variables['ego_sector_polygon'] = sector
-	else:
-		if debug:
-			writeSMTtoFile(smt_file_path, "ego_visibleRegion already in cached_variables.keys()")
-		sector = cached_variables['ego_visibleRegion'].polygon
+	if sector is None:		# visible region unknown in advance: nothing can be pruned
+		if isinstance(region_polygon, SpatialIndex):
+			return list(region_polygon.geometries)
+		return list(region_polygon)
+	if isinstance(region_polygon, SpatialIndex):
+		return region_polygon.intersecting(sector)
 
 	region_polygon = list(region_polygon) if not isinstance(region_polygon, list) else region_polygon
 	## intersect the sector with region_polygon
@@ -161,8 +175,116 @@ def pruneValidRegion(smt_file_path, cached_variables, region_polygon, debug=Fals
 
 	return intersecting_triangles
 
-def encodePolygonalRegion_SMT(smt_file_path, cached_variables, triangles, point, debug=False):
-	""" Assumption: the polygons given from polygon region will always be in triangles """
+def encodeConvexPolygon_SMT(polygon, point):
+	""" Encodes that point := (x, y) lies in the convex polygon, as a conjunction of
+	linear constraints: the point must be to the left of every edge of the (counterclockwise)
+	boundary, i.e. (b - a) x (p - a) >= 0 for every edge (a, b) """
+	(x, y) = point
+	coords = list(shapely.geometry.polygon.orient(polygon).exterior.coords)
+	encoding = None
+	for (ax, ay), (bx, by) in zip(coords, coords[1:]):
+		dx, dy = bx - ax, by - ay
+		lhs = smt_subtract(smt_multiply(numeral(dx), y), smt_multiply(numeral(dy), x))
+		halfPlane = smt_lessThanEq(numeral(dx * ay - dy * ax), lhs)
+		encoding = halfPlane if encoding is None else smt_and(encoding, halfPlane)
+	return encoding
+
+def _isNumber(value):
+	return isinstance(value, (int, float))
+
+def _term(value):
+	return numeral(value) if _isNumber(value) else value
+
+def _plus(a, b):
+	"""Sum of two numbers or terms, computed directly if both are numbers."""
+	return a + b if _isNumber(a) and _isNumber(b) else smt_add(_term(a), _term(b))
+
+def _times(a, b):
+	"""Product of two numbers or terms, computed directly if both are numbers."""
+	return a * b if _isNumber(a) and _isNumber(b) else smt_multiply(_term(a), _term(b))
+
+def _negated(value):
+	return -value if _isNumber(value) else Term('-', value)
+
+def _absolute(value):
+	return abs(value) if _isNumber(value) else Term('abs', value)
+
+def _rectangleAxes(heading):
+	"""Unit vectors along the width and length of a rectangle with the given heading.
+
+	The heading is a number, or a pair of terms giving its cosine and sine.
+	"""
+	if isinstance(heading, tuple):
+		c, s = heading
+	else:
+		c, s = math.cos(heading), math.sin(heading)
+	return (c, s), (_negated(s), c)
+
+def rectangleCorners_SMT(rectangle):
+	""" Encodes the corners of rectangle := (position, heading, hw, hl), where position is
+	a pair of terms and the heading and half-width/length are numbers (e.g. conditioned
+	values), so that the corners are linear in the position. The heading may also be a
+	pair of terms giving its cosine and sine (e.g. parameters of a template), in which
+	case the corners are linear in those terms too """
+	(x, y), heading, hw, hl = rectangle
+	(ux, uy), (vx, vy) = _rectangleAxes(heading)
+	corners = []
+	for sw, sl in ((1, 1), (-1, 1), (-1, -1), (1, -1)):
+		dx = _plus(_times(sw * hw, ux), _times(sl * hl, vx))
+		dy = _plus(_times(sw * hw, uy), _times(sl * hl, vy))
+		corners.append((smt_add(x, _term(dx)), smt_add(y, _term(dy))))
+	return corners
+
+def encodeRectangleSeparation_SMT(first, second):
+	""" Encodes that two rectangles, given as for rectangleCorners_SMT, do not intersect,
+	using the separating axis theorem: the projections of the rectangles onto one of the
+	axes of either rectangle must be disjoint. With constant headings the projections
+	of the centers are linear and the extents constant, so the encoding is linear; a
+	heading given by terms makes it nonlinear in them """
+	(x1, y1), h1, hw1, hl1 = first
+	(x2, y2), h2, hw2, hl2 = second
+	dx, dy = smt_subtract(x2, x1), smt_subtract(y2, y1)
+	def parallel(axis, other):
+		if not all(_isNumber(coord) for coord in axis + other):
+			return False
+		return abs(axis[0] * other[1] - axis[1] * other[0]) <= 1e-9
+	axes = list(_rectangleAxes(h1))
+	for axis in _rectangleAxes(h2):
+		# skip axes parallel to ones already used, e.g. for aligned rectangles
+		if not any(parallel(axis, other) for other in axes):
+			axes.append(axis)
+	disjuncts = []
+	for nx, ny in axes:
+		extent = 0
+		for heading, hw, hl in ((h1, hw1, hl1), (h2, hw2, hl2)):
+			(ux, uy), (vx, vy) = _rectangleAxes(heading)
+			alongWidth = _absolute(_plus(_times(nx, ux), _times(ny, uy)))
+			alongLength = _absolute(_plus(_times(nx, vx), _times(ny, vy)))
+			extent = _plus(extent, _plus(_times(hw, alongWidth), _times(hl, alongLength)))
+		projection = smt_add(_times(nx, dx), _times(ny, dy))
+		disjuncts.append(smt_lessThan(_term(extent), projection))
+		disjuncts.append(smt_lessThan(projection, _term(_negated(extent))))
+	return smt_junction('or', disjuncts)
+
+def encodeRectangleInPolygon_SMT(rectangle, pieces):
+	""" Encodes that a rectangle, given as for rectangleCorners_SMT, lies in the union of
+	the given convex polygons (e.g. from convexPieces), by requiring each corner to lie in
+	one of them. This is exact if there is a single piece, and otherwise a necessary
+	condition (the rectangle could still cross a hole or notch of the union) """
+	pieces = list(pieces)
+	conjuncts = []
+	for corner in rectangleCorners_SMT(rectangle):
+		conjuncts.append(smt_junction('or', [encodeConvexPolygon_SMT(piece, corner)
+		                                     for piece in pieces]))
+	return smt_junction('and', conjuncts)
+
+def encodePolygonalRegion_SMT(smt_file_path, cached_variables, triangles, point, debug=False, mode='barycentric'):
+	""" Assumption: the polygons given from polygon region will always be in triangles 
+
+	mode := 'barycentric' encodes each triangle using barycentric coordinates s, t;
+	'convex' instead takes any convex polygons (e.g. from convexPieces) and encodes each 
+	as a conjunction of half-planes, avoiding the nonlinear s, t multipliers 
+	"""
 	if debug:
 		writeSMTtoFile(smt_file_path, "encodePolygonalRegion_SMT")
 	triangle_list = triangles if isinstance(triangles, list) else list(triangles)
@@ -171,10 +293,25 @@ def encodePolygonalRegion_SMT(smt_file_path, cached_variables, triangles, point,
 	sectorRegion = cached_variables['ego_visibleRegion']
 	(x,y) = sectorRegion.encodeToSMT(smt_file_path, cached_variables, debug=debug)
 
+	if mode == 'convex':
+		for polygon in triangle_list:
+			smt_encoding = encodeConvexPolygon_SMT(polygon, (x,y))
+			if cumulative_smt_encoding is None:
+				cumulative_smt_encoding = smt_encoding
+			else:
+				cumulative_smt_encoding = smt_or(cumulative_smt_encoding, smt_encoding)
+		if cumulative_smt_encoding is None:
+			cumulative_smt_encoding = 'false'
+		writeSMTtoFile(smt_file_path, smt_assert(None, cumulative_smt_encoding))
+		return (x,y)
+	elif mode != 'barycentric':
+		raise RuntimeError(f'unknown polygon encoding mode {mode}')
+
 	## For testing only -- to be deleted
 	count = 0
 	sector = sectorRegion.polygon
-	plt.plot(*sector.exterior.xy, color='r')
+	if sector is not None:
+		plt.plot(*sector.exterior.xy, color='r')
 	# for tri in triangle_list:
 	# 	plt.plot(*tri.exterior.xy, color='g')
 	# plt.show()
@@ -310,6 +447,15 @@ class PointInRegionDistribution(VectorDistribution):
 	def sampleGiven(self, value):
 		return value[self.region].uniformPointInner()
 
+	def supportBox(self):
+		region = self.region
+		if needsSampling(region):
+			return unboundedBox
+		try:
+			return region.getAABB()
+		except NotImplementedError:
+			return unboundedBox
+
 	@property
 	def heading(self):
 		if self.region.orientation is not None:
@@ -488,8 +634,18 @@ class CircularRegion(Region):
 		self.circumcircle = (self.center, self.radius)
 		self.resolution = resolution
 
-	def encodeToSMT(self, smt_file_path, cached_variables, obj, debug=False):
-		raise NotImplementedError
+	def encodeToSMT(self, smt_file_path, cached_variables, obj=None, debug=False):
+		""" Encodes that the current object lies in the circle """
+		if debug:
+			writeSMTtoFile(smt_file_path, "CircularRegion")
+		point = cached_variables['current_obj']
+		(center_x, center_y) = checkAndEncodeSMT(smt_file_path, cached_variables, self.center)
+		radius = checkAndEncodeSMT(smt_file_path, cached_variables, self.radius)
+		dx, dy = smt_subtract(point[0], center_x), smt_subtract(point[1], center_y)
+		square_distance = smt_add(smt_multiply(dx, dx), smt_multiply(dy, dy))
+		writeSMTtoFile(smt_file_path,
+		               smt_assert(None, smt_lessThanEq(square_distance, smt_multiply(radius, radius))))
+		return point
 
 	def conditionforSMT(self, condition, conditioned_bool):
 		raise NotImplementedError
@@ -723,11 +879,30 @@ class RectangularRegion(_RotatedRectangle, Region):
 	def conditionforSMT(self, condition, conditioned_bool):
 		raise NotImplementedError
 
-	def encodeToSMT(self, smt_file_path, cached_variables, obj, debug=False):
-		if not isinstance(obj, Samplable):
-			obj = self
-
-		raise NotImplementedError
+	def encodeToSMT(self, smt_file_path, cached_variables, obj=None, debug=False):
+		""" Encodes that the current object lies in the rectangle; this is linear if the
+		rectangle is fixed, and otherwise uses the cosine and sine of its heading """
+		if debug:
+			writeSMTtoFile(smt_file_path, "RectangularRegion")
+		point = cached_variables['current_obj']
+		if not needsSampling(self):
+			writeSMTtoFile(smt_file_path, smt_assert(None, encodeConvexPolygon_SMT(self.polygon, point)))
+			return point
+		(center_x, center_y) = checkAndEncodeSMT(smt_file_path, cached_variables, self.position)
+		heading = checkAndEncodeSMT(smt_file_path, cached_variables, self.heading)
+		hw = checkAndEncodeSMT(smt_file_path, cached_variables, self.hw)
+		hl = checkAndEncodeSMT(smt_file_path, cached_variables, self.hl)
+		dx, dy = smt_subtract(point[0], center_x), smt_subtract(point[1], center_y)
+		cos_h, sin_h = smt_cos(heading), smt_sin(heading)
+		# coordinates of the point along the width and length of the rectangle
+		along_width = smt_add(smt_multiply(dx, cos_h), smt_multiply(dy, sin_h))
+		along_length = smt_subtract(smt_multiply(dy, cos_h), smt_multiply(dx, sin_h))
+		constraints = []
+		for coordinate, half in ((along_width, hw), (along_length, hl)):
+			constraints.append(smt_lessThanEq(smt_subtract('0', half), coordinate))
+			constraints.append(smt_lessThanEq(coordinate, half))
+		writeSMTtoFile(smt_file_path, smt_assert(None, smt_junction('and', constraints)))
+		return point
 
 	def sampleGiven(self, value):
 		return RectangularRegion(value[self.position], value[self.heading],
@@ -826,7 +1001,9 @@ class PolylineRegion(Region):
 			return cached_variables[self]
 
 		point = cached_variables['current_obj']
-		linStringList = pruneValidLines(smt_file_path, cached_variables, self.lineString, debug=False)
+		with profileSection(smt_file_path, 'pruneValidLines'):
+			linStringList = pruneValidLines(smt_file_path, cached_variables, self.segmentIndex,
+			                                debug=False)
 		point = encodeLine_SMT(smt_file_path, cached_variables, linStringList, point, debug=False)
 		return cacheVarName(cached_variables, self, point)
 
@@ -851,6 +1028,12 @@ class PolylineRegion(Region):
 		else:
 			raise RuntimeError('called segmentsOf on non-linestring')
 
+	@cached_property
+	def segmentIndex(self):
+		"""Spatial index over the segments of this polyline, as LineStrings."""
+		return SpatialIndex(shapely.geometry.LineString((tuple(p), tuple(q)))
+		                    for p, q in self.segments)
+
 	def defaultOrientation(self, point):
 		start, end = self.nearestSegmentTo(point)
 		return start.angleTo(end)
@@ -1055,19 +1238,20 @@ class PolygonalRegion(Region):
 		if debug:
 			writeSMTtoFile(smt_file_path, "PolygonalRegion")
 
-		key_exists = False
-		for key in list(cached_variables.keys()):
-			if self is key:
-				key_exists = True
-
-		if key_exists:
+		if isCached(cached_variables, self):
 			writeSMTtoFile(smt_file_path, "PolygonalRegion ALREADY EXISTS IN CACHED_VARIABLES")
 			return cached_variables[self]
 
-		region_polygon = [triangle[0] for triangle in self.trianglesAndBounds]
-		intersection_triangles = pruneValidRegion(smt_file_path, cached_variables, region_polygon, debug=debug)
+		# cached_variables['polygon_encoding'] selects the encoding of the region:
+		# see encodePolygonalRegion_SMT
+		mode = cached_variables.get('polygon_encoding', 'barycentric')
+		with profileSection(smt_file_path, 'pruneValidRegion'):
+			index = self.convexPieceIndex if mode == 'convex' else self.triangleIndex
+			intersection_triangles = pruneValidRegion(smt_file_path, cached_variables, index,
+			                                          debug=debug)
 		point = cached_variables['current_obj']
-		encodePolygonalRegion_SMT(smt_file_path, cached_variables, intersection_triangles, point, debug=debug)
+		encodePolygonalRegion_SMT(smt_file_path, cached_variables, intersection_triangles, point,
+		                          debug=debug, mode=mode)
 
 		if debug:
 			print("PolygonalRegion cached_variables")
@@ -1173,6 +1357,16 @@ class PolygonalRegion(Region):
 	def prepared(self):
 		return shapely.prepared.prep(self.polygons)
 
+	@cached_property
+	def triangleIndex(self):
+		"""Spatial index over the triangulation of this region."""
+		return SpatialIndex(triangle for triangle, bounds in self.trianglesAndBounds)
+
+	@cached_property
+	def convexPieceIndex(self):
+		"""Spatial index over a decomposition of this region into convex polygons."""
+		return SpatialIndex(convexPieces(triangle for triangle, bounds in self.trianglesAndBounds))
+
 	def containsPoint(self, point):
 		return self.prepared.intersects(shapely.geometry.Point(point))
 
@@ -1194,7 +1388,7 @@ class PolygonalRegion(Region):
 		return self.polygons.distance(shapely.geometry.Point(point))
 
 	def getAABB(self):
-		xmin, xmax, ymin, ymax = self.polygons.bounds
+		xmin, ymin, xmax, ymax = self.polygons.bounds
 		return ((xmin, ymin), (xmax, ymax))
 
 	def show(self, plt, style='r-', **kwargs):
@@ -1217,6 +1411,8 @@ class PolygonalRegion(Region):
 	def __getstate__(self):
 		state = self.__dict__.copy()
 		state.pop('_cached_prepared', None)		# prepared geometries are not picklable
+		state.pop('_cached_triangleIndex', None)	# rebuilt lazily when needed
+		state.pop('_cached_convexPieceIndex', None)
 		return state
 
 class PointSetRegion(Region):
@@ -0,0 +1,221 @@
+"""Persistent cache of the results of SMT queries.
+
+Running a dataset query again after a small change usually produces many of the
+same SMT problems as before. A `ResultCache` stores the result of each problem (and
+the model found, if any) in an SQLite database on disk, keyed by a hash of the
+canonical form of its encoding, so that repeated problems are looked up instead of
+solved::
+
+	with ResultCache('~/.cache/scenic/smt.db') as cache:
+		for frame in frames:
+			context = ...		# encode the query for this frame
+			result, model = cache.check(context)
+
+The canonical form (see `canonicalForm`) does not depend on the order of the
+declarations or on the names chosen for the variables, so the same problem is
+recognized even if the numbering of variables changes between runs. Once the
+cache holds more than a given number of results, the least recently used ones are
+evicted.
+"""
+
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import time
+
+from scenic.core.smt import parseDeclaration, toSMTLIB
+
+_tokenPattern = re.compile(r'\|[^|]*\||"[^"]*"|[^\s()]+')
+
+def canonicalForm(context):
+	"""Get a canonical form of the encoding stored in an `EncodingContext`.
+
+	Declared constants are renamed to ``v1``, ``v2``, etc. in order of their first
+	use in the definitions and assertions, and declared in that order. Other
+	declarations, such as ``define-fun`` commands, are kept in their original order
+	with the functions they declare renamed to ``f1``, ``f2``, etc.; comments and
+	commands other than declarations and assertions are dropped.
+
+	Returns:
+		A pair consisting of the canonical SMT-LIB text and the list of the original
+		names of the constants, in canonical order.
+	"""
+	sorts = {}
+	definitions = []
+	functions = {}
+	for declaration in context.declarations:
+		constant = parseDeclaration(declaration)
+		if constant is not None:
+			sorts[constant[0]] = constant[1]
+		else:
+			definitions.append(declaration.strip())
+			name = _tokenPattern.findall(declaration)[1]
+			functions[name] = f'f{len(functions)+1}'
+	renaming = {}
+	def rename(match):
+		token = match.group(0)
+		if token in sorts:
+			if token not in renaming:
+				renaming[token] = f'v{len(renaming)+1}'
+			return renaming[token]
+		return functions.get(token, token)
+	definitions = [_tokenPattern.sub(rename, definition) for definition in definitions]
+	assertions = []
+	for command in context.body:
+		command = toSMTLIB(command).strip()
+		if command.startswith('(assert'):
+			assertions.append(_tokenPattern.sub(rename, command))
+	for name in sorts:		# declared but unused constants
+		if name not in renaming:
+			renaming[name] = f'v{len(renaming)+1}'
+	names = list(renaming)
+	lines = [f'(set-logic {context.logic})'] if context.logic is not None else []
+	lines.extend(f'(declare-fun {renaming[name]} () {sorts[name]})' for name in names)
+	lines.extend(definitions)
+	lines.extend(assertions)
+	return '\n'.join(lines), names
+
+class ResultCache:
+	"""Cache of SMT results, stored in an SQLite database.
+
+	Args:
+		path (str): path of the database file, which is created if necessary; the
+		  cache can be shared between processes.
+		maxEntries (int): maximum number of results to keep, or :obj:`None` for no
+		  limit.
+	"""
+	def __init__(self, path, maxEntries=100000):
+		path = os.path.expanduser(path)
+		directory = os.path.dirname(path)
+		if directory:
+			os.makedirs(directory, exist_ok=True)
+		self.path = path
+		self.maxEntries = maxEntries
+		self.hits = self.misses = 0
+		self._db = sqlite3.connect(path, timeout=30)
+		with self._db:
+			self._db.execute('CREATE TABLE IF NOT EXISTS results ('
+			                 'key TEXT PRIMARY KEY, result TEXT NOT NULL, model TEXT, '
+			                 'used REAL NOT NULL)')
+			self._db.execute('CREATE INDEX IF NOT EXISTS results_used ON results (used)')
+
+	@staticmethod
+	def key(context):
+		"""Get the key of an encoding, together with its constants in canonical order."""
+		text, names = canonicalForm(context)
+		return hashlib.sha256(text.encode()).hexdigest(), names
+
+	def get(self, context):
+		"""Look up the result and model of an encoding, or :obj:`None` if not cached.
+
+		The model uses the names of the constants in the given encoding.
+		"""
+		return self._get(*self.key(context))
+
+	def put(self, context, result, model=None):
+		"""Store the result of checking an encoding, and the model found, if any.
+
+		Only ``'sat'`` and ``'unsat'`` results are stored.
+		"""
+		if result not in ('sat', 'unsat'):
+			return
+		key, names = self.key(context)
+		self._store(key, result, self._toCanonical(model, names))
+
+	def check(self, context, solver=None):
+		"""Check an encoding, using the cached result if there is one.
+
+		Otherwise the encoding is checked using **solver** (a `SMTSolver`, inside a
+		`push`/`pop` pair so that the session can be reused), or a new session
+		started by `defaultSolver` if **solver** is :obj:`None`, and the result is
+		stored. Returns the result and the model found, if any.
+		"""
+		key, names = self.key(context)
+		cached = self._get(key, names)
+		if cached is not None:
+			return cached
+		if solver is None:
+			from scenic.core.solvers import defaultSolver
+			with defaultSolver(logic=context.logic) as solver:
+				result, model = self._solve(context, solver, names)
+		else:
+			with solver.frame():
+				result, model = self._solve(context, solver, names)
+		if result in ('sat', 'unsat'):
+			self._store(key, result, self._toCanonical(model, names))
+		return result, model
+
+	def clear(self):
+		"""Remove all stored results."""
+		with self._db:
+			self._db.execute('DELETE FROM results')
+
+	def close(self):
+		self._db.close()
+
+	def __len__(self):
+		return self._db.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def __repr__(self):
+		return f'ResultCache({self.path!r}, maxEntries={self.maxEntries})'
+
+	## Internals
+
+	@staticmethod
+	def _solve(context, solver, names):
+		solver.load(context)
+		result = solver.check()
+		model = solver.model(names) if result == 'sat' else None
+		return result, model
+
+	@staticmethod
+	def _toCanonical(model, names):
+		if model is None:
+			return None
+		return { f'v{i}': model[name] for i, name in enumerate(names, start=1)
+		         if name in model }
+
+	@staticmethod
+	def _fromCanonical(model, names):
+		if model is None:
+			return None
+		return { name: model[f'v{i}'] for i, name in enumerate(names, start=1)
+		         if f'v{i}' in model }
+
+	def _get(self, key, names):
+		entry = self._lookup(key)
+		if entry is None:
+			self.misses += 1
+			return None
+		self.hits += 1
+		result, model = entry
+		return result, self._fromCanonical(model, names)
+
+	def _lookup(self, key):
+		with self._db:
+			row = self._db.execute('SELECT result, model FROM results WHERE key = ?',
+			                       (key,)).fetchone()
+			if row is None:
+				return None
+			self._db.execute('UPDATE results SET used = ? WHERE key = ?',
+			                 (time.time(), key))
+		result, model = row
+		return result, (None if model is None else json.loads(model))
+
+	def _store(self, key, result, model):
+		model = None if model is None else json.dumps(model)
+		with self._db:
+			self._db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)',
+			                 (key, result, model, time.time()))
+			if self.maxEntries is not None:
+				self._db.execute('DELETE FROM results WHERE key IN '
+				                 '(SELECT key FROM results ORDER BY used DESC, rowid DESC '
+				                 'LIMIT -1 OFFSET ?)', (self.maxEntries,))
@@ -1,13 +1,20 @@
 """Scenario and scene objects."""
 
+import collections.abc
+import contextlib
+import math
 import random
 import time
+import warnings
 
-from scenic.core.distributions import Samplable, RejectionException, needsSampling
+from scenic.core.distributions import (Samplable, Constant, RejectionException, needsSampling,
+                                       supportInterval, writeSMTtoFile, smt_assert)
 from scenic.core.lazy_eval import needsLazyEvaluation
 from scenic.core.external_params import ExternalSampler
 from scenic.core.regions import EmptyRegion
+import scenic.core.regions as regions
 from scenic.core.workspaces import Workspace
+from scenic.core.type_support import TypecheckedDistribution
 from scenic.core.vectors import Vector
 from scenic.core.utils import areEquivalent
 from scenic.core.errors import InvalidScenarioError
@@ -53,6 +60,11 @@ class Scene:
 			self.workspace.zoomAround(plt, self.objects, expansion=zoom)
 		plt.show(block=block)
 
+def _fixedValue(thing):
+	"""The value of a quantity, if it is fixed (possibly by conditioning)."""
+	low, high = supportInterval(thing)
+	return low if low is not None and low == high else None
+
 class Scenario:
 	"""Scenario()
 
@@ -156,6 +168,111 @@ class Scenario:
 			return False
 		return True
 
+	@contextlib.contextmanager
+	def conditioned(self, conditions):
+		"""Context manager temporarily conditioning values of this scenario.
+
+		Within the ``with`` block, each value behaves as if conditioned with
+		`Samplable.conditionTo`; on exit, the previous conditioning is restored. No
+		copies are made, so a single scenario can be matched against many frames::
+
+			for label in labels:
+				with scenario.conditioned({ ego.position: label.position }):
+					...
+
+		Args:
+			conditions: mapping, or iterable of pairs, from `Samplable` values of the
+			  scenario (e.g. ``obj.position``) to the values to condition them to. Values
+			  which are not `Samplable` are wrapped in a `Constant`.
+		"""
+		if isinstance(conditions, collections.abc.Mapping):
+			conditions = conditions.items()
+		saved = []
+		try:
+			for dist, value in conditions:
+				while isinstance(dist, TypecheckedDistribution):
+					dist = dist.dist
+				if not isinstance(dist, Samplable):
+					raise RuntimeError(f'cannot condition non-random value {dist}')
+				if not isinstance(value, Samplable):
+					value = Constant(value)
+				saved.append((dist, dist._conditioned))
+				dist.conditionTo(value)
+			yield self
+		finally:
+			for dist, old in reversed(saved):
+				dist._conditioned = old
+
+	def encodeBuiltinRequirements(self, smt_file_path, cached_variables, positions, ego=None):
+		"""Encode the built-in containment and non-intersection requirements into SMT.
+
+		The linear encodings of `regions.encodeRectangleInPolygon_SMT` and
+		`regions.encodeRectangleSeparation_SMT` are used, so only objects whose
+		heading, width, and length are fixed (possibly by conditioning) are
+		constrained, and containment is only encoded for polygonal containers; a
+		warning lists the requirements which are not encoded. The visibility
+		requirement is not encoded here, since objects are already constrained to
+		the visible region of the ego when their positions are encoded.
+
+		Args:
+			smt_file_path: `EncodingContext` or file to write the encoding to.
+			cached_variables: the cache used to encode the positions of the objects.
+			positions: pairs (obj, (x, y)) giving the terms encoding the position of
+			  each object to constrain.
+			ego: optional pair (position, heading) giving the pose of the ego, where the
+			  position is a pair of terms and the heading a number or a pair of terms
+			  giving its cosine and sine (see `regions.rectangleCorners_SMT`). If given,
+			  the objects are also required not to intersect the ego.
+
+		Returns:
+			The number of assertions made.
+		"""
+		sector = regions.visibleSectorPolygon(smt_file_path, cached_variables)
+		dropped = []
+		rectangles = []
+		for obj, position in positions:
+			shape = [_fixedValue(obj.heading), _fixedValue(obj.hw), _fixedValue(obj.hl)]
+			if None in shape:
+				dropped.append(f'containment and non-intersection of {obj} (random heading or size)')
+			else:
+				rectangles.append((obj, (position, *shape)))
+
+		count = 0
+		for obj, rectangle in rectangles:
+			container = self.containerOfObject(obj)
+			if isinstance(container, regions.AllRegion):
+				continue
+			if not isinstance(container, regions.PolygonalRegion):
+				dropped.append(f'containment of {obj} in {container} (not polygonal)')
+				continue
+			if sector is None:
+				pieces = container.convexPieceIndex.geometries
+			else:
+				# the corners of a visible object are within its radius of the sector
+				radius = math.hypot(rectangle[2], rectangle[3])
+				pieces = container.convexPieceIndex.intersecting(sector.buffer(radius))
+			encoding = regions.encodeRectangleInPolygon_SMT(rectangle, pieces)
+			writeSMTtoFile(smt_file_path, smt_assert(None, encoding))
+			count += 1
+		for i, (obj, rectangle) in enumerate(rectangles):
+			for other, otherRectangle in rectangles[:i]:
+				encoding = regions.encodeRectangleSeparation_SMT(rectangle, otherRectangle)
+				writeSMTtoFile(smt_file_path, smt_assert(None, encoding))
+				count += 1
+		if ego is not None:
+			egoShape = (_fixedValue(self.egoObject.hw), _fixedValue(self.egoObject.hl))
+			if None in egoShape:
+				dropped.append('non-intersection with the ego (random size)')
+			else:
+				egoRectangle = (*ego, *egoShape)
+				for obj, rectangle in rectangles:
+					encoding = regions.encodeRectangleSeparation_SMT(egoRectangle, rectangle)
+					writeSMTtoFile(smt_file_path, smt_assert(None, encoding))
+					count += 1
+		if dropped:
+			warnings.warn('built-in requirements not encoded: ' + '; '.join(dropped))
+		return count
+
 	def generate(self, maxIterations=2000, verbosity=0, feedback=None):
 		"""Sample a `Scene` from this scenario.
 
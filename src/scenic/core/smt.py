@@ -0,0 +1,750 @@
+"""Support for building SMT-LIB encodings of scenarios.
+
+The ``encodeToSMT`` methods of Samplables emit SMT-LIB commands through
+`writeSMTtoFile`. Originally each command was appended directly to a file on disk;
+passing an `EncodingContext` in place of the file path instead collects the whole
+encoding in memory, so that it can be written out once at the end as a file, a
+string, or a stream (e.g. the standard input of a solver process)::
+
+	context = EncodingContext()
+	point = obj.position.encodeToSMT(context, cached_variables)
+	context.write('(check-sat)')
+	context.writeTo('query.smt2')
+
+When objects are conditioned to constant values, much of the encoding becomes
+constant; `EncodingContext.simplify` folds such subterms away and, if the result
+is linear, switches the logic to the (much faster) QF_LRA.
+"""
+
+import collections.abc
+import decimal
+import io
+import math
+import re
+import weakref
+
+## Terms
+
+class Term:
+	"""An SMT-LIB term, built from an operator applied to arguments.
+
+	Terms are hash-consed: constructing a term structurally equal to an existing one
+	returns the existing object. Arguments are either other terms or strings (for
+	variables and numerals), so equality and hashing of terms are by identity and
+	building a term costs time proportional to its number of arguments, not to the
+	size of its subterms.
+
+	Subterms occurring more than once in an assertion are emitted only once, bound
+	with ``let`` (see `toSMTLIB`). For compatibility with encoders which assemble
+	strings by hand, concatenating a term with a string yields the plain string form.
+	"""
+	__slots__ = ('op', 'args', '__weakref__')
+	_table = weakref.WeakValueDictionary()
+
+	def __new__(cls, op, *args):
+		key = (op, args)
+		term = cls._table.get(key)
+		if term is None:
+			for arg in args:
+				if not isinstance(arg, (str, Term)):
+					raise TypeError(f'invalid argument {arg!r} for SMT term')
+			term = super().__new__(cls)
+			term.op = op
+			term.args = args
+			cls._table[key] = term
+		return term
+
+	def __reduce__(self):
+		return (Term, (self.op,) + self.args)
+
+	def __add__(self, other):
+		if not isinstance(other, str):
+			return NotImplemented
+		return str(self) + other
+
+	def __radd__(self, other):
+		if not isinstance(other, str):
+			return NotImplemented
+		return other + str(self)
+
+	def __str__(self):
+		return toSMTLIB(self, share=False)
+
+	def __repr__(self):
+		return f'Term({self.op!r}, {len(self.args)} args)'
+
+def isTerm(thing):
+	"""Whether something can be used as an SMT term (a `Term` or a string)."""
+	return isinstance(thing, (str, Term))
+
+def _postorder(root, stop=()):
+	"""Iterate over the distinct compound subterms of a term, children first.
+
+	Subterms whose ids are in **stop** are not descended into. Uses an explicit
+	stack since terms like long disjunctions can be very deep.
+	"""
+	seen = set()
+	stack = [(root, False)]
+	while stack:
+		term, expanded = stack.pop()
+		if expanded:
+			yield term
+			continue
+		if id(term) in seen:
+			continue
+		seen.add(id(term))
+		stack.append((term, True))
+		for arg in reversed(term.args):
+			if isinstance(arg, Term) and id(arg) not in seen and id(arg) not in stop:
+				stack.append((arg, False))
+
+def _render(term, names):
+	"""Render a term, writing its proper subterms in ``names`` by name."""
+	pieces = []
+	stack = [term]
+	while stack:
+		item = stack.pop()
+		if isinstance(item, str):
+			pieces.append(item)
+		elif item is not term and id(item) in names:
+			pieces.append(names[id(item)])
+		else:
+			pieces.append('(' + item.op)
+			stack.append(')')
+			for arg in reversed(item.args):
+				stack.append(arg)
+				stack.append(' ')
+	return ''.join(pieces)
+
+def toSMTLIB(term, share=True):
+	"""Convert a term to SMT-LIB syntax.
+
+	If **share** is true, compound subterms occurring more than once are bound to
+	fresh names with ``let`` and written out only once. Assertions are handled
+	specially so that the bindings go inside the ``assert``.
+	"""
+	if isinstance(term, str):
+		return term
+	if term.op == 'assert' and len(term.args) == 1:
+		return '(assert ' + toSMTLIB(term.args[0], share=share) + ')'
+	if not share:
+		return _render(term, {})
+
+	# Count references to each compound subterm
+	order = list(_postorder(term))
+	refs = {}
+	for sub in order:
+		for arg in sub.args:
+			if isinstance(arg, Term):
+				refs[id(arg)] = refs.get(id(arg), 0) + 1
+	shared = {id(sub) for sub in order
+	          if refs.get(id(sub), 0) > 1 and numericValue(sub) is None}
+	if not shared:
+		return _render(term, {})
+
+	# Group shared subterms into levels so each binding only uses earlier ones
+	depth = {}		# maximum level of a shared subterm below (or at) each subterm
+	levels = []
+	for sub in order:
+		below = -1
+		for arg in sub.args:
+			if isinstance(arg, Term):
+				below = max(below, depth[id(arg)])
+		if id(sub) in shared:
+			level = below + 1
+			if level == len(levels):
+				levels.append([])
+			levels[level].append(sub)
+			depth[id(sub)] = level
+		else:
+			depth[id(sub)] = below
+
+	names = {}
+	for level in levels:
+		for sub in level:
+			names[id(sub)] = f'?t{len(names)+1}'
+	prefix = []
+	for level in levels:
+		bindings = []
+		for sub in level:
+			bindings.append(f'({names[id(sub)]} {_render(sub, names)})')
+		prefix.append('(let (' + ' '.join(bindings) + ') ')
+	return ''.join(prefix) + _render(term, names) + ')' * len(levels)
+
+def parseTerm(text):
+	"""Parse SMT-LIB syntax into a `Term` (or a string, for an atom).
+
+	Only plain applications ``(op arg ...)`` are supported; raises `ValueError` for
+	anything else (e.g. ``let`` bindings or indexed identifiers).
+	"""
+	tokens = re.findall(r'\(|\)|[^\s()]+', text)
+	stack = [[]]
+	for token in tokens:
+		if token == '(':
+			stack.append([])
+		elif token == ')':
+			if len(stack) < 2:
+				raise ValueError(f'unbalanced parentheses in {text!r}')
+			items = stack.pop()
+			if not items or not isinstance(items[0], str) or items[0] == 'let':
+				raise ValueError(f'unsupported SMT-LIB syntax in {text!r}')
+			stack[-1].append(Term(items[0], *items[1:]))
+		else:
+			stack[-1].append(token)
+	if len(stack) != 1 or len(stack[0]) != 1:
+		raise ValueError(f'malformed SMT-LIB term {text!r}')
+	return stack[0][0]
+
+def parseDeclaration(command):
+	"""Get the name and sort of the constant declared by a command, if any.
+
+	Returns :obj:`None` for commands other than declarations of constants.
+	"""
+	parts = command.replace('(', ' ( ').replace(')', ' ) ').split()
+	if parts[1:2] == ['declare-fun'] and parts[3:5] == ['(', ')'] and len(parts) == 7:
+		return parts[2], parts[5]
+	if parts[1:2] == ['declare-const'] and len(parts) == 5:
+		return parts[2], parts[3]
+	return None
+
+## Simplification
+
+_numeralPattern = re.compile(r'-?[0-9]+(\.[0-9]*)?([eE][-+]?[0-9]+)?')
+
+def numericValue(term):
+	"""The value of a numeral (possibly negated), or :obj:`None` for other terms."""
+	if isinstance(term, str):
+		if _numeralPattern.fullmatch(term):
+			return float(term)
+		return None
+	if term.op == '-' and len(term.args) == 1:
+		value = numericValue(term.args[0])
+		return None if value is None else -value
+	return None
+
+def numeral(value):
+	"""The SMT-LIB numeral for a float, with negative numbers written as ``(- n)``."""
+	text = format(decimal.Decimal(repr(abs(value))), 'f')
+	if '.' not in text:
+		text += '.0'
+	return Term('-', text) if value < 0 else text
+
+_folders = {
+	'+': lambda *xs: math.fsum(xs),
+	'*': lambda *xs: math.prod(xs),
+	'-': lambda x, *ys: x - math.fsum(ys) if ys else -x,
+	'/': lambda x, y: x / y,
+	'abs': abs, 'cos': math.cos, 'sin': math.sin,
+}
+_comparisons = {
+	'<': lambda x, y: x < y, '<=': lambda x, y: x <= y,
+	'>': lambda x, y: x > y, '>=': lambda x, y: x >= y, '=': lambda x, y: x == y,
+}
+
+def _fold(op, args):
+	"""Build the term ``(op args...)``, simplified assuming its arguments are."""
+	values = [numericValue(arg) for arg in args]
+	if op in _folders and all(value is not None for value in values):
+		try:
+			result = _folders[op](*values)
+		except (ArithmeticError, TypeError, ValueError):
+			result = None
+		if result is not None and math.isfinite(result):
+			return numeral(result)
+	elif op in _comparisons and len(args) == 2:
+		if all(value is not None for value in values):
+			return 'true' if _comparisons[op](*values) else 'false'
+		if op in ('=', '<=', '>=') and args[0] is args[1]:
+			return 'true'
+	elif op in ('and', 'or'):
+		unit, zero = ('true', 'false') if op == 'and' else ('false', 'true')
+		if zero in args:
+			return zero
+		args = [arg for arg in args if arg != unit]
+		if not args:
+			return unit
+		if len(args) == 1:
+			return args[0]
+	elif op == 'not' and len(args) == 1 and args[0] in ('true', 'false'):
+		return 'false' if args[0] == 'true' else 'true'
+	elif op == 'ite' and args[0] in ('true', 'false'):
+		return args[1] if args[0] == 'true' else args[2]
+	elif op == 'abs' and len(args) == 1:
+		# abs is not part of the SMT-LIB theory of reals, so spell it out
+		return Term('ite', Term('<', args[0], '0.0'), Term('-', args[0]), args[0])
+
+	# Identities: drop additive zeros and multiplicative ones; x * 0 = 0
+	if op == '*':
+		if 0.0 in values:
+			return '0.0'
+		args = [arg for arg, value in zip(args, values) if value != 1.0]
+		if not args:
+			return '1.0'
+		if len(args) == 1:
+			return args[0]
+	elif op == '+':
+		args = [arg for arg, value in zip(args, values) if value != 0.0]
+		if not args:
+			return '0.0'
+		if len(args) == 1:
+			return args[0]
+	elif op == '-' and len(args) == 2 and values[1] == 0.0:
+		return args[0]
+	return Term(op, *args)
+
+def simplify(term, bindings=None):
+	"""Fold constant subterms of a term, substituting variables given in **bindings**.
+
+	Negative numerals are also normalized to the SMT-LIB form ``(- n)``.
+	"""
+	if bindings is None:
+		bindings = {}
+	def atom(name):
+		seen = 0
+		while name in bindings and seen <= len(bindings):	# follow chains of aliases
+			name = bindings[name]
+			seen += 1
+			if not isinstance(name, str):
+				return name
+		value = numericValue(name)
+		return name if value is None or value >= 0 else numeral(value)
+
+	if isinstance(term, str):
+		return atom(term)
+	results = {}
+	for sub in _postorder(term):
+		args = [results[id(arg)] if isinstance(arg, Term) else atom(arg)
+		        for arg in sub.args]
+		results[id(sub)] = _fold(sub.op, args)
+	return results[id(term)]
+
+_linearOps = frozenset(('+', '-', '*', '/', 'ite', 'and', 'or', 'not', '=>',
+                        '=', 'distinct', '<', '<=', '>', '>=', 'assert'))
+
+def isLinear(term):
+	"""Whether a (simplified) term lies within linear real arithmetic."""
+	if isinstance(term, str):
+		return True
+	for sub in _postorder(term):
+		if sub.op not in _linearOps:
+			return False
+		if sub.op == '*':
+			if sum(numericValue(arg) is None for arg in sub.args) > 1:
+				return False
+		elif sub.op == '/':
+			if any(numericValue(arg) is None for arg in sub.args[1:]):
+				return False
+	return True
+
+## Caches of encoded objects
+
+class DeclaredNames(collections.abc.Sequence):
+	"""Ordered collection of declared variable names, with constant-time membership.
+
+	Replaces the plain list stored under ``'variables'`` in the encoding cache;
+	supports the ``append`` and ``in`` operations the encoders use on that list.
+	Appending a name which is already present has no effect.
+	"""
+	def __init__(self, names=()):
+		self._names = []
+		self._set = set()
+		for name in names:
+			self.append(name)
+
+	def append(self, name):
+		if name not in self._set:
+			self._set.add(name)
+			self._names.append(name)
+
+	def __contains__(self, name):
+		return name in self._set
+
+	def __getitem__(self, index):
+		return self._names[index]
+
+	def __iter__(self):
+		return iter(self._names)
+
+	def __len__(self):
+		return len(self._names)
+
+	def __repr__(self):
+		return f'DeclaredNames({self._names})'
+
+class EncodingCache(collections.abc.MutableMapping):
+	"""Cache of the variables encoding each object, for use as ``cached_variables``.
+
+	A drop-in replacement for the dictionary passed to the ``encodeToSMT`` methods.
+	String keys (``'ego'``, ``'ego_visibleRegion'``, etc.) behave as in an ordinary
+	dictionary; any other key is looked up by identity, like `DefaultIdentityDict`,
+	so lookups take constant time and never invoke the (possibly expensive or, for
+	distributions, forbidden) ``__eq__`` and ``__hash__`` methods of Samplables.
+	The names of declared variables are kept under ``'variables'`` as a
+	`DeclaredNames`.
+	"""
+	def __init__(self, items=(), **kwargs):
+		self._named = { 'variables': DeclaredNames() }
+		self._objects = {}		# maps id(obj) to (obj, value), keeping obj alive
+		self.update(items, **kwargs)
+
+	@property
+	def variables(self):
+		"""The `DeclaredNames` of all variables declared so far."""
+		return self._named['variables']
+
+	def __getitem__(self, key):
+		if isinstance(key, str):
+			return self._named[key]
+		try:
+			return self._objects[id(key)][1]
+		except KeyError:
+			raise KeyError(key) from None
+
+	def __setitem__(self, key, value):
+		if isinstance(key, str):
+			if key == 'variables' and not isinstance(value, DeclaredNames):
+				value = DeclaredNames(value)
+			self._named[key] = value
+		else:
+			self._objects[id(key)] = (key, value)
+
+	def __delitem__(self, key):
+		if isinstance(key, str):
+			del self._named[key]
+		else:
+			try:
+				del self._objects[id(key)]
+			except KeyError:
+				raise KeyError(key) from None
+
+	def __contains__(self, key):
+		if isinstance(key, str):
+			return key in self._named
+		return id(key) in self._objects
+
+	def __iter__(self):
+		yield from self._named
+		for obj, value in self._objects.values():
+			yield obj
+
+	def __len__(self):
+		return len(self._named) + len(self._objects)
+
+	def __repr__(self):
+		return (f'<EncodingCache with {len(self._objects)} objects '
+		        f'and {len(self.variables)} variables>')
+
+## Fresh variable names
+
+class NameAllocator:
+	"""Allocator of fresh variable names, numbered separately for each prefix.
+
+	Each prefix keeps its own counter, so allocating a name takes constant time
+	(rather than counting all previous names with the same prefix). Every name
+	handed out or reserved is remembered, so names can never collide even when one
+	prefix extends another (e.g. ``x`` followed by ``11`` and ``x1`` followed
+	by ``1``).
+
+	Args:
+		parent (`NameAllocator`): allocator to continue from (see `fork`).
+	"""
+	def __init__(self, parent=None):
+		self._parent = parent
+		self._counters = {} if parent is None else dict(parent._counters)
+		self._taken = set()
+
+	def fresh(self, prefix, avoid=()):
+		"""Get a fresh name starting with the given prefix.
+
+		Names in **avoid** (e.g. those already recorded in an `EncodingCache`) are
+		skipped as well.
+		"""
+		count = self._counters.get(prefix, 0)
+		while True:
+			count += 1
+			name = prefix + str(count)
+			if name not in self and name not in avoid:
+				break
+		self._counters[prefix] = count
+		self._taken.add(name)
+		return name
+
+	def reserve(self, name):
+		"""Mark a name as used, so that it will not be handed out."""
+		self._taken.add(name)
+
+	def fork(self):
+		"""Get a new allocator which continues from the current state of this one.
+
+		Names used so far remain unavailable to the fork, but are not copied, so
+		forking takes time proportional only to the number of distinct prefixes.
+		This allows many encodings (e.g. one per frame of a dataset query) to extend
+		a common prefix encoding.
+		"""
+		return NameAllocator(parent=self)
+
+	def reset(self):
+		"""Forget all names allocated so far (including those of any parent)."""
+		self._parent = None
+		self._counters.clear()
+		self._taken.clear()
+
+	def __contains__(self, name):
+		allocator = self
+		while allocator is not None:
+			if name in allocator._taken:
+				return True
+			allocator = allocator._parent
+		return False
+
+## Encoding contexts
+
+class EncodingContext:
+	"""In-memory buffer for an SMT-LIB encoding under construction.
+
+	Declarations are kept separately from the other commands so that they are
+	always emitted first, regardless of the order in which variables were created.
+	Free-text debugging markers (as written by the ``debug`` mode of the encoders)
+	are stored as SMT-LIB comments, so the output remains a valid script.
+
+	Args:
+		logic (str): SMT-LIB logic for the ``set-logic`` header, or :obj:`None` to
+		  omit the header.
+		path (str): default file for `flush`, if any.
+		profiler (`EncodingProfiler`): profiler recording the construction of the
+		  encoding, if any (see :mod:`scenic.core.profiling`).
+	"""
+	def __init__(self, logic='QF_NRA', path=None, profiler=None):
+		self.logic = logic
+		self.path = path
+		self.profiler = profiler
+		self.declarations = []
+		self.body = []
+		self.numAssertions = 0
+		self.names = NameAllocator()
+
+	def _addDeclaration(self, declaration):
+		self.declarations.append(declaration)
+		if self.profiler is not None:
+			self.profiler.declared(declaration)
+
+	def _addCommand(self, command, assertion=False):
+		self.body.append(command)
+		if assertion:
+			self.numAssertions += 1
+		if self.profiler is not None:
+			self.profiler.emitted(toSMTLIB(command), assertion)
+
+	def declare(self, name, sort='Real'):
+		"""Declare a new constant of the given sort."""
+		self.names.reserve(name)
+		self._addDeclaration(f'(declare-fun {name} () {sort})')
+
+	def declareFresh(self, prefix, sort='Real', avoid=()):
+		"""Declare a new constant with a fresh name, returning the name."""
+		name = self.names.fresh(prefix, avoid)
+		self._addDeclaration(f'(declare-fun {name} () {sort})')
+		return name
+
+	def addAssertion(self, term):
+		"""Assert an SMT-LIB term (without the enclosing ``assert``)."""
+		if isinstance(term, Term):
+			self._addCommand(Term('assert', term), assertion=True)
+		else:
+			self._addCommand(f'(assert {term})', assertion=True)
+
+	def comment(self, text):
+		"""Add a comment, e.g. a debugging marker."""
+		for line in str(text).splitlines():
+			self._addCommand('; ' + line)
+
+	def write(self, command):
+		"""Add a raw SMT-LIB command, as passed to `writeSMTtoFile`.
+
+		Pairs of commands (as produced by ``vector_operation_smt``) are also accepted.
+		"""
+		if isinstance(command, tuple) and len(command) == 2:
+			self.write(command[0])
+			self.write(command[1])
+			return
+		if isinstance(command, Term):
+			if command.op != 'assert':
+				raise RuntimeError(f'tried to write non-command term {command!r}')
+			self._addCommand(command, assertion=True)
+			return
+		if not isinstance(command, str):
+			raise TypeError(f'cannot write SMT command of type {type(command).__name__}')
+		command = command.strip()
+		if not command:
+			return
+		if command.startswith('(declare-') or command.startswith('(define-'):
+			self._addDeclaration(' '.join(command.split()))
+		elif command.startswith('(assert'):
+			self._addCommand(command, assertion=True)
+		elif command.startswith('(set-logic'):
+			self.logic = command[len('(set-logic'):-1].strip()
+		elif command.startswith('('):
+			self._addCommand(command)
+		else:
+			self.comment(command)
+
+	def simplify(self, bindings=None):
+		"""Simplify the assertions encoded so far.
+
+		Constant subterms are folded (including ``cos``/``sin`` of constants, which
+		arise when headings are conditioned) and variables asserted equal to a
+		constant or to another variable are substituted into the other assertions.
+		The defining equations themselves are kept, so models still give values to
+		all declared variables. Since ``abs`` is not part of the SMT-LIB theory of
+		reals, it is rewritten with ``ite``. If the logic is QF_NRA and no nonlinear
+		terms remain, it is changed to QF_LRA.
+
+		Values for further variables (e.g. parameters of an encoding) may be given as a
+		dictionary **bindings** mapping names to numbers.
+		"""
+		declared = set()
+		for declaration in self.declarations:
+			constant = parseDeclaration(declaration)
+			if constant is not None and constant[1] == 'Real':
+				declared.add(constant[0])
+
+		# Parse assertions given as strings; other commands are left alone
+		commands = []
+		linear = True
+		for command in self.body:
+			if isinstance(command, str) and command.startswith('(assert'):
+				try:
+					command = parseTerm(command)
+				except ValueError:
+					linear = False
+			commands.append(command)
+
+		if bindings is None:
+			bindings = {}
+		bindings = { name: numeral(float(value)) for name, value in bindings.items() }
+		definitions, definitionValues = {}, {}	# assertion index -> variable -> value
+		results = list(commands)
+		changed = True
+		while changed:
+			changed = False
+			for index, command in enumerate(commands):
+				if not isinstance(command, Term):
+					continue
+				# don't substitute a variable into its own definition
+				defined = definitions.pop(index, None)
+				if defined is not None:
+					del bindings[defined]
+				result = simplify(command, bindings)
+				if defined is not None:
+					bindings[defined] = definitionValues[defined]
+					definitions[index] = defined
+				results[index] = result
+				if index in definitions or not (isinstance(result, Term) and result.op == 'assert'):
+					continue
+				fact = result.args[0]
+				if not (isinstance(fact, Term) and fact.op == '=' and len(fact.args) == 2):
+					continue
+				for var, value in (fact.args, reversed(fact.args)):
+					if (isinstance(var, str) and var in declared and var not in bindings
+					    and (numericValue(value) is not None
+					         or (isinstance(value, str) and value in declared
+					             and simplify(value, bindings) != var))):
+						bindings[var] = definitionValues[var] = value
+						definitions[index] = var
+						changed = True
+						break
+
+		body = []
+		numAssertions = 0
+		for result in results:
+			if isinstance(result, Term) and result.op == 'assert':
+				if result.args[0] == 'true':
+					continue
+				numAssertions += 1
+				linear = linear and isLinear(result)
+			elif isinstance(result, str) and result.startswith('(assert'):
+				numAssertions += 1
+			body.append(result)
+		self.body = body
+		self.numAssertions = numAssertions
+		if linear and self.logic == 'QF_NRA':
+			self.logic = 'QF_LRA'
+		return self
+
+	def lines(self):
+		"""Iterate over the lines of the complete SMT-LIB script."""
+		if self.logic is not None:
+			yield f'(set-logic {self.logic})'
+		yield from self.declarations
+		for command in self.body:
+			yield toSMTLIB(command)
+
+	def writeToStream(self, stream):
+		"""Write the encoding to a text stream."""
+		for line in self.lines():
+			stream.write(line)
+			stream.write('\n')
+
+	def toString(self):
+		"""Get the encoding as a single string."""
+		buf = io.StringIO()
+		self.writeToStream(buf)
+		return buf.getvalue()
+
+	def writeTo(self, path):
+		"""Write the encoding to the given file, replacing its contents."""
+		with open(path, 'w') as smtFile:
+			self.writeToStream(smtFile)
+
+	def flush(self, path=None):
+		"""Write the encoding to a file, by default the one given at construction."""
+		if path is None:
+			path = self.path
+		if path is None:
+			raise RuntimeError('no path given to flush SMT encoding to')
+		self.writeTo(path)
+
+	def copy(self):
+		"""Get an independent copy of this context."""
+		context = EncodingContext(logic=self.logic, path=self.path, profiler=self.profiler)
+		context.declarations = list(self.declarations)
+		context.body = list(self.body)
+		context.numAssertions = self.numAssertions
+		context.names = self.names.fork()
+		return context
+
+	def fork(self):
+		"""Get an empty context for encoding additional constraints on top of this one.
+
+		The new context continues allocating names from where this one left off (see
+		`NameAllocator.fork`), so the two encodings can be given to the same solver,
+		e.g. one encoding of a scenario and one of the conditions for each frame of a
+		dataset, sent inside a `push`/`pop` pair (see :mod:`scenic.core.solvers`).
+		"""
+		context = EncodingContext(logic=self.logic, profiler=self.profiler)
+		context.names = self.names.fork()
+		return context
+
+	def subcontext(self):
+		"""Get an empty context sharing the names (and profiler) of this one.
+
+		Used to collect the assertions made by an encoder, e.g. to combine them into
+		a disjunction, before merging them back into this context.
+		"""
+		context = EncodingContext(logic=None, profiler=self.profiler)
+		context.names = self.names
+		return context
+
+	def clear(self):
+		"""Discard everything encoded so far, including the names allocated."""
+		self.declarations.clear()
+		self.body.clear()
+		self.numAssertions = 0
+		self.names.reset()
+
+	def __str__(self):
+		return self.toString()
+
+	def __repr__(self):
+		return (f'<EncodingContext with {len(self.declarations)} declarations '
+		        f'and {self.numAssertions} assertions>')
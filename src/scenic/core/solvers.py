@@ -0,0 +1,374 @@
+"""Persistent sessions with SMT solvers, for checking encodings of scenarios.
+
+Rather than writing each encoding to a file and starting a fresh solver on it, a
+`SMTSolver` keeps one solver session open. Constraints shared by many queries (e.g.
+the encoding of the scenario itself) are loaded once, and each query only adds its
+own constraints inside a `push`/`pop` pair::
+
+	solver = defaultSolver()
+	solver.load(scenarioContext)
+	for frame in frames:
+		context = scenarioContext.fork()
+		...		# encode the conditions for this frame into context
+		with solver.frame():
+			solver.load(context)
+			if solver.check() == 'sat':
+				print(solver.model())
+
+Two backends are provided: `Z3Solver`, using the Python bindings of Z3, and
+`SubprocessSolver`, which talks SMT-LIB to any solver run as a subprocess.
+"""
+
+import contextlib
+import fractions
+import re
+import shutil
+import subprocess
+
+from scenic.core.smt import Term, parseDeclaration, toSMTLIB
+
+class SolverError(RuntimeError):
+	"""Raised when a solver reports an error or cannot be started."""
+	pass
+
+# Commands which control the solver session rather than add constraints
+_sessionCommands = ('(set-logic', '(check-sat', '(get-model', '(get-value', '(exit',
+                    '(push', '(pop', '(reset')
+
+class SMTSolver:
+	"""Abstract persistent solver session.
+
+	Keeps track of the constants declared at each level of the assertion stack, so
+	that loading an encoding whose declarations were already made (e.g. by a parent
+	context) does not declare them twice.
+	"""
+	def __init__(self):
+		self._scopes = [{}]		# name -> sort, for each level of the stack
+
+	## Interface for subclasses
+
+	def _declare(self, name, sort):
+		raise NotImplementedError
+
+	def _assert(self, command):
+		"""Add an assertion, given as an SMT-LIB ``assert`` command."""
+		raise NotImplementedError
+
+	def _command(self, command):
+		"""Send any other SMT-LIB command (e.g. ``set-option``)."""
+		raise NotImplementedError
+
+	def _push(self):
+		raise NotImplementedError
+
+	def _pop(self):
+		raise NotImplementedError
+
+	def check(self):
+		"""Check satisfiability, returning ``'sat'``, ``'unsat'``, or ``'unknown'``."""
+		raise NotImplementedError
+
+	def model(self, names=None):
+		"""Get the values of declared constants in a model found by `check`.
+
+		By default all declared constants are included. Rational values are converted
+		to floats, and Booleans to bools; other values are given in SMT-LIB syntax.
+		"""
+		raise NotImplementedError
+
+	def close(self):
+		"""End the session."""
+		pass
+
+	## Public API
+
+	def declare(self, name, sort='Real'):
+		"""Declare a constant, unless it is already declared."""
+		if self.isDeclared(name):
+			return
+		self._declare(name, sort)
+		self._scopes[-1][name] = sort
+
+	def isDeclared(self, name):
+		return any(name in scope for scope in self._scopes)
+
+	@property
+	def declaredNames(self):
+		"""The names of all constants currently declared, in order of declaration."""
+		return [name for scope in self._scopes for name in scope]
+
+	def addAssertion(self, term):
+		"""Assert an SMT-LIB term (without the enclosing ``assert``)."""
+		if isinstance(term, Term):
+			self._assert(toSMTLIB(Term('assert', term)))
+		else:
+			self._assert(f'(assert {term})')
+
+	def write(self, command):
+		"""Send an SMT-LIB command, as stored in an `EncodingContext`.
+
+		Session commands like ``check-sat`` and ``set-logic`` are ignored, since the
+		session is controlled through the methods of this class instead.
+		"""
+		if isinstance(command, Term):
+			self._assert(toSMTLIB(command))
+			return
+		command = command.strip()
+		if not command or command.startswith(';'):
+			return
+		constant = parseDeclaration(command)
+		if constant is not None:
+			self.declare(*constant)
+		elif command.startswith('(assert'):
+			self._assert(command)
+		elif not command.startswith(_sessionCommands):
+			self._command(command)
+
+	def load(self, context):
+		"""Add all the declarations and assertions of an `EncodingContext`."""
+		for declaration in context.declarations:
+			self.write(declaration)
+		for command in context.body:
+			self.write(command)
+
+	def push(self):
+		"""Push a new level onto the assertion stack."""
+		self._push()
+		self._scopes.append({})
+
+	def pop(self, levels=1):
+		"""Pop levels off the assertion stack, undoing their assertions and declarations."""
+		if levels >= len(self._scopes):
+			raise SolverError('tried to pop more levels than were pushed')
+		for i in range(levels):
+			self._pop()
+			self._scopes.pop()
+
+	@contextlib.contextmanager
+	def frame(self):
+		"""Context manager running its body inside a `push`/`pop` pair."""
+		self.push()
+		try:
+			yield self
+		finally:
+			self.pop()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+## Z3 Python bindings
+
+class Z3Solver(SMTSolver):
+	"""Solver session using the Z3 Python bindings (the ``z3-solver`` package).
+
+	Args:
+		logic (str): SMT-LIB logic to use, or :obj:`None` to let Z3 choose.
+	"""
+	def __init__(self, logic=None):
+		super().__init__()
+		try:
+			import z3
+		except ModuleNotFoundError as e:
+			raise RuntimeError('the Z3 solver backend requires the z3 module;'
+			                   ' try "pip install z3-solver"') from e
+		self._z3 = z3
+		self._solver = z3.SolverFor(logic) if logic else z3.Solver()
+		self._constants = {}
+
+	def _declare(self, name, sort):
+		sorts = { 'Real': self._z3.RealSort, 'Int': self._z3.IntSort,
+		          'Bool': self._z3.BoolSort }
+		if sort not in sorts:
+			raise SolverError(f'unsupported sort {sort} for {name}')
+		self._constants[name] = self._z3.Const(name, sorts[sort]())
+
+	def _assert(self, command):
+		try:
+			assertions = self._z3.parse_smt2_string(command, decls=self._constants)
+		except self._z3.Z3Exception as e:
+			raise SolverError(f'Z3 could not parse {command!r}: {e}') from None
+		self._solver.add(assertions)
+
+	def _command(self, command):
+		raise SolverError(f'unsupported command for Z3 backend: {command}')
+
+	def _push(self):
+		self._solver.push()
+
+	def _pop(self):
+		self._solver.pop()
+		for name in self._scopes[-1]:
+			del self._constants[name]
+
+	def check(self):
+		return str(self._solver.check())
+
+	def model(self, names=None):
+		z3 = self._z3
+		model = self._solver.model()
+		values = {}
+		for name in (self.declaredNames if names is None else names):
+			value = model.eval(self._constants[name], model_completion=True)
+			if z3.is_rational_value(value):
+				value = float(value.as_fraction())
+			elif z3.is_algebraic_value(value):
+				value = float(value.approx(20).as_fraction())
+			elif z3.is_true(value) or z3.is_false(value):
+				value = z3.is_true(value)
+			else:
+				value = value.sexpr()
+			values[name] = value
+		return values
+
+## Solvers run as subprocesses
+
+def _parseSExpression(text):
+	"""Parse an S-expression into nested lists of atoms."""
+	stack = [[]]
+	for token in re.findall(r'\(|\)|"[^"]*"|[^\s()]+', text):
+		if token == '(':
+			stack.append([])
+		elif token == ')':
+			items = stack.pop()
+			stack[-1].append(items)
+		else:
+			stack[-1].append(token)
+	return stack[0]
+
+def _valueOf(sexpr):
+	"""Convert an SMT-LIB value to a Python number or bool, if possible."""
+	if isinstance(sexpr, str):
+		if sexpr in ('true', 'false'):
+			return sexpr == 'true'
+		try:
+			return fractions.Fraction(sexpr)
+		except ValueError:
+			return None
+	if len(sexpr) == 2 and sexpr[0] == '-':
+		value = _valueOf(sexpr[1])
+		return None if value is None else -value
+	if len(sexpr) == 3 and sexpr[0] == '/':
+		num, den = _valueOf(sexpr[1]), _valueOf(sexpr[2])
+		return None if num is None or den is None else num / den
+	return None
+
+def _unparse(sexpr):
+	if isinstance(sexpr, str):
+		return sexpr
+	return '(' + ' '.join(_unparse(item) for item in sexpr) + ')'
+
+_endMarker = 'scenic-end-of-response'
+
+class SubprocessSolver(SMTSolver):
+	"""Solver session with an SMT-LIB solver running as a subprocess.
+
+	Commands are written to the standard input of the solver as they are issued,
+	and responses read back from its standard output.
+
+	Args:
+		command (list): command line starting the solver in interactive mode,
+		  reading SMT-LIB from standard input.
+		logic (str): SMT-LIB logic to use, or :obj:`None` for the solver default.
+	"""
+	def __init__(self, command=('z3', '-in'), logic=None):
+		super().__init__()
+		try:
+			self._process = subprocess.Popen(command, stdin=subprocess.PIPE,
+			                                 stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+			                                 universal_newlines=True, bufsize=1)
+		except OSError as e:
+			raise SolverError(f'could not start solver {command[0]}: {e}') from e
+		self._send('(set-option :print-success false)')
+		if logic is not None:
+			self._send(f'(set-logic {logic})')
+
+	def _send(self, command):
+		try:
+			self._process.stdin.write(command + '\n')
+			self._process.stdin.flush()
+		except (BrokenPipeError, ValueError) as e:
+			raise SolverError('solver process has exited') from e
+
+	def _query(self, command):
+		"""Send a command and read its response.
+
+		The response is delimited by echoing a marker afterward, so that errors from
+		earlier commands (which solvers report asynchronously) or from the command
+		itself cannot leave the session out of sync.
+		"""
+		self._send(command)
+		self._send(f'(echo "{_endMarker}")')
+		lines = []
+		while True:
+			line = self._process.stdout.readline()
+			if not line:
+				raise SolverError('solver process exited unexpectedly: ' + ''.join(lines))
+			if line.strip().strip('"') == _endMarker:
+				break
+			lines.append(line)
+		response = ''.join(lines).strip()
+		errors = [line.strip() for line in lines if line.startswith('(error')]
+		if errors:
+			raise SolverError('solver reported errors: ' + ' '.join(errors))
+		return response
+
+	def _declare(self, name, sort):
+		self._send(f'(declare-fun {name} () {sort})')
+
+	def _assert(self, command):
+		self._send(command)
+
+	def _command(self, command):
+		self._send(command)
+
+	def _push(self):
+		self._send('(push 1)')
+
+	def _pop(self):
+		self._send('(pop 1)')
+
+	def check(self):
+		return self._query('(check-sat)')
+
+	def model(self, names=None):
+		names = self.declaredNames if names is None else list(names)
+		if not names:
+			return {}
+		response = _parseSExpression(self._query(f'(get-value ({" ".join(names)}))'))
+		values = {}
+		for name, value in response[0]:
+			number = _valueOf(value)
+			if isinstance(number, fractions.Fraction):
+				number = float(number)
+			values[name] = _unparse(value) if number is None else number
+		return values
+
+	def close(self):
+		if self._process.poll() is None:
+			try:
+				self._send('(exit)')
+			except SolverError:
+				pass
+			try:
+				self._process.wait(timeout=5)
+			except subprocess.TimeoutExpired:
+				self._process.kill()
+		self._process.stdin.close()
+		self._process.stdout.close()
+
+def defaultSolver(logic=None):
+	"""Start a session with the best available solver.
+
+	Uses the Z3 Python bindings if they are installed, and otherwise a ``z3``
+	executable on the PATH.
+	"""
+	try:
+		return Z3Solver(logic=logic)
+	except RuntimeError:
+		pass
+	if shutil.which('z3') is None:
+		raise SolverError('no SMT solver found; try "pip install z3-solver"')
+	return SubprocessSolver(logic=logic)
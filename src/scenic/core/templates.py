@@ -0,0 +1,285 @@
+"""Parametric SMT encodings, compiled once and reused across many queries.
+
+Querying a dataset for frames matching a scenario used to mean conditioning the
+scenario on each frame and encoding it from scratch, although only the pose of the
+ego and the labelled positions of the objects change from frame to frame. Instead,
+`compileScenarioTemplate` encodes the scenario once, as an `EncodingTemplate` in
+which those values are free parameters; each frame then only binds the parameters::
+
+	sector = ParametricSectorRegion(50, math.radians(140), workspace=workspace)
+	template = compileScenarioTemplate(scenario, sector)
+	solver = defaultSolver()
+	template.load(solver)
+	for egoPose, labels in frames:
+		result, model = template.check(solver, template.values(egoPose, labels))
+
+Only the bindings of the parameters are sent to the solver for each frame, so the
+cost per frame depends on the number of labels rather than the size of the encoding.
+Frames which clearly cannot match, e.g. because a label is out of view of the ego,
+can be skipped without calling the solver at all by first checking
+``template.feasible(egoPose, labels)``.
+"""
+
+import math
+
+from scenic.core.distributions import (needsSampling, supportInterval,
+                                       findVariableName, writeSMTtoFile,
+                                       smt_add, smt_subtract, smt_multiply, smt_and, smt_or,
+                                       smt_lessThan, smt_lessThanEq, smt_assert)
+from scenic.core.regions import Region, toPolygon
+from scenic.core.smt import EncodingContext, EncodingCache, Term, numeral
+from scenic.core.vectors import Vector, supportBox, boxContains, unboundedBox
+
+class EncodingTemplate:
+	"""An SMT encoding with free parameters, to be bound for each query.
+
+	Args:
+		context (`EncodingContext`): the encoding, in which the parameters are declared.
+		parameters (list): names of the parameters.
+	"""
+	def __init__(self, context, parameters):
+		self.context = context
+		self.parameters = tuple(parameters)
+
+	def bindings(self, values):
+		"""Terms binding the parameters to the values given as a dictionary."""
+		missing = [name for name in self.parameters if name not in values]
+		if missing:
+			raise RuntimeError(f'no values given for template parameters {missing}')
+		return [Term('=', name, numeral(float(values[name]))) for name in self.parameters]
+
+	def instantiate(self, values):
+		"""Get a standalone encoding with the parameters replaced by the given values.
+
+		The result is simplified (see `EncodingContext.simplify`), so constants are
+		folded and the encoding is often linear; this is useful for writing out a file
+		or for solvers without incremental solving.
+		"""
+		self.bindings(values)		# check all parameters have values
+		bindings = { name: values[name] for name in self.parameters }
+		return self.context.copy().simplify(bindings=bindings)
+
+	def load(self, solver):
+		"""Load the template into a solver session (see `scenic.core.solvers`)."""
+		solver.load(self.context)
+
+	def check(self, solver, values, context=None):
+		"""Check the template for the given parameter values, in a solver session.
+
+		The template must have been loaded into the solver with `load`: only the
+		bindings of the parameters (and the additional encoding **context**, if any)
+		are sent, inside a `push`/`pop` pair. Returns the result of the check and the
+		model found, if any.
+		"""
+		with solver.frame():
+			for binding in self.bindings(values):
+				solver.addAssertion(binding)
+			if context is not None:
+				solver.load(context)
+			result = solver.check()
+			model = solver.model() if result == 'sat' else None
+		return result, model
+
+	def __repr__(self):
+		return f'<{type(self).__name__} with {len(self.parameters)} parameters>'
+
+class ParametricSectorRegion(Region):
+	"""The visible region of an ego whose pose is a parameter of the encoding.
+
+	Used in place of the `SectorRegion` in ``cached_variables['ego_visibleRegion']``:
+	its encoding is the same, except that the position of the ego and the offsets
+	from it to the ends of the edges of the sector are the parameters listed in
+	``parameters``, computed from the pose by `parameterValues`. Since the actual
+	sector is not known in advance, regions are pruned against **workspace** instead,
+	which should contain the visible regions of all poses of interest (if it is
+	:obj:`None`, nothing is pruned).
+	"""
+	parameters = ('ego_x', 'ego_y', 'ego_lx', 'ego_ly', 'ego_rx', 'ego_ry')
+
+	def __init__(self, radius, angle, workspace=None, name=None):
+		super().__init__(name)
+		self.radius = radius
+		self.angle = angle
+		self.center = Vector('ego_x', 'ego_y')
+		self.polygon = toPolygon(workspace) if isinstance(workspace, Region) else workspace
+
+	def parameterValues(self, x, y, heading):
+		"""Values of the parameters for an ego at (x, y) with the given heading."""
+		left, right = heading + self.angle / 2, heading - self.angle / 2
+		r = self.radius
+		return { 'ego_x': x, 'ego_y': y,
+		         'ego_lx': -r * math.sin(left), 'ego_ly': r * math.cos(left),
+		         'ego_rx': -r * math.sin(right), 'ego_ry': r * math.cos(right) }
+
+	def headingAxes(self):
+		"""Terms giving the cosine and sine of the heading of the ego.
+
+		They are linear in the parameters, recovered from the offsets to the ends of the
+		edges of the sector (see `parameterValues`).
+		"""
+		half = self.angle / 2
+		if abs(math.sin(half)) >= abs(math.cos(half)):
+			scale = numeral(1 / (2 * self.radius * math.sin(half)))
+			c = smt_multiply(scale, smt_subtract('ego_rx', 'ego_lx'))
+			s = smt_multiply(scale, smt_subtract('ego_ry', 'ego_ly'))
+		else:
+			scale = numeral(1 / (2 * self.radius * math.cos(half)))
+			c = smt_multiply(scale, smt_add('ego_ly', 'ego_ry'))
+			s = smt_multiply(Term('-', scale), smt_add('ego_lx', 'ego_rx'))
+		return c, s
+
+	def encodeToSMT(self, smt_file_path, cached_variables, debug=False):
+		if debug:
+			writeSMTtoFile(smt_file_path, "ParametricSectorRegion")
+		# not cached, since the constraints are on the current object, which changes
+		(x, y) = cached_variables['current_obj']
+		dx, dy = smt_subtract(x, 'ego_x'), smt_subtract(y, 'ego_y')
+
+		square_distance = smt_add(smt_multiply(dx, dx), smt_multiply(dy, dy))
+		constraint = smt_lessThanEq(square_distance, str(self.radius * self.radius))
+		if self.angle < math.tau - 0.001:
+			# right of the left edge and left of the right edge, as in SectorRegion
+			right_of_left = smt_lessThanEq(
+				smt_subtract(smt_multiply('ego_lx', dy), smt_multiply('ego_ly', dx)), '0')
+			left_of_right = smt_lessThanEq('0',
+				smt_subtract(smt_multiply('ego_rx', dy), smt_multiply('ego_ry', dx)))
+			if self.angle <= math.pi:
+				edges = smt_and(right_of_left, left_of_right)
+			else:
+				edges = smt_or(right_of_left, left_of_right)
+			constraint = smt_and(constraint, edges)
+		writeSMTtoFile(smt_file_path, smt_assert(None, constraint))
+		return (x, y)
+
+	def __repr__(self):
+		return f'ParametricSectorRegion({self.radius}, {self.angle})'
+
+class ScenarioTemplate(EncodingTemplate):
+	"""Parametric encoding of a scenario, as produced by `compileScenarioTemplate`.
+
+	Attributes:
+		sector (`ParametricSectorRegion`): the visible region of the ego.
+		labels (list): for each non-ego object, the names of the parameters giving
+		  its labelled position.
+		bounds (list): for each non-ego object, a bounding box on its position (see
+		  `supportBox`) and the maximum distance from the ego at which it is visible,
+		  or :obj:`None` if it need not be visible.
+		tolerance (float): maximum distance along each axis between an object and
+		  its label.
+	"""
+	def __init__(self, context, sector, labels, bounds=None, tolerance=0):
+		params = list(sector.parameters)
+		for label in labels:
+			params.extend(label)
+		super().__init__(context, params)
+		self.sector = sector
+		self.labels = tuple(labels)
+		if bounds is None:
+			bounds = [(unboundedBox, None)] * len(labels)
+		self.bounds = tuple(bounds)
+		self.tolerance = tolerance
+
+	def feasible(self, egoPose, labels):
+		"""Cheaply check whether the labels of a frame could match the scenario.
+
+		This only uses interval bounds on the positions of the objects, and on their
+		distance from the ego if they are required to be visible, so it does not
+		call the solver. If it returns :obj:`False` the frame cannot match the
+		scenario; if it returns :obj:`True` the frame may still not match. The heading
+		of the ego is not checked, since the template does not constrain it either.
+		"""
+		if len(labels) != len(self.labels):
+			raise RuntimeError(f'expected {len(self.labels)} labels, got {len(labels)}')
+		x, y = egoPose[0], egoPose[1]
+		slack = self.tolerance * math.sqrt(2)
+		for (lx, ly), (box, reach) in zip(labels, self.bounds):
+			if not boxContains(box, (lx, ly), self.tolerance):
+				return False
+			if reach is not None and math.hypot(lx - x, ly - y) > reach + slack:
+				return False
+		return True
+
+	def values(self, egoPose, labels):
+		"""Parameter values for an ego pose (x, y, heading) and labelled positions.
+
+		The labels are (x, y) pairs, one for each non-ego object of the scenario.
+		"""
+		if len(labels) != len(self.labels):
+			raise RuntimeError(f'expected {len(self.labels)} labels, got {len(labels)}')
+		values = self.sector.parameterValues(*egoPose)
+		for (xName, yName), (x, y) in zip(self.labels, labels):
+			values[xName] = x
+			values[yName] = y
+		return values
+
+def compileScenarioTemplate(scenario, sector, conditions=(), network=None,
+                            tolerance=0.01, logic='QF_NRA', builtinRequirements=True):
+	"""Encode a scenario once, with the ego pose and object labels as parameters.
+
+	This performs the same encoding as a query for a single frame, but with the
+	ego's position conditioned to the parameters of **sector**, which is also used
+	as the visible region. The position of each non-ego object is then encoded and
+	required to be within **tolerance** of its label, given by further parameters.
+	Bounds on the positions of the objects are also computed, for use by
+	`ScenarioTemplate.feasible`.
+
+	Args:
+		scenario (`Scenario`): the scenario to encode.
+		sector (`ParametricSectorRegion`): the visible region of the ego.
+		conditions: pairs (samplable, value) of additional conditions to apply
+		  during encoding (e.g. replacing a visible region used by the scenario by
+		  **sector**); they are undone afterward, as is the conditioning of the ego.
+		network (`Network`): road network, if the scenario uses one.
+		tolerance (float): maximum distance along each axis between an object and
+		  its label.
+		logic (str): SMT-LIB logic of the encoding.
+		builtinRequirements (bool): whether to also encode the built-in containment
+		  and non-intersection requirements of the non-ego objects (see
+		  `Scenario.encodeBuiltinRequirements`); the ego is placed at the pose given by
+		  the parameters of **sector**.
+	"""
+	context = EncodingContext(logic=logic)
+	for name in sector.parameters:
+		context.declare(name)
+	cache = EncodingCache(ego=sector.center, ego_visibleRegion=sector,
+	                      ego_view_radius=sector.radius,
+	                      ego_viewAngle=math.degrees(sector.angle),
+	                      ego_sector_polygon=sector.polygon)
+	if network is not None:
+		cache['network'] = network
+
+	ego = scenario.egoObject
+	conditions = list(conditions)
+	if needsSampling(ego.position):
+		conditions.append((ego.position, sector.center))
+	with scenario.conditioned(conditions):
+		labels, bounds, positions = [], [], []
+		for obj in scenario.objects:
+			if obj is ego:
+				continue
+			x = findVariableName(cache, context, cache['variables'], 'x')
+			y = findVariableName(cache, context, cache['variables'], 'y')
+			cache['current_obj'] = (x, y)
+			point = obj.position.encodeToSMT(context, cache)
+
+			label = (f'label{len(labels)+1}_x', f'label{len(labels)+1}_y')
+			for name in label:
+				context.declare(name)
+			close = [smt_lessThan(Term('abs', smt_subtract(coord, name)), str(tolerance))
+			         for coord, name in zip(point, label)]
+			writeSMTtoFile(context, smt_assert('and', *close))
+			labels.append(label)
+			bounds.append((supportBox(obj.position), _visibleDistance(obj, sector)))
+			positions.append((obj, point))
+		if builtinRequirements:
+			egoPose = (tuple(sector.center), sector.headingAxes())
+			scenario.encodeBuiltinRequirements(context, cache, positions, ego=egoPose)
+
+	return ScenarioTemplate(context, sector, labels, bounds, tolerance)
+
+def _visibleDistance(obj, sector):
+	"""Maximum distance from the ego at which an object can be visible, if required."""
+	if obj.requireVisible is not True:
+		return None
+	_, radius = supportInterval(obj.radius)
+	return None if radius is None else sector.radius + radius
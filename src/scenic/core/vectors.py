@@ -12,10 +12,13 @@ import shapely.geometry
 import wrapt
 
 from scenic.core.distributions import (Samplable, Distribution, MethodDistribution,
-    needsSampling, makeOperatorHandler, distributionMethod, distributionFunction,
+    needsSampling, supportInterval, makeOperatorHandler, distributionMethod, distributionFunction,
 	RejectionException, smt_add, smt_subtract, smt_multiply, smt_divide, smt_and, 
 	smt_equal, smt_mod, smt_assert, findVariableName,isNotConditioned,
-	checkAndEncodeSMT, writeSMTtoFile, cacheVarName, smt_lessThan, smt_lessThanEq, smt_ite, normalizeAngle_SMT, vector_operation_smt)
+	checkAndEncodeSMT, writeSMTtoFile, cacheVarName, smt_lessThan, smt_lessThanEq, smt_ite, normalizeAngle_SMT, vector_operation_smt,
+	smt_cos, smt_sin)
+from scenic.core.smt import isTerm
+from scenic.core.profiling import profiledEncoding
 from scenic.core.lazy_eval import valueInContext, needsLazyEvaluation, makeDelayedFunctionCall
 import scenic.core.utils as utils
 from scenic.core.geometry import normalizeAngle
@@ -27,6 +30,10 @@ class VectorDistribution(Distribution):
 	def toVector(self):
 		return self
 
+	def supportBox(self):
+		"""Compute a bounding box on the value of this distribution (see `supportBox`)."""
+		return unboundedBox
+
 class CustomVectorDistribution(VectorDistribution):
 	"""Distribution with a custom sampler given by an arbitrary function."""
 	def __init__(self, sampler, *dependencies, name='CustomVectorDistribution', evaluator=None):
@@ -96,6 +103,11 @@ class VectorOperatorDistribution(VectorDistribution):
 		operands = tuple(valueInContext(arg, context) for arg in self.operands)
 		return VectorOperatorDistribution(self.operator, obj, operands)
 
+	def supportBox(self):
+		if len(self.operands) != 1:
+			return unboundedBox
+		return _offsetBox(self.operator, self.object, self.operands[0])
+
 	def __str__(self):
 		ops = utils.argsToString(self.operands)
 		return f'{self.object}.{self.operator}{ops}'
@@ -131,6 +143,11 @@ class VectorMethodDistribution(VectorDistribution):
 		kwargs = { name: valueInContext(arg, context) for name, arg in self.kwargs.items() }
 		return VectorMethodDistribution(self.method, obj, arguments, kwargs)
 
+	def supportBox(self):
+		if len(self.arguments) != 1 or self.kwargs:
+			return unboundedBox
+		return _offsetBox(self.method.__name__, self.object, self.arguments[0])
+
 	def __str__(self):
 		args = utils.argsToString(itertools.chain(self.arguments, self.kwargs.values()))
 		return f'{self.object}.{self.method.__name__}{args}'
@@ -188,6 +205,61 @@ def vectorDistributionMethod(method):
 		return helper(*args, **kwargs)
 	return wrapper(method)
 
+unboundedBox = ((None, None), (None, None))
+
+def supportBox(thing):
+	"""Axis-aligned bounding box ((xmin, ymin), (xmax, ymax)) on this vector, if known.
+
+	The vector analogue of `supportInterval`: any bound which is not known is
+	:obj:`None`. If the vector has been conditioned, the box bounds the conditioned
+	value.
+	"""
+	from scenic.core.distributions import MultiplexerDistribution
+	conditioned = getattr(thing, '_conditioned', thing)
+	if conditioned is not thing and isinstance(conditioned, Samplable):
+		return supportBox(conditioned)
+	if isinstance(thing, VectorDistribution):
+		return thing.supportBox()
+	elif isinstance(thing, MultiplexerDistribution):
+		boxes = [supportBox(opt) for opt in thing.options]
+		def extreme(bounds, pick):
+			return None if any(b is None for b in bounds) else pick(bounds)
+		return ((extreme([box[0][0] for box in boxes], min),
+		         extreme([box[0][1] for box in boxes], min)),
+		        (extreme([box[1][0] for box in boxes], max),
+		         extreme([box[1][1] for box in boxes], max)))
+	elif isinstance(thing, (Vector, tuple, list)) and len(thing) == 2:
+		(xl, xh), (yl, yh) = supportInterval(thing[0]), supportInterval(thing[1])
+		return ((xl, yl), (xh, yh))
+	return unboundedBox
+
+def _offsetBox(operator, first, second):
+	"""Bounding box on a sum or difference of vectors, as given by an operator name."""
+	if operator not in ('__add__', '__radd__', '__sub__', '__rsub__'):
+		return unboundedBox
+	(xl1, yl1), (xh1, yh1) = supportBox(first)
+	(xl2, yl2), (xh2, yh2) = supportBox(second)
+	def bound(a, b, sign):
+		return None if a is None or b is None else a + sign * b
+	if operator in ('__add__', '__radd__'):
+		return ((bound(xl1, xl2, 1), bound(yl1, yl2, 1)),
+		        (bound(xh1, xh2, 1), bound(yh1, yh2, 1)))
+	elif operator == '__sub__':
+		return ((bound(xl1, xh2, -1), bound(yl1, yh2, -1)),
+		        (bound(xh1, xl2, -1), bound(yh1, yl2, -1)))
+	else:
+		return ((bound(xl2, xh1, -1), bound(yl2, yh1, -1)),
+		        (bound(xh2, xl1, -1), bound(yh2, yl1, -1)))
+
+def boxContains(box, point, tolerance=0):
+	"""Whether a point lies in a box as given by `supportBox`, up to a tolerance."""
+	for low, high, coord in zip(box[0], box[1], point):
+		if low is not None and coord < low - tolerance:
+			return False
+		if high is not None and coord > high + tolerance:
+			return False
+	return True
+
 class Vector(Samplable, collections.abc.Sequence):
 	"""A 2D vector, whose coordinates can be distributions."""
 	def __init__(self, x, y):
@@ -217,13 +289,13 @@ class Vector(Samplable, collections.abc.Sequence):
 
 		angle = checkAndEncodeSMT(smt_file_path, cached_variables, angle)
 
-		if not isinstance(x, str):
+		if not isTerm(x):
 			x = checkAndEncodeSMT(smt_file_path, cached_variables, x)
-		if not isinstance(y, str):
+		if not isTerm(y):
 			y = checkAndEncodeSMT(smt_file_path, cached_variables, y)
 
-		cos = "(cos "+angle+")"
-		sin = "(sin "+angle+")"
+		cos = smt_cos(angle)
+		sin = smt_sin(angle)
 
 		cos_mul_x = smt_multiply(cos, x)
 		sin_mul_y = smt_multiply(sin, y)
@@ -249,11 +321,11 @@ class Vector(Samplable, collections.abc.Sequence):
 		x_smt_var = offset_smt[0]
 		y_smt_var = offset_smt[1]
 
-		if not isinstance(self.x, str):
+		if not isTerm(self.x):
 			self_x = checkAndEncodeSMT(smt_file_path, cached_variables, self.x)
 		else: 
 			self_x = self.x
-		if not isinstance(self.y, str):
+		if not isTerm(self.y):
 			self_y = checkAndEncodeSMT(smt_file_path, cached_variables, self.y)
 		else:
 			self_y = self.y
@@ -392,7 +464,7 @@ class Vector(Samplable, collections.abc.Sequence):
 				square_y = smt_multiply(vec_y, vec_y) 
 				summation = smt_add(square_x, square_y)
 				norm_var = findVariableName(cached_variables, smt_file_path, cached_variables['variables'], 'vec_norm')
-				sq_norm_var = "(* "+norm_var+" "+norm_var+")"
+				sq_norm_var = smt_multiply(norm_var, norm_var)
 				norm_smt_encoding = smt_assert("equal", sq_norm_var, summation)
 				x = smt_divide(vec_x, norm_var)
 				y = smt_divide(vec_y, norm_var)
@@ -695,6 +767,7 @@ class VectorField:
 	def conditionforSMT(self, condition, conditioned_bool):
 		raise NotImplementedError
 
+	@profiledEncoding
 	def encodeToSMT(self, smt_file_path, cached_variables, obj, debug=False):
 		if debug:
 			writeSMTtoFile(smt_file_path, "VectorField")
@@ -32,6 +32,7 @@ from shapely.geometry import Polygon, MultiPolygon
 from scenic.core.distributions import distributionFunction, distributionMethod, MethodDistribution, writeSMTtoFile, Samplable
 from scenic.core.vectors import Vector, VectorField
 from scenic.core.regions import PolygonalRegion, PolylineRegion
+from scenic.core.profiling import profiledEncoding
 from scenic.core.object_types import Point
 import scenic.core.geometry as geometry
 import scenic.core.utils as utils
@@ -1031,6 +1032,7 @@ class Network:
         """Get the `Lane` passing through a given point."""
         return self.findPointIn(point, self.lanes, reject)
 
+    @profiledEncoding
     def encodeToSMT(self, smt_file_path, cached_variables, obj=None, debug=False):
         if debug:
             writeSMTtoFile(smt_file_path, "Network Class")
@@ -0,0 +1,199 @@
+'''
+Columnar store of the labels of nuScenes frames.
+
+Extracting the labels of a frame with NuscQueryAPI.get_img_data is expensive, but
+queries usually first discard most frames using simple predicates on the labels, such
+as the number of vehicles or the time of day. A LabelStore holds the labels of every
+frame in a directory of NumPy arrays, extracted once; later runs memory-map the arrays
+and evaluate such predicates for all frames at once:
+
+	store = LabelStore.extract(query, 'labels/boston')	# once
+	store = LabelStore.open('labels/boston')
+	mask = (store.num_vehicles >= NUM_CAR) & store.time_between('06:00', '18:00')
+	for img_filename in store.select(mask):
+		label = query.get_img_data(img_filename)
+		...
+'''
+
+import json
+import os
+
+import numpy as np
+from shapely.geometry import Polygon
+
+class LabelStore:
+	'''
+	Labels of a set of frames, stored column by column.
+
+	Per-frame columns (indexed by frame) are filenames, location and description codes,
+	local time in minutes since midnight, ego position and heading, and offsets into the
+	per-vehicle columns, which hold the positions, headings, and 2D boxes of all vehicles
+	of all frames (those of frame i being vehicle_offsets[i]:vehicle_offsets[i+1]).
+	'''
+
+	FORMAT_VERSION = 1
+	FRAME_COLUMNS = ('filename', 'location_code', 'description_code', 'time_minutes',
+	                 'ego_position', 'ego_heading', 'vehicle_offsets')
+	VEHICLE_COLUMNS = ('vehicle_position', 'vehicle_heading', 'vehicle_box')
+
+	def __init__(self, columns, locations, descriptions, path=None):
+		self.columns = columns
+		self.locations = list(locations)
+		self.descriptions = list(descriptions)
+		self.path = path
+		for name, column in columns.items():
+			setattr(self, name, column)
+
+	@classmethod
+	def extract(cls, query, path, img_filenames=None, progress=None):
+		'''
+		Extracts the labels of the given frames (by default, all those of the query API) and
+		saves them in the given directory. If given, progress is called as progress(done, total)
+		after each frame.
+		'''
+
+		if img_filenames is None:
+			img_filenames = sorted(query.get_img_filenames())
+		img_filenames = list(img_filenames)
+
+		locations, descriptions = {}, {}
+		frames = {name: [] for name in cls.FRAME_COLUMNS}
+		vehicles = {name: [] for name in cls.VEHICLE_COLUMNS}
+		vehicle_count = 0
+		for done, img_filename in enumerate(img_filenames, start=1):
+			label = query.get_img_data(img_filename)
+			location = query.get_location(img_filename)
+			hours, minutes = label['time'].split(':')
+
+			frames['filename'].append(img_filename)
+			frames['location_code'].append(locations.setdefault(location, len(locations)))
+			frames['description_code'].append(descriptions.setdefault(label['description'], len(descriptions)))
+			frames['time_minutes'].append(60 * int(hours) + int(minutes))
+			frames['ego_position'].append(label['EgoCar']['position'])
+			frames['ego_heading'].append(label['EgoCar']['heading'])
+			frames['vehicle_offsets'].append(vehicle_count)
+
+			for vehicle in label['Vehicles']:
+				vehicles['vehicle_position'].append(vehicle['position'])
+				vehicles['vehicle_heading'].append(vehicle['heading'])
+				vehicles['vehicle_box'].append(np.asarray(vehicle['box'].exterior.coords)[:4])
+			vehicle_count += len(label['Vehicles'])
+
+			if progress is not None:
+				progress(done, len(img_filenames))
+		frames['vehicle_offsets'].append(vehicle_count)
+
+		columns = {
+			'filename': np.array(frames['filename'], dtype=str),
+			'location_code': np.array(frames['location_code'], dtype=np.int16),
+			'description_code': np.array(frames['description_code'], dtype=np.int32),
+			'time_minutes': np.array(frames['time_minutes'], dtype=np.int16),
+			'ego_position': np.array(frames['ego_position'], dtype=float).reshape(-1, 2),
+			'ego_heading': np.array(frames['ego_heading'], dtype=float),
+			'vehicle_offsets': np.array(frames['vehicle_offsets'], dtype=np.int64),
+			'vehicle_position': np.array(vehicles['vehicle_position'], dtype=float).reshape(-1, 2),
+			'vehicle_heading': np.array(vehicles['vehicle_heading'], dtype=float),
+			'vehicle_box': np.array(vehicles['vehicle_box'], dtype=float).reshape(-1, 4, 2),
+		}
+		store = cls(columns, locations, descriptions, path)
+		store.save(path)
+		return store
+
+	def save(self, path):
+		os.makedirs(path, exist_ok=True)
+		for name, column in self.columns.items():
+			np.save(os.path.join(path, name + '.npy'), column)
+		metadata = {'version': self.FORMAT_VERSION, 'locations': self.locations,
+		            'descriptions': self.descriptions}
+		with open(os.path.join(path, 'metadata.json'), 'w') as f:
+			json.dump(metadata, f)
+		self.path = path
+
+	@classmethod
+	def open(cls, path, mmap=True):
+		'''
+		Opens a store saved by extract. Columns are memory-mapped unless mmap is False.
+		'''
+
+		with open(os.path.join(path, 'metadata.json')) as f:
+			metadata = json.load(f)
+		if metadata.get('version') != cls.FORMAT_VERSION:
+			raise ValueError(f'label store {path} has an unsupported format; extract it again')
+		mode = 'r' if mmap else None
+		columns = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode=mode)
+		           for name in cls.FRAME_COLUMNS + cls.VEHICLE_COLUMNS}
+		return cls(columns, metadata['locations'], metadata['descriptions'], path)
+
+	def __len__(self):
+		return len(self.filename)
+
+	## Predicates, giving a boolean mask over the frames
+
+	@property
+	def num_vehicles(self):
+		return np.diff(self.vehicle_offsets)
+
+	def at_location(self, *locations):
+		codes = [self.locations.index(loc) for loc in locations if loc in self.locations]
+		return np.isin(self.location_code, codes)
+
+	def time_between(self, start, end):
+		'''
+		Frames whose local time, given as 'HH:MM', lies in [start, end]; if end is before
+		start, the range wraps around midnight.
+		'''
+
+		start, end = _minutes(start), _minutes(end)
+		if start <= end:
+			return (self.time_minutes >= start) & (self.time_minutes <= end)
+		return (self.time_minutes >= start) | (self.time_minutes <= end)
+
+	def description_contains(self, text, case_sensitive=False):
+		if not case_sensitive:
+			text = text.lower()
+		matching = [i for i, description in enumerate(self.descriptions)
+		            if text in (description if case_sensitive else description.lower())]
+		return np.isin(self.description_code, matching)
+
+	def vehicles_within(self, distance):
+		'''
+		Number of vehicles of each frame within the given distance of the ego.
+		'''
+
+		frame_of_vehicle = np.repeat(np.arange(len(self)), self.num_vehicles)
+		offsets = self.vehicle_position - self.ego_position[frame_of_vehicle]
+		near = np.einsum('ij,ij->i', offsets, offsets) <= distance * distance
+		return np.bincount(frame_of_vehicle[near], minlength=len(self))
+
+	## Retrieving frames
+
+	def select(self, mask):
+		'''
+		Returns the list of filenames of the frames selected by a boolean mask.
+		'''
+
+		return self.filename[np.asarray(mask, dtype=bool)].tolist()
+
+	def label(self, index):
+		'''
+		Returns the labels of a frame in the format of NuscQueryAPI.get_img_data, except for
+		the map geometry and traffic flow function.
+		'''
+
+		start, end = self.vehicle_offsets[index], self.vehicle_offsets[index + 1]
+		vehicles = [{'heading': float(self.vehicle_heading[i]),
+		             'position': tuple(self.vehicle_position[i]),
+		             'box': Polygon(self.vehicle_box[i])} for i in range(start, end)]
+		minutes = int(self.time_minutes[index])
+		return {
+			'EgoCar': {'heading': float(self.ego_heading[index]),
+			           'position': tuple(self.ego_position[index])},
+			'Vehicles': vehicles,
+			'time': '{:02d}:{:02d}'.format(minutes // 60, minutes % 60),
+			'description': self.descriptions[self.description_code[index]],
+			'location': self.locations[self.location_code[index]],
+		}
+
+def _minutes(time):
+	hours, minutes = time.split(':')
+	return 60 * int(hours) + int(minutes)
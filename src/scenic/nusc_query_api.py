@@ -1,23 +1,366 @@
 from nuscenes.nuscenes import NuScenes
 from nuscenes.map_expansion.map_api import NuScenesMap
 from nuscenes.scripts.export_2d_annotations_as_json import post_process_coords
-from nuscenes.utils.geometry_utils import view_points
 
 from pyquaternion.quaternion import Quaternion
 import numpy as np
+from scipy.spatial import cKDTree
 
 import shapely
+import shapely.geometry
+import shapely.prepared
+import shapely.wkb
 from shapely.geometry import Point, Polygon, LineString, MultiLineString
-from shapely.ops import unary_union
+from shapely.ops import clip_by_rect, unary_union
 
 from datetime import datetime, timezone, timedelta
 
-from collections import defaultdict
+from collections import OrderedDict, defaultdict, deque
+from collections.abc import ItemsView, KeysView, ValuesView
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import hashlib
+import itertools
+import math
+import os
+import pickle
+import struct
+import tempfile
+import threading
+import time
 
 import scenic.domains.driving.roads as roads
 
-from scenic.core.regions import PolygonalRegion, PolylineRegion, regionFromShapelyObject
-from scenic.core.vectors import Vector
+from scenic.core.distributions import Samplable
+from scenic.core.geometry import SpatialIndex, pointsIntersecting
+from scenic.core.regions import toPolygon, everywhere
+from scenic.core.vectors import Vector, supportBox
+from scenic.nusc_label_store import LabelStore
+from scenic.syntax.veneer import verbosePrint
+
+def _rotation_matrices(quaternions):
+	'''
+	Converts quaternions, given as rows (w, x, y, z), to an array of rotation matrices.
+	'''
+
+	q = np.asarray(quaternions, dtype=float).reshape(-1, 4)
+	q = q / np.linalg.norm(q, axis=1, keepdims=True)
+	w, x, y, z = q.T
+	return np.stack((
+		np.stack((1 - 2*(y*y + z*z), 2*(x*y - w*z), 2*(x*z + w*y)), axis=1),
+		np.stack((2*(x*y + w*z), 1 - 2*(x*x + z*z), 2*(y*z - w*x)), axis=1),
+		np.stack((2*(x*z - w*y), 2*(y*z + w*x), 1 - 2*(x*x + y*y)), axis=1),
+	), axis=1)
+
+class _LazyDict(dict):
+	'''
+	Dictionary computing missing values on first access. Each value is computed only
+	once, even when several threads ask for it at the same time.
+
+	If keys are given, the dictionary behaves as if it held a value for each of them
+	from the start: membership tests, iteration, len and get do not depend on which
+	values have been computed yet, and other keys are missing.
+	'''
+
+	def __init__(self, factory, keys=None):
+		super().__init__()
+		self._factory = factory
+		self._keys = None if keys is None else tuple(dict.fromkeys(keys))
+		self._locks = defaultdict(threading.Lock)
+		self._locks_lock = threading.Lock()
+
+	def __missing__(self, key):
+		if self._keys is not None and key not in self._keys:
+			raise KeyError(key)
+		with self._locks_lock:
+			key_lock = self._locks[key]
+		with key_lock:
+			if dict.__contains__(self, key):
+				return dict.__getitem__(self, key)
+			value = self._factory(key)
+			self[key] = value
+			return value
+
+	def __contains__(self, key):
+		if self._keys is None:
+			return dict.__contains__(self, key)
+		return key in self._keys
+
+	def __iter__(self):
+		return dict.__iter__(self) if self._keys is None else iter(self._keys)
+
+	def __len__(self):
+		return dict.__len__(self) if self._keys is None else len(self._keys)
+
+	def get(self, key, default=None):
+		return self[key] if key in self else default
+
+	def keys(self):
+		return KeysView(self)
+
+	def values(self):
+		return ValuesView(self)
+
+	def items(self):
+		return ItemsView(self)
+
+class _TrafficFlowIndex:
+	'''
+	Index of the lanes of a map for looking up the direction of traffic at many points.
+
+	Lanes are stored in an STRtree together with their traffic flow headings, computed
+	once from their edge lines as in the original per-point lookup (pointing from the
+	midpoint of the incoming edge to that of the outgoing edge, minus pi/2 to match
+	Scenic's convention). Optionally, the headings can also be rasterized into a grid
+	for faster (but approximate) lookups.
+
+	Unlike NuScenesMap.get_closest_lane, which the original lookup fell back on, points
+	lying on no lane are assigned the lane whose polygon (not centerline) is nearest, and
+	lane connectors are not indexed: they have no edge lines to compute a heading from.
+	'''
+
+	def __init__(self, map_api):
+		self.tokens = [rec['token'] for rec in map_api.lane]
+		self.index = SpatialIndex(map_api.extract_polygon(rec['polygon_token']) for rec in map_api.lane)
+		self.bounds = np.array([poly.bounds for poly in self.index.geometries]).reshape(-1, 4)
+		self.headings = np.array([self._lane_heading(map_api, rec) for rec in map_api.lane])
+		self.grid = None
+
+	@staticmethod
+	def _lane_heading(map_api, lane_rec):
+		from_edge = map_api.get('line', lane_rec['from_edge_line_token'])
+		to_edge = map_api.get('line', lane_rec['to_edge_line_token'])
+
+		from_nodes = [map_api.get('node', t) for t in from_edge['node_tokens']]
+		from_nodes = [np.array([n['x'], n['y']]) for n in from_nodes]
+		to_nodes = [map_api.get('node', t) for t in to_edge['node_tokens']]
+		to_nodes = [np.array([n['x'], n['y']]) for n in to_nodes]
+
+		# Compute traffic flow vector using midpoints of edges
+		from_mid = (from_nodes[0] + from_nodes[1]) / 2
+		to_mid = (to_nodes[0] + to_nodes[1]) / 2
+		traffic_flow_vec = to_mid - from_mid
+
+		heading = np.arctan2(traffic_flow_vec[1], traffic_flow_vec[0])
+
+		return heading - np.pi / 2
+
+	def lanes_at(self, points, radius=5):
+		'''
+		Returns the index of the lane containing each point (the first one, in the order
+		of the map, if several do), or of the lane whose polygon is nearest within the
+		given radius if none does, or -1 if there is no lane that close.
+		'''
+
+		points = np.asarray(points, dtype=float).reshape(-1, 2)
+		lanes = np.full(len(points), -1)
+		if len(points) == 0:
+			return lanes
+
+		# Test all the points against each lane whose bounding box contains any of them
+		x_min, y_min = points.min(axis=0)
+		x_max, y_max = points.max(axis=0)
+		for lane in self.index.candidates(shapely.geometry.box(x_min, y_min, x_max, y_max)):
+			lx_min, ly_min, lx_max, ly_max = self.bounds[lane]
+			nearby = np.flatnonzero((lanes < 0)
+			                        & (points[:, 0] >= lx_min) & (points[:, 0] <= lx_max)
+			                        & (points[:, 1] >= ly_min) & (points[:, 1] <= ly_max))
+			if len(nearby) > 0:
+				inside = pointsIntersecting(self.index.geometries[lane], points[nearby])
+				lanes[nearby[inside]] = lane
+
+		# Fall back to the nearest lane for the (usually few) points lying on no lane
+		for i in np.flatnonzero(lanes < 0):
+			point = Point(points[i])
+			candidates = self.index.intersectingIndices(point.buffer(radius))
+			if candidates:
+				geoms = self.index.geometries
+				lanes[i] = min(candidates, key=lambda lane: geoms[lane].distance(point))
+
+		return lanes
+
+	def traffic_flow(self, points, radius=5):
+		'''
+		Returns an array of the traffic flow headings at the given points, NaN where there
+		is no lane within the given radius. If the headings have been rasterized, points in
+		cells of the grid covered by a lane use the heading of that cell.
+		'''
+
+		points = np.asarray(points, dtype=float).reshape(-1, 2)
+		if self.grid is None:
+			lanes = self.lanes_at(points, radius)
+			return np.where(lanes >= 0, self.headings[lanes], np.nan)
+
+		headings = self._grid_lookup(points)
+		missing = np.flatnonzero(np.isnan(headings))
+		if len(missing) > 0:
+			lanes = self.lanes_at(points[missing], radius)
+			headings[missing] = np.where(lanes >= 0, self.headings[lanes], np.nan)
+		return headings
+
+	def rasterize(self, resolution=1):
+		'''
+		Precomputes the traffic flow heading at the center of every cell of a grid with the
+		given resolution (in meters) covering the lanes of the map, so that lookups at most
+		points take constant time. Lookups near the edges of lanes are approximate.
+		'''
+
+		x_min, y_min = self.bounds[:, :2].min(axis=0)
+		x_max, y_max = self.bounds[:, 2:].max(axis=0)
+		columns = int(np.ceil((x_max - x_min) / resolution))
+		rows = int(np.ceil((y_max - y_min) / resolution))
+		headings = np.full((rows, columns), np.nan)
+
+		# Visit the lanes in reverse so that the first lane containing a cell wins, as above
+		for lane in reversed(range(len(self.headings))):
+			lx_min, ly_min, lx_max, ly_max = self.bounds[lane]
+			first_column = int((lx_min - x_min) / resolution)
+			last_column = min(int(np.ceil((lx_max - x_min) / resolution)), columns)
+			first_row = int((ly_min - y_min) / resolution)
+			last_row = min(int(np.ceil((ly_max - y_min) / resolution)), rows)
+			xs = x_min + (np.arange(first_column, last_column) + 0.5) * resolution
+			ys = y_min + (np.arange(first_row, last_row) + 0.5) * resolution
+			grid_x, grid_y = np.meshgrid(xs, ys)
+			centers = np.stack((grid_x.ravel(), grid_y.ravel()), axis=1)
+			inside = pointsIntersecting(self.index.geometries[lane], centers).reshape(grid_x.shape)
+			block = headings[first_row:last_row, first_column:last_column]
+			block[inside] = self.headings[lane]
+
+		self.grid = (headings, x_min, y_min, resolution)
+
+	def _grid_lookup(self, points):
+		headings, x_min, y_min, resolution = self.grid
+		columns = np.floor((points[:, 0] - x_min) / resolution).astype(int)
+		rows = np.floor((points[:, 1] - y_min) / resolution).astype(int)
+		valid = (rows >= 0) & (rows < headings.shape[0]) & (columns >= 0) & (columns < headings.shape[1])
+		result = np.full(len(points), np.nan)
+		result[valid] = headings[rows[valid], columns[valid]]
+		return result
+
+class _TileCache:
+	'''
+	Cache of the geometry of a map, split along a fixed grid of square tiles.
+
+	Each tile holds the union of the polygons of each layer clipped to the tile, so that
+	the geometry of a patch can be assembled from the few tiles it overlaps instead of
+	extracting and merging the polygons of the patch again. At most max_tiles tiles are
+	kept, discarding the least recently used ones.
+	'''
+
+	def __init__(self, map_api, tile_size=100, max_tiles=1024, layers=('road_segment', 'walkway')):
+		self.map_api = map_api
+		self.tile_size = tile_size
+		self.max_tiles = max_tiles
+		self.layers = tuple(layers)
+		self.tiles = OrderedDict()
+		self.lock = threading.Lock()
+
+	def tile(self, column, row):
+		'''
+		Returns a dictionary mapping each layer to its geometry within the given tile.
+		'''
+
+		key = (column, row)
+		with self.lock:
+			tile = self.tiles.get(key)
+			if tile is not None:
+				self.tiles.move_to_end(key)
+				return tile
+
+		tile = self._build_tile(column, row)
+
+		with self.lock:
+			self.tiles[key] = tile
+			self.tiles.move_to_end(key)
+			while len(self.tiles) > self.max_tiles:
+				self.tiles.popitem(last=False)
+		return tile
+
+	def _build_tile(self, column, row):
+		map_api = self.map_api
+		bounds = (column * self.tile_size, row * self.tile_size,
+		          (column + 1) * self.tile_size, (row + 1) * self.tile_size)
+		map_record_tokens = map_api.get_records_in_patch(bounds, list(self.layers))
+
+		tile = {}
+		for layer in self.layers:
+			records = [map_api.get(layer, token) for token in map_record_tokens[layer]]
+			polys = [map_api.extract_polygon(rec['polygon_token']) for rec in records]
+			tile[layer] = clip_by_rect(unary_union(polys), *bounds)
+		return tile
+
+	def patch(self, patch_coords):
+		'''
+		Returns a dictionary mapping each layer to its geometry within the given patch,
+		given as (x_min, y_min, x_max, y_max).
+		'''
+
+		x_min, y_min, x_max, y_max = patch_coords
+		size = self.tile_size
+		tiles = [self.tile(column, row)
+		         for column in range(math.floor(x_min / size), math.floor(x_max / size) + 1)
+		         for row in range(math.floor(y_min / size), math.floor(y_max / size) + 1)]
+
+		patch = {}
+		for layer in self.layers:
+			pieces = [tile[layer] for tile in tiles if not tile[layer].is_empty]
+			patch[layer] = clip_by_rect(unary_union(pieces), *patch_coords)
+		return patch
+
+class _EgoPoseIndex:
+	'''
+	KD-tree over the ego positions of the images of a location.
+	'''
+
+	def __init__(self, img_filenames, positions):
+		self.img_filenames = list(img_filenames)
+		self.positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+		self.tree = cKDTree(self.positions) if len(self.positions) > 0 else None
+
+	def near(self, point, radius):
+		'''
+		Returns the indices of the images whose ego position is within radius of the point.
+		'''
+
+		if self.tree is None:
+			return np.zeros(0, dtype=int)
+		return np.array(sorted(self.tree.query_ball_point(point, radius)), dtype=int)
+
+	def within(self, geometry, margin=0):
+		'''
+		Returns the images whose ego position lies in the given shapely geometry, or within
+		margin of it.
+		'''
+
+		if margin > 0:
+			geometry = geometry.buffer(margin)
+		if geometry.is_empty:
+			return []
+		x_min, y_min, x_max, y_max = geometry.bounds
+		center = ((x_min + x_max) / 2, (y_min + y_max) / 2)
+		candidates = self.near(center, math.hypot(x_max - x_min, y_max - y_min) / 2)
+		inside = pointsIntersecting(geometry, self.positions[candidates])
+		return [self.img_filenames[i] for i in candidates[inside]]
+
+def _unconditioned_support_box(value):
+	'''
+	Returns the bounding box given by supportBox for a vector, ignoring any conditioning
+	of the vector or of the values it depends on.
+	'''
+
+	saved = {}
+	stack = [value]
+	while stack:
+		node = stack.pop()
+		if isinstance(node, Samplable) and id(node) not in saved:
+			saved[id(node)] = (node, node._conditioned)
+			node._conditioned = node
+			stack.extend(node._dependencies)
+	try:
+		return supportBox(value)
+	finally:
+		for node, conditioned in saved.values():
+			node._conditioned = conditioned
 
 class NuscQueryAPI:
 	LOCATIONS = ['boston-seaport', 'singapore-onenorth', 'singapore-queenstown', 'singapore-hollandvillage']
@@ -37,16 +380,117 @@ class NuscQueryAPI:
 				 'singapore-queenstown': SINGAPORE_TIMEZONE,
 				 'singapore-hollandvillage': SINGAPORE_TIMEZONE}
 
-	def __init__(self, version='v1.0-trainval', dataroot='/home/bridge_simulator_to_realworld/nuscenes'):
-		self.nusc = NuScenes(version=version, dataroot=dataroot, verbose=True)
+	# Size (in meters) of the tiles in which map geometry is cached, and how many to keep
+	TILE_SIZE = 100
+	MAX_TILES = 1024
+
+	#: File extension of the index of preprocessed data saved next to the dataset.
+	INDEX_EXT = '.nqidx'
+
+	@classmethod
+	def _index_format_version(cls):
+		'''
+		Version number for the format of the index file. Should be incremented whenever the
+		data stored in the index, or the way it is derived, changes.
+		'''
+		return 1
+
+	class IndexMismatchError(Exception):
+		'''Exception raised when loading an index not matching the dataset.'''
+		pass
+
+	def __init__(self, version='v1.0-trainval', dataroot='/home/bridge_simulator_to_realworld/nuscenes', preload=False,
+	             index_path=None, use_index=True, write_index=True):
+		'''
+		Indexes the front camera images of the valid locations. Maps and their geometry are
+		only loaded when first needed, unless preload is True, in which case they are
+		prepared in a background thread (see preload).
+
+		The image index, per-sample metadata and map geometry are saved in an index file
+		(by default <dataroot>/<version>.nqidx), which later instances load instead of
+		deriving them again, provided the dataset has not changed. The nuScenes tables are
+		then only loaded once an image is actually queried. Map geometry computed by preload
+		is added to the index when preloading finishes; geometry computed on demand is only
+		saved by an explicit call to save_index.
+		'''
+
+		self.version = version
+		self.dataroot = dataroot
+		self._nusc = None
+		self._nusc_lock = threading.Lock()
+
+		if index_path is None:
+			index_path = os.path.join(dataroot, version + self.INDEX_EXT)
+		self.index_path = index_path
+		self._write_index = write_index
+		self._index_lock = threading.Lock()
+		self._index_digest = self._compute_index_digest()
+		# WKB of the map geometry of each location, as stored in the index
+		self._index_geometry = {}
+
+		loaded = False
+		if use_index and os.path.exists(index_path):
+			try:
+				self._load_index(index_path)
+				loaded = True
+			except pickle.UnpicklingError:
+				verbosePrint('Unable to load nuScenes index (old format or corrupted).')
+			except self.IndexMismatchError:
+				verbosePrint('nuScenes index does not match the dataset; ignoring it.')
+
+		if not loaded:
+			self._build_index()
+			if write_index:
+				self.save_index()
+
+		# Maps and their geometry are loaded lazily, the first time each location is used
+		self.nusc_map = _LazyDict(self._load_map, self.LOCATIONS)
+		self._geometry = _LazyDict(self._compute_geometry)
+
+		# Retrieve road, curb, and sidewalk geometry for each location
+		self.road = _LazyDict(lambda location: self._geometry[location]['road'], self.LOCATIONS)
+		self.sidewalk = _LazyDict(lambda location: self._geometry[location]['sidewalk'], self.LOCATIONS)
+		self.curb = _LazyDict(lambda location: self._geometry[location]['curb'], self.LOCATIONS)
+
+		# Prepared road geometry of each location, for fast point-in-road tests
+		self.road_prepared = _LazyDict(lambda location: shapely.prepared.prep(self.road[location]),
+		                               self.LOCATIONS)
+
+		# Cache of tiles of the road and sidewalk geometry of each location
+		self.map_tiles = _LazyDict(lambda location: _TileCache(self.nusc_map[location],
+		                                                       self.TILE_SIZE, self.MAX_TILES),
+		                           self.LOCATIONS)
+
+		# Spatial index over the ego positions of the images of each location
+		self.ego_pose_index = _LazyDict(self._build_ego_pose_index, self.LOCATIONS)
+
+		# Index of the lanes of each location, for looking up the direction of traffic
+		self.traffic_flow_index = _LazyDict(lambda location: _TrafficFlowIndex(self.nusc_map[location]),
+		                                    self.LOCATIONS)
 
+		# Construct Scenic network for each location
+		self.scenic_network = {}
+
+		if preload:
+			self.preload(background=True)
+
+	@property
+	def nusc(self):
+		if self._nusc is None:
+			with self._nusc_lock:
+				if self._nusc is None:
+					self._nusc = NuScenes(version=self.version, dataroot=self.dataroot, verbose=True)
+		return self._nusc
+
+	def _build_index(self):
 		# Create reverse mapping for image filenames to sample data tokens
 		self.img_filename_to_sample_data_token = {}
 
 		# Create reverse mapping for image filenames to location
 		self.img_filename_to_location = {}
 
-		self.img_filenames = set()
+		# Metadata of the sample of each image, which does not require the nuScenes tables
+		self.img_metadata = {}
 
 		for scene in self.nusc.scene:
 			num_samples = scene['nbr_samples']
@@ -61,77 +505,240 @@ class NuscQueryAPI:
 			for _ in range(num_samples):
 				sample = self.nusc.get('sample', curr_sample_token)
 				cam_front_data = self.nusc.get('sample_data', sample['data']['CAM_FRONT'])
+				pose_rec = self.nusc.get('ego_pose', cam_front_data['ego_pose_token'])
 
 				# Extract file name without directories; e.g., samples/CAM_FRONT/filename.jpg becomes filename.jpg
 				img_filename = cam_front_data['filename'].split('/')[-1]
-				self.img_filenames.add(img_filename)
 				self.img_filename_to_sample_data_token[img_filename] = cam_front_data['token']
 
 				self.img_filename_to_location[img_filename] = location
 
+				self.img_metadata[img_filename] = {
+					'sample_token': sample['token'],
+					'scene_token': scene['token'],
+					'timestamp': cam_front_data['timestamp'],
+					'ego_translation': tuple(pose_rec['translation']),
+					'ego_rotation': tuple(pose_rec['rotation']),
+					'description': scene['description'],
+				}
+
 				curr_sample_token = sample['next']
 
-		# Load map for each location
-		self.nusc_map = {}
-		for loc in self.LOCATIONS:
-			self.nusc_map[loc] = NuScenesMap(dataroot=dataroot, map_name=loc)
+		self.img_filenames = set(self.img_filename_to_sample_data_token)
+
+	def _compute_index_digest(self):
+		# Identify the dataset by its version, location and the sizes and modification
+		# times of its tables and maps, so that the index is rebuilt if any of them change
+		hasher = hashlib.blake2b()
+		hasher.update(f'{self.version}\0{os.path.abspath(self.dataroot)}\0'.encode())
+		hasher.update(repr(sorted(self.VALID_LOCATIONS)).encode())
+		for directory in (os.path.join(self.dataroot, self.version),
+		                  os.path.join(self.dataroot, 'maps', 'expansion')):
+			if not os.path.isdir(directory):
+				continue
+			for name in sorted(os.listdir(directory)):
+				if name.endswith('.json'):
+					stat = os.stat(os.path.join(directory, name))
+					hasher.update(f'{name}\0{stat.st_size}\0{stat.st_mtime_ns}\0'.encode())
+		return hasher.digest()
+
+	def _load_index(self, path):
+		start_time = time.time()
+		with open(path, 'rb') as f:
+			version_field = f.read(4)
+			if len(version_field) != 4:
+				raise pickle.UnpicklingError(f'{self.INDEX_EXT} file is corrupted')
+			version = struct.unpack('<I', version_field)
+			if version[0] != self._index_format_version():
+				raise pickle.UnpicklingError(f'{self.INDEX_EXT} file is too old')
+			digest = f.read(64)
+			if len(digest) != 64:
+				raise pickle.UnpicklingError(f'{self.INDEX_EXT} file is corrupted')
+			if digest != self._index_digest:
+				raise self.IndexMismatchError(f'{self.INDEX_EXT} file does not correspond to the dataset')
+			try:
+				with gzip.open(f) as gf:
+					state = pickle.load(gf)
+			except (OSError, EOFError) as e:
+				raise pickle.UnpicklingError(f'{self.INDEX_EXT} file is corrupted') from e
+
+		self.img_filename_to_sample_data_token = state['img_filename_to_sample_data_token']
+		self.img_filename_to_location = state['img_filename_to_location']
+		self.img_metadata = state['img_metadata']
+		self.img_filenames = set(self.img_filename_to_sample_data_token)
+		self._index_geometry = state['geometry']
+
+		total_time = time.time() - start_time
+		verbosePrint(f'Loaded nuScenes index in {total_time:.2f} seconds.')
+
+	def save_index(self, path=None):
+		'''
+		Saves the image index, per-sample metadata, and the map geometry computed so far to
+		the given path (by default, the index path given on construction).
+		'''
 
-		# Retrieve road, curb, and sidewalk geometry for each location
-		self.road = {}
-		self.sidewalk = {}
-		self.curb = {}
+		if path is None:
+			path = self.index_path
+		state = {
+			'img_filename_to_sample_data_token': self.img_filename_to_sample_data_token,
+			'img_filename_to_location': self.img_filename_to_location,
+			'img_metadata': self.img_metadata,
+			'geometry': dict(self._index_geometry),
+		}
+		data = pickle.dumps(state)
+		version = struct.pack('<I', self._index_format_version())
+
+		# Write to a temporary file first, so that other processes never see a partial index
+		with self._index_lock:
+			directory = os.path.dirname(os.path.abspath(path))
+			try:
+				fd, temp_path = tempfile.mkstemp(dir=directory, suffix=self.INDEX_EXT)
+				try:
+					with os.fdopen(fd, 'wb') as f:
+						f.write(version)		# uncompressed in case we change compression schemes later
+						f.write(self._index_digest)
+						with gzip.open(f, 'wb') as gf:
+							gf.write(data)
+					os.replace(temp_path, path)
+				except BaseException:
+					os.unlink(temp_path)
+					raise
+			except OSError as e:
+				verbosePrint(f'Unable to save nuScenes index: {e}')
+
+	def _build_ego_pose_index(self, location):
+		img_filenames = sorted(img_filename for img_filename, img_location in self.img_filename_to_location.items()
+		                       if img_location == location)
+		positions = [self.img_metadata[img_filename]['ego_translation'][:2] for img_filename in img_filenames]
+		return _EgoPoseIndex(img_filenames, positions)
+
+	def _load_map(self, location):
+		return NuScenesMap(dataroot=self.dataroot, map_name=location)
+
+	def _compute_geometry(self, location):
+		stored = self._index_geometry.get(location)
+		if stored is not None:
+			return {key: shapely.wkb.loads(data) for key, data in stored.items()}
 
-		# Construct Scenic network for each location
-		self.scenic_network = {}
+		map_api = self.nusc_map[location]
 
-		for location in NuscQueryAPI.LOCATIONS:
-			map_api = self.nusc_map[location]
+		road_polys = [map_api.extract_polygon(rec['polygon_token']) for rec in map_api.road_segment]
+		sidewalk_polys = [map_api.extract_polygon(rec['polygon_token']) for rec in map_api.walkway]
 
-			road_polys = [map_api.extract_polygon(rec['polygon_token']) for rec in map_api.road_segment]
-			sidewalk_polys = [map_api.extract_polygon(rec['polygon_token']) for rec in map_api.walkway]
+		road = unary_union(road_polys)
+		sidewalk = unary_union(sidewalk_polys)
 
-			self.road[location] = unary_union(road_polys)
-			self.sidewalk[location] = unary_union(sidewalk_polys)
+		curb_lines = []
+		road_parts = road.geoms if hasattr(road, 'geoms') else [road]
+		for road_poly in road_parts:
+			# Retrieve the curb, which is the boundary of the road polygon
+			oriented_poly = shapely.geometry.polygon.orient(road_poly) # Orient the vertices CCW
+			curb_vertices = list(oriented_poly.exterior.coords)
+			curb_lines.append(LineString(curb_vertices))
 
-			curb_lines = []
-			for road_poly in self.road[location]:
-				# Retrieve the curb, which is the boundary of the road polygon
-				oriented_poly = shapely.geometry.polygon.orient(road_poly) # Orient the vertices CCW
-				curb_vertices = list(oriented_poly.exterior.coords)
-				curb_lines.append(LineString(curb_vertices))
+		geometry = {'road': road, 'sidewalk': sidewalk, 'curb': MultiLineString(curb_lines)}
 
-			self.curb[location] = MultiLineString(curb_lines)
+		if self._write_index:
+			self._index_geometry[location] = {key: geom.wkb for key, geom in geometry.items()}
 
-	def get_location(self, img_filename):
-		return self.img_filename_to_location[img_filename]
+		return geometry
 
-	def _ann_in_view(box, cs_rec, pose_rec, camera_intrinsic):
-		bbox = box.copy()
+	def preload(self, locations=None, background=False):
+		'''
+		Loads the maps of the given locations (by default, those of the images) and computes
+		their road, sidewalk, and curb geometry ahead of use. If background is True, this is
+		done in a daemon thread, which is returned; queries that need a location still being
+		processed wait for it instead of repeating the work. If any geometry had to be
+		computed, the index is saved once all the locations are done.
+		'''
 
-		# Move bbox to the ego-pose frame.
-		bbox.translate(-np.array(pose_rec['translation']))
-		bbox.rotate(Quaternion(pose_rec['rotation']).inverse)
+		if locations is None:
+			locations = sorted(set(self.img_filename_to_location.values()))
 
-		# Move them to the calibrated sensor frame.
-		bbox.translate(-np.array(cs_rec['translation']))
-		bbox.rotate(Quaternion(cs_rec['rotation']).inverse)
+		def load():
+			missing = [location for location in locations if location not in self._index_geometry]
+			for location in locations:
+				self._geometry[location]
+			if self._write_index and any(location in self._index_geometry for location in missing):
+				self.save_index()
 
-		# Filter out the corners that are not in front of the calibrated sensor.
-		corners_3d = bbox.corners()
-		in_front = np.argwhere(corners_3d[2, :] > 0).flatten()
-		corners_3d = corners_3d[:, in_front]
+		if not background:
+			load()
+			return None
 
-		# Project 3d box to 2d.
-		corner_coords = view_points(corners_3d, camera_intrinsic, True).T[:, :2].tolist()
+		thread = threading.Thread(target=load, name='NuscQueryAPI.preload', daemon=True)
+		thread.start()
+		return thread
+
+	def get_location(self, img_filename):
+		return self.img_filename_to_location[img_filename]
 
-		# Keep only corners that fall within the image.
-		final_coords = post_process_coords(corner_coords)
+	# Signs of the coordinates of the corners of a box, in the order of nuScenes' Box.corners
+	CORNER_SIGNS = np.array([[1, 1, 1, 1, -1, -1, -1, -1],
+	                         [1, -1, -1, 1, 1, -1, -1, 1],
+	                         [1, 1, -1, -1, 1, 1, -1, -1]])
 
-		# Skip if the convex hull of the re-projected corners does not intersect the image canvas.
-		if final_coords is None:
-			return False
+	@staticmethod
+	def _box_corners(ann_recs):
+		'''
+		Returns the corners of the 3D boxes of the given annotations in global coordinates,
+		as an array of shape (n, 3, 8) with the corners in the order of Box.corners.
+		'''
+
+		n = len(ann_recs)
+		centers = np.array([rec['translation'] for rec in ann_recs], dtype=float).reshape(n, 3)
+		sizes = np.array([rec['size'] for rec in ann_recs], dtype=float).reshape(n, 3)
+		rotations = _rotation_matrices([rec['rotation'] for rec in ann_recs])
+
+		# Sizes are given as width, length, height, and the box extends along x by its length
+		half_extents = sizes[:, [1, 0, 2]] / 2
+		local = half_extents[:, :, None] * NuscQueryAPI.CORNER_SIGNS
+		return rotations @ local + centers[:, :, None]
+
+	@staticmethod
+	def _anns_in_view(corners, cs_rec, pose_rec, camera_intrinsic, imsize=(1600, 900)):
+		'''
+		Returns a boolean mask telling which boxes, given by their corners as computed by
+		_box_corners, appear in the image of the camera: i.e. the convex hull of the projections
+		of their corners in front of the camera intersects the image canvas.
+		'''
 
-		return True
+		if len(corners) == 0:
+			return np.zeros(0, dtype=bool)
+
+		# Move the corners to the ego-pose frame and then the calibrated sensor frame, in one step
+		pose_rotation = _rotation_matrices([pose_rec['rotation']])[0]
+		cs_rotation = _rotation_matrices([cs_rec['rotation']])[0]
+		rotation = (pose_rotation @ cs_rotation).T
+		offset = rotation @ np.asarray(pose_rec['translation']) + cs_rotation.T @ np.asarray(cs_rec['translation'])
+		points = rotation @ corners - offset[:, None]
+
+		# Only corners in front of the calibrated sensor are projected
+		in_front = points[:, 2, :] > 0
+		projected = np.asarray(camera_intrinsic) @ points
+		with np.errstate(divide='ignore', invalid='ignore'):
+			u = projected[:, 0, :] / projected[:, 2, :]
+			v = projected[:, 1, :] / projected[:, 2, :]
+
+		# A box is visible if any corner lies within the image...
+		width, height = imsize
+		inside = in_front & (u >= 0) & (u <= width) & (v >= 0) & (v <= height)
+		visible = inside.any(axis=1)
+
+		# ...and invisible if no corner is in front, or all lie beyond one side of the image
+		separated = ~in_front.any(axis=1)
+		separated |= np.where(in_front, u, -np.inf).max(axis=1) < 0
+		separated |= np.where(in_front, u, np.inf).min(axis=1) > width
+		separated |= np.where(in_front, v, -np.inf).max(axis=1) < 0
+		separated |= np.where(in_front, v, np.inf).min(axis=1) > height
+
+		# Otherwise the convex hull of the corners may still cross the image; check exactly
+		for index in np.flatnonzero(~visible & ~separated):
+			front = in_front[index]
+			corner_coords = np.stack((u[index, front], v[index, front]), axis=1).tolist()
+			visible[index] = post_process_coords(corner_coords, imsize) is not None
+
+		return visible
 
 	def get_img_data(self, img_filename):
 		sample_data_token = self.img_filename_to_sample_data_token[img_filename]
@@ -141,7 +748,7 @@ class NuscQueryAPI:
 
 		# Load road geometry
 		location = self.get_location(img_filename)
-		road = regionFromShapelyObject(self.get_whole_map(location)['road'])
+		road = self.road_prepared[location]
 
 		# Get the calibrated sensor and ego pose record to get the transformation matrices.
 		cs_rec = self.nusc.get('calibrated_sensor', sample_data['calibrated_sensor_token'])
@@ -154,44 +761,38 @@ class NuscQueryAPI:
 		# Get annotation records
 		ann_recs = [self.nusc.get('sample_annotation', ann_token) for ann_token in sample['anns']]
 
-		vehicles = []
-
-		for ann_rec in ann_recs:
-			# Discard if not desired vehicle type
-			instance = self.nusc.get('instance', ann_rec['instance_token'])
-			category = self.nusc.get('category', instance['category_token'])
+		# Discard if not desired vehicle type (the devkit stores the category name in each annotation)
+		ann_recs = [rec for rec in ann_recs if rec['category_name'] in self.VEHICLE_CATEGORIES]
 
-			box = self.nusc.get_box(ann_rec['token'])
+		# Keep the annotations visible in the camera, transforming all their boxes at once
+		corners = NuscQueryAPI._box_corners(ann_recs)
+		in_view = NuscQueryAPI._anns_in_view(corners, cs_rec, pose_rec, camera_intrinsic)
+		ann_recs = [rec for rec, visible in zip(ann_recs, in_view) if visible]
+		corners = corners[in_view]
 
-			if not NuscQueryAPI._ann_in_view(box, cs_rec, pose_rec, camera_intrinsic):
-				continue
-
-			# Get heading angle (yaw) from quaternion in degrees
-			heading = box.orientation.yaw_pitch_roll[0]
-			heading = ((heading * 180 / np.pi) + 360) % 360
+		# Filter out all labels regarding entities NOT on road, testing all centers at once
+		centers = [rec['translation'][:2] for rec in ann_recs]
+		on_road = pointsIntersecting(road, centers)
 
-			# Birds-eye coordinates
-			xy = box.center[:2]
+		vehicles = []
 
-			# Filter out all labels regarding entities NOT on road
-			if not road.containsPoint(Vector(xy[0], xy[1])):
+		for ann_rec, box_corners, ann_on_road in zip(ann_recs, corners, on_road):
+			if not ann_on_road:
 				continue
 
 			# # Reject images with INVALID traffic participant ON road
-			# if (category['name'] in self.INVALID_CATEGORIES) and (road.intersects(Point(xy[0], xy[1]))):
+			# if ann_rec['category_name'] in self.INVALID_CATEGORIES:
 			# 	return 0
 
-			# Skip annotation if it's not a desired vehicle type
-			if category['name'] not in self.VEHICLE_CATEGORIES:
-				continue
+			# Get heading angle (yaw) from quaternion in degrees
+			heading = Quaternion(ann_rec['rotation']).yaw_pitch_roll[0]
+			heading = ((heading * 180 / np.pi) + 360) % 360
+
+			# Birds-eye coordinates
+			xy = np.array(ann_rec['translation'][:2])
 
-			# Birds-eye 2D bounding box
-			corners = box.bottom_corners()
-			corners = corners[:2, :]
-			vertices = []
-			for corner_idx in range(corners.shape[1]):
-				vertices.append((corners[0, corner_idx], corners[1, corner_idx]))
-			box_2d = Polygon(vertices)
+			# Birds-eye 2D bounding box, from the bottom corners in the order of Box.bottom_corners
+			box_2d = Polygon(box_corners[:2, [2, 3, 7, 6]].T)
 
 			vehicle_dict = {'heading': heading, 'position': tuple(xy), 'box': box_2d}
 			vehicles.append(vehicle_dict)
@@ -215,21 +816,12 @@ class NuscQueryAPI:
 		x_max += 25
 		y_max += 25
 
-		# Load API for relevant map
-		location = self.img_filename_to_location[img_filename]
-		map_api = self.nusc_map[location]
-
-		# Retrieve all lane and sidewalk polygons in patch
+		# Retrieve the road and sidewalk geometry in the patch, from cached tiles of the map
 		patch_coords = (x_min, y_min, x_max, y_max)
-		map_record_tokens = map_api.get_records_in_patch(patch_coords, ['road_segment', 'walkway'])
-		road_records = [map_api.get('road_segment', token) for token in map_record_tokens['road_segment']]
-		sidewalk_records = [map_api.get('walkway', token) for token in map_record_tokens['walkway']]
-
-		lane_polys = [map_api.extract_polygon(rec['polygon_token']) for rec in road_records]
-		sidewalk_polys = [map_api.extract_polygon(rec['polygon_token']) for rec in sidewalk_records]
+		patch = self.map_tiles[location].patch(patch_coords)
 
-		retval['road'] = unary_union(lane_polys)
-		retval['sidewalk'] = unary_union(sidewalk_polys)
+		retval['road'] = patch['road_segment']
+		retval['sidewalk'] = patch['walkway']
 
 		# Get local time, dividing timestamp by 10^6 since it's represented in microseconds
 		local_time = datetime.fromtimestamp(sample_data['timestamp'] / 1e6, tz=NuscQueryAPI.TIME_ZONE[location])
@@ -237,48 +829,127 @@ class NuscQueryAPI:
 		retval['description'] = scene['description']
 
 		# Also return helper function that retrieves traffic flow at any point
+		flow_index = self.traffic_flow_index[location]
 		def get_traffic_flow(point):
-			lane_token = map_api.record_on_point(point[0], point[1], 'lane')
+			heading = flow_index.traffic_flow([point])[0]
 
-			if lane_token == '':
-				# Find closest lane if point does not lie on any lane
-				closest_lane_token = map_api.get_closest_lane(point[0], point[1])
+			if np.isnan(heading):
+				return 'Found no lanes near point'
 
-				if closest_lane_token == '':
-					return 'Found no lanes near point'
+			return heading
 
-				lane_token = closest_lane_token
+		retval['traffic_flow'] = get_traffic_flow
 
-			lane_rec = map_api.get('lane', lane_token)
+		return retval
 
-			from_edge = map_api.get('line', lane_rec['from_edge_line_token'])
-			to_edge = map_api.get('line', lane_rec['to_edge_line_token'])
+	def traffic_flow(self, location, points):
+		'''
+		Returns an array of the traffic flow headings at many points of the given location
+		at once, NaN for points which are not within 5 meters of a lane.
+		'''
 
-			from_nodes = [map_api.get('node', t) for t in from_edge['node_tokens']]
-			from_nodes = [np.array([n['x'], n['y']]) for n in from_nodes]
-			to_nodes = [map_api.get('node', t) for t in to_edge['node_tokens']]
-			to_nodes = [np.array([n['x'], n['y']]) for n in to_nodes]
+		return self.traffic_flow_index[location].traffic_flow(points)
 
-			# Compute traffic flow vector using midpoints of edges
-			from_mid = (from_nodes[0] + from_nodes[1]) / 2
-			to_mid = (to_nodes[0] + to_nodes[1]) / 2
-			traffic_flow_vec = to_mid - from_mid
+	def get_img_filenames_near(self, location, point, radius):
+		'''
+		Returns the images of the given location whose ego position is within radius of the point.
+		'''
 
-			heading = np.arctan2(traffic_flow_vec[1], traffic_flow_vec[0])
+		index = self.ego_pose_index[location]
+		return [index.img_filenames[i] for i in index.near(point, radius)]
 
-			return heading - np.pi / 2
+	def get_img_filenames_in(self, location, region, margin=0):
+		'''
+		Returns the images of the given location whose ego position lies in the given region
+		(a Scenic Region or shapely geometry), or within margin of it. Regions which are not
+		polygonal are approximated by their bounding box if they have one, and otherwise
+		tested point by point (in which case margin must be 0).
+		'''
 
-		retval['traffic_flow'] = get_traffic_flow
+		index = self.ego_pose_index[location]
+		if region is everywhere:
+			return list(index.img_filenames)
+		if not isinstance(region, shapely.geometry.base.BaseGeometry):
+			geometry = toPolygon(region)
+			if geometry is None:
+				try:
+					((x_min, y_min), (x_max, y_max)) = region.getAABB()
+				except NotImplementedError:
+					if margin > 0:
+						raise RuntimeError(f'cannot find images within a margin of {region}')
+					return [img_filename for img_filename, position in zip(index.img_filenames, index.positions)
+					        if region.containsPoint(Vector(*position))]
+				geometry = shapely.geometry.box(x_min, y_min, x_max, y_max)
+			region = geometry
+		return index.within(region, margin)
+
+	def get_candidate_img_filenames(self, scenario, location, margin=0):
+		'''
+		Returns the images of the given location which can match the scenario as far as the
+		position of the ego is concerned: those whose ego position lies in the workspace of
+		the scenario and in the bounding box of the possible positions of its ego (ignoring
+		any conditioning, e.g. by Scenario.conditioned), or within margin of them.
+		'''
 
-		return retval
+		geometry = None
+		workspace = scenario.workspace.region
+		if workspace is not everywhere:
+			geometry = toPolygon(workspace)
+
+		((x_min, y_min), (x_max, y_max)) = _unconditioned_support_box(scenario.egoObject.position)
+		if None not in (x_min, y_min, x_max, y_max):
+			ego_box = shapely.geometry.box(x_min, y_min, x_max, y_max)
+			geometry = ego_box if geometry is None else geometry.intersection(ego_box)
+
+		if geometry is None:
+			return sorted(self.ego_pose_index[location].img_filenames)
+		return self.ego_pose_index[location].within(geometry, margin)
+
+	def iter_img_data(self, img_filenames, workers=4, prefetch=None):
+		'''
+		Yields pairs (img_filename, label) for the given images in order, like calling
+		get_img_data on each, but extracting the labels of up to prefetch images ahead (by
+		default, twice the number of workers) in a pool of threads. This overlaps label
+		extraction with whatever the caller does with each label, while bounding the number
+		of labels held in memory. If the generator is closed early, pending work is cancelled.
+		'''
+
+		if workers < 1:
+			raise ValueError(f'invalid number of workers {workers}')
+		if prefetch is None:
+			prefetch = 2 * workers
+		if prefetch < 1:
+			raise ValueError(f'invalid prefetch count {prefetch}')
+
+		img_filenames = iter(img_filenames)
+		with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='NuscQueryAPI') as executor:
+			pending = deque((img_filename, executor.submit(self.get_img_data, img_filename))
+			                for img_filename in itertools.islice(img_filenames, prefetch))
+			try:
+				while pending:
+					img_filename, future = pending.popleft()
+					label = future.result()
+
+					# Start on the next image before handing this one over
+					for next_filename in itertools.islice(img_filenames, 1):
+						pending.append((next_filename, executor.submit(self.get_img_data, next_filename)))
+
+					yield img_filename, label
+			finally:
+				for _, future in pending:
+					future.cancel()
 
 	def get_whole_map(self, location):
-		retval = {}
-		retval['road'] = self.road[location]
-		retval['sidewalk'] = self.sidewalk[location]
-		retval['curb'] = self.curb[location]
+		return dict(self._geometry[location])
 
-		return retval
+	def extract_labels(self, path, img_filenames=None, progress=None):
+		'''
+		Extracts the labels of the given images (by default, all of them) into a LabelStore
+		saved in the given directory, so that later queries can filter frames on their labels
+		without calling get_img_data (see scenic.nusc_label_store).
+		'''
+
+		return LabelStore.extract(self, path, img_filenames, progress)
 
 	def get_img_filenames(self):
 		'''
@@ -0,0 +1,41 @@
+import io
+
+import pytest
+
+from scenic.core.batch import BatchQueryRunner, ProgressPrinter
+
+def makeState(offset):
+    return {'offset': offset, 'checked': 0}
+
+def checkFrame(state, frame):
+    state['checked'] += 1
+    if frame < 0:
+        raise ValueError(frame)
+    return (frame + state['offset']) % 3 == 0
+
+@pytest.mark.parametrize('workers', (1, 2))
+def test_batch_order(workers):
+    reports = []
+    runner = BatchQueryRunner(makeState, checkFrame, initargs=(1,), workers=workers,
+                              chunksize=4, progress=lambda *args: reports.append(args))
+    frames = list(range(20))
+    results = list(runner.run(frames))
+    assert [frame for frame, result in results] == frames
+    assert [result for frame, result in results] == [(f+1) % 3 == 0 for f in frames]
+    assert reports == [(i, 20) for i in range(1, 21)]
+    assert runner.matching(iter(frames)) == [2, 5, 8, 11, 14, 17]
+
+@pytest.mark.parametrize('workers', (1, 2))
+def test_batch_errors(workers):
+    runner = BatchQueryRunner(makeState, checkFrame, initargs=(0,), workers=workers)
+    with pytest.raises(ValueError):
+        list(runner.run([1, 2, -1, 3]))
+
+def test_progress_printer():
+    stream = io.StringIO()
+    printer = ProgressPrinter(stream)
+    printer(1, 2)
+    printer(2, 2)
+    assert stream.getvalue().count('\r  Checked ') == 2
+    assert 'Checked 2/2 frames' in stream.getvalue()
+    assert stream.getvalue().endswith('\n')
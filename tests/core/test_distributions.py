@@ -4,7 +4,8 @@ import warnings
 import scipy.stats
 import numpy.linalg
 
-from scenic.core.distributions import Range, Normal, TruncatedNormal, DiscreteRange, Options
+from scenic.core.distributions import (Range, Normal, TruncatedNormal, DiscreteRange, Options,
+                                       supportInterval)
 
 def similarDistributions(d1, d2, samples=3000, p=0.002):
     s1 = [d1.sample() for i in range(samples)]
@@ -41,3 +42,24 @@ def test_bucketed_discrete_range():
 def test_bucketed_options():
     o = Options({0: 1, 1: 3})
     similarDistributions(o, o.bucket())
+
+def test_support_interval():
+    r = Range(-3, 7)
+    assert supportInterval(r) == (-3, 7)
+    assert supportInterval(2 * r + 1) == (-5, 15)
+    assert supportInterval(-r) == (-7, 3)
+    assert supportInterval(Range(r, 10)) == (-3, 10)
+    assert supportInterval(Options([r, DiscreteRange(0, 9)])) == (-3, 9)
+    assert supportInterval(TruncatedNormal(0, 1, -1, 2)) == (-1, 2)
+    assert supportInterval(r + Normal(0, 1)) == (None, None)
+    r.conditionTo(Range(0, 1))
+    assert supportInterval(r) == (0, 1)
+
+def test_options_encoding():
+    from scenic.core.smt import EncodingContext, EncodingCache
+    context = EncodingContext()
+    var = Options([Range(0, 1), 5]).encodeToSMT(context, EncodingCache())
+    assert var == 'options1'
+    assert context.numAssertions == 1
+    assert list(context.lines())[-1] == ('(assert (or (and (and (<= 0.0 range1) (<= range1 1.0))'
+                                         ' (= range1 options1)) (= 5 options1)))')
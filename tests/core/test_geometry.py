@@ -2,6 +2,7 @@
 import pytest
 import shapely.geometry
 import shapely.ops
+import shapely.prepared
 
 import scenic.core.geometry as geometry
 
@@ -52,3 +53,24 @@ def test_triangulation_holes():
         ]
     )
     checkTriangulation(p)
+
+def test_convex_pieces():
+    rect = shapely.geometry.box(0, 0, 4, 1)
+    assert len(geometry.convexPieces(geometry.triangulatePolygon(rect))) == 1
+    ell = shapely.geometry.Polygon([(0, 0), (3, 0), (3, 1), (1, 1), (1, 3), (0, 3)])
+    triangles = geometry.triangulatePolygon(ell)
+    pieces = geometry.convexPieces(triangles)
+    assert 2 <= len(pieces) < len(triangles)
+    for piece in pieces:
+        assert piece.area == pytest.approx(piece.convex_hull.area)
+    assert sum(piece.area for piece in pieces) == pytest.approx(ell.area)
+    assert shapely.ops.unary_union(pieces).symmetric_difference(ell).area < 1e-9
+
+def test_points_intersecting():
+    poly = shapely.geometry.Polygon([(0, 0), (3, 0), (3, 1), (1, 1), (1, 3), (0, 3)])
+    points = [(0.5, 0.5), (2, 2), (3, 0.5), (0, 3), (-1, 0), (0.5, 2.5)]
+    expected = [poly.intersects(shapely.geometry.Point(p)) for p in points]
+    assert list(geometry.pointsIntersecting(poly, points)) == expected
+    prepared = shapely.prepared.prep(poly)
+    assert list(geometry.pointsIntersecting(prepared, points)) == expected
+    assert len(geometry.pointsIntersecting(poly, [])) == 0
@@ -0,0 +1,61 @@
+import json
+
+import pytest
+
+from scenic.core.distributions import Range
+from scenic.core.profiling import EncodingProfiler
+from scenic.core.smt import EncodingContext, EncodingCache
+
+def test_encoding_profiler(tmpdir):
+    profiler = EncodingProfiler()
+    context = EncodingContext(profiler=profiler)
+    cache = EncodingCache()
+    r1, r2 = Range(0, 1), Range(2, 3)
+    (r1 + r2).encodeToSMT(context, cache)
+    assert context.numAssertions == profiler.assertions
+    assert len(context.declarations) == profiler.variables
+
+    outer = profiler.stats[('OperatorDistribution',)]
+    inner = profiler.stats[('OperatorDistribution', 'Range')]
+    assert outer['calls'] == 1 and inner['calls'] == 2
+    assert outer['variables'] == len(context.declarations)
+    assert outer['self_variables'] == outer['variables'] - inner['variables']
+    assert inner['variables'] == 2 and inner['assertions'] == 2
+    assert outer['self_time'] <= outer['time']
+    text = context.toString()
+    header = len('(set-logic QF_NRA)\n')
+    assert outer['bytes'] == len(text) - header
+
+    totals = profiler.byName()
+    assert totals['Range']['calls'] == 2
+    assert 'Range' in profiler.summary()
+    stacks = profiler.flamegraphStacks(metric='assertions')
+    assert 'OperatorDistribution;Range 2' in stacks
+
+    path = str(tmpdir.join('profile.json'))
+    profiler.writeJSON(path)
+    with open(path) as f:
+        entries = json.load(f)
+    assert {tuple(entry['stack']) for entry in entries} == set(profiler.stats)
+
+def test_encoding_without_profiler():
+    context = EncodingContext()
+    Range(0, 1).encodeToSMT(context, {'variables': []})
+    assert context.profiler is None
+    assert context.numAssertions == 1
+
+def test_profiler_reset():
+    profiler = EncodingProfiler()
+    with profiler.section('outer'):
+        with profiler.section('inner'):
+            profiler.emitted('(assert true)', assertion=True)
+            with pytest.raises(RuntimeError, match='outer, inner'):
+                profiler.reset()
+    assert profiler.stats[('outer', 'inner')]['assertions'] == 1
+    assert profiler.stats[('outer',)]['self_assertions'] == 0
+    profiler.reset()
+    assert profiler.stats == {} and profiler.assertions == 0
+    with profiler.section('inner'):
+        profiler.emitted('(assert true)', assertion=True)
+    assert list(profiler.stats) == [('inner',)]
+    assert profiler.stats[('inner',)]['self_assertions'] == 1
@@ -1,3 +1,6 @@
+import math
+
+import pytest
 
 import shapely.geometry
 
@@ -18,3 +21,123 @@ def test_polygon_sampling():
     assert sum(1 <= y <= 2 for y in ys) <= 870
     assert sum(x >= 1.5 for x in xs) >= 1250
     assert sum(y >= 1.5 for y in ys) >= 1250
+
+def test_polygon_prune_sector():
+    grid = shapely.geometry.MultiPolygon([shapely.geometry.box(i, j, i+1, j+1)
+                                          for i in range(0, 40, 2) for j in range(0, 40, 2)])
+    region = PolygonalRegion(polygon=grid)
+    triangles = [tri for tri, bounds in region.trianglesAndBounds]
+    cache = {'ego': OrientedVector(10, 10, 0), 'ego_view_radius': 5, 'ego_viewAngle': 90}
+    pruned = pruneValidRegion(None, cache, region.triangleIndex)
+    assert pruned
+    assert pruned == pruneValidRegion(None, cache, triangles)
+    assert region.triangleIndex is region.triangleIndex
+
+def test_polyline_prune_sector():
+    line = PolylineRegion([(-10, 5), (0, 5), (10, 5), (10, 20)])
+    cache = {'ego': OrientedVector(0, 0, 0), 'ego_view_radius': 10, 'ego_viewAngle': 90}
+    pruned = pruneValidLines(None, cache, line.segmentIndex)
+    assert len(pruned) == 2
+    sector = cache['ego_sector_polygon']
+    total = sum(piece.length for piece in pruned)
+    assert total == pytest.approx((line.lineString & sector).length)
+
+def test_polygon_convex_encoding():
+    from scenic.core.smt import EncodingContext, EncodingCache
+    ell = shapely.geometry.Polygon([(0, 0), (3, 0), (3, 1), (1, 1), (1, 3), (0, 3)])
+    region = PolygonalRegion(polygon=ell)
+    pieces = region.convexPieceIndex.geometries
+    assert len(pieces) < len(region.trianglesAndBounds)
+    ego = OrientedVector(0, -1, 0)
+    sector = SectorRegion(ego, 10, 0, math.pi / 2)
+    context = EncodingContext()
+    point = (context.declareFresh('x'), context.declareFresh('y'))
+    cache = EncodingCache(ego=ego, ego_visibleRegion=sector, current_obj=point,
+                          polygon_encoding='convex')
+    cache[sector] = point
+    region.encodeToSMT(context, cache)
+    text = context.toString()
+    assert 'declare-fun s1' not in text and 'declare-fun t1' not in text
+    assert text.count('(and (<=') >= len(pieces)
+
+def test_polygon_convex_encoding_numerals():
+    from scenic.core.regions import encodeConvexPolygon_SMT
+    from scenic.core.smt import toSMTLIB
+    triangle = shapely.geometry.Polygon([(-3, 0), (1e-5, 0), (0, 2.5)])
+    text = toSMTLIB(encodeConvexPolygon_SMT(triangle, ('x', 'y')))
+    assert 'e-' not in text and ' -' not in text and '(-3' not in text
+    assert '(- 3.0)' in text and '0.00001' in text
+
+def test_options_visible_encoding():
+    from scenic.core.distributions import Options
+    from scenic.core.smt import EncodingContext, EncodingCache
+    squares = [PolygonalRegion([(x, 0), (x+1, 0), (x+1, 1), (x, 1)]) for x in range(0, 100, 5)]
+    options = Options(squares)
+    sector = SectorRegion(Vector(0, 0), 12, -math.pi / 2, math.pi / 2)
+    cache = EncodingCache(ego=Vector(0, 0), ego_visibleRegion=sector,
+                          polygon_encoding='convex')
+    context = EncodingContext()
+    assert options.visibleOptions(context, cache) == squares[:3]
+    point = (context.declareFresh('x'), context.declareFresh('y'))
+    cache['current_obj'] = point
+    assert options.encodeToSMT(context, cache) == point
+    pytest.importorskip('z3')
+    from scenic.core.solvers import Z3Solver
+    context.simplify()      # fold the trigonometry of the constant sector
+    for x, expected in ((0.5, 'sat'), (10.5, 'sat'), (3, 'unsat'), (15.5, 'unsat')):
+        with Z3Solver() as solver:
+            solver.load(context)
+            solver.addAssertion(f'(and (= x1 {x}) (= y1 0.5))')
+            assert solver.check() == expected
+
+def checkSMT(context, *assertions):
+    z3 = pytest.importorskip('z3')
+    from scenic.core.solvers import Z3Solver
+    with Z3Solver() as solver:
+        solver.load(context)
+        for assertion in assertions:
+            solver.addAssertion(assertion)
+        return solver.check()
+
+def test_rectangle_separation_encoding():
+    from scenic.core.smt import EncodingContext
+    from scenic.core.distributions import smt_assert
+    context = EncodingContext()
+    context.declare('x1')
+    context.declare('y1')
+    first = (('x1', 'y1'), math.pi / 4, 1, 2)
+    second = (('0', '0'), 0, 1, 1)
+    context.write(smt_assert(None, encodeRectangleSeparation_SMT(first, second)))
+    assert context.simplify().logic == 'QF_LRA'
+    for x, y in ((0, 2.5), (3, 3), (-2.2, -2.2), (2.4, 0), (0, 3.5)):
+        rect = RectangularRegion(Vector(x, y), math.pi / 4, 2, 4)
+        other = RectangularRegion(Vector(0, 0), 0, 2, 2)
+        expected = 'unsat' if rect.intersects(other) else 'sat'
+        assert checkSMT(context, f'(= x1 {x})', f'(= y1 {y})') == expected
+
+def test_rectangle_containment_encoding():
+    from scenic.core.smt import EncodingContext
+    from scenic.core.distributions import smt_assert
+    context = EncodingContext()
+    context.declare('x1')
+    context.declare('y1')
+    square = shapely.geometry.Polygon([(0, 0), (10, 0), (10, 10), (0, 10)])
+    rectangle = (('x1', 'y1'), math.pi / 2, 1, 2)      # 4 wide along x, 2 along y
+    context.write(smt_assert(None, encodeRectangleInPolygon_SMT(rectangle, [square])))
+    assert checkSMT(context, '(= x1 2.5)', '(= y1 1.5)') == 'sat'
+    assert checkSMT(context, '(= x1 1.5)', '(= y1 1.5)') == 'unsat'
+    assert checkSMT(context, '(= x1 5)', '(= y1 9.5)') == 'unsat'
+
+def test_circle_rectangle_encoding():
+    from scenic.core.smt import EncodingContext, EncodingCache
+    for region, inside, outside in (
+        (CircularRegion(Vector(1, 1), 2), (2, 2), (2.5, 2.5)),
+        (RectangularRegion(Vector(1, 1), math.pi / 2, 2, 4), (2.9, 1.9), (1, 2.1)),
+    ):
+        context = EncodingContext()
+        point = (context.declareFresh('x'), context.declareFresh('y'))
+        assert region.encodeToSMT(context, EncodingCache(current_obj=point)) == point
+        assert region.containsPoint(Vector(*inside))
+        assert not region.containsPoint(Vector(*outside))
+        for (x, y), expected in ((inside, 'sat'), (outside, 'unsat')):
+            assert checkSMT(context, f'(= x1 {x})', f'(= y1 {y})') == expected
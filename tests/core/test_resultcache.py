@@ -0,0 +1,72 @@
+import pytest
+
+from scenic.core.resultcache import ResultCache, canonicalForm
+from scenic.core.smt import EncodingContext
+
+def makeContext(x, y, bound):
+    context = EncodingContext(logic='QF_LRA')
+    context.declare(y)
+    context.declare(x)
+    context.comment('query')
+    context.write(f'(assert (< 0 {x}))')
+    context.write(f'(assert (< {x} {y} {bound}))')
+    context.write('(check-sat)')
+    return context
+
+def test_canonical_form():
+    text, names = canonicalForm(makeContext('x1', 'y1', 2))
+    assert names == ['x1', 'y1']
+    assert text.splitlines() == [
+        '(set-logic QF_LRA)',
+        '(declare-fun v1 () Real)',
+        '(declare-fun v2 () Real)',
+        '(assert (< 0 v1))',
+        '(assert (< v1 v2 2))',
+    ]
+    assert canonicalForm(makeContext('x7', 'y3', 2))[0] == text
+    assert canonicalForm(makeContext('x1', 'y1', 3))[0] != text
+
+def test_canonical_form_definitions():
+    def makeDefinition(value, name='c'):
+        context = EncodingContext(logic='QF_LRA')
+        context.declare('x')
+        context.write(f'(define-fun {name} () Real {value})')
+        context.write(f'(assert (< x {name}))')
+        return context
+    text, names = canonicalForm(makeDefinition('1.0'))
+    assert names == ['x']
+    assert '(define-fun f1 () Real 1.0)' in text.splitlines()
+    assert '(assert (< v1 f1))' in text.splitlines()
+    assert canonicalForm(makeDefinition('5.0'))[0] != text
+    assert canonicalForm(makeDefinition('1.0', name='d'))[0] == text
+
+def test_result_cache(tmpdir):
+    pytest.importorskip('z3')
+    path = str(tmpdir.join('cache', 'results.db'))
+    with ResultCache(path) as cache:
+        result, model = cache.check(makeContext('x1', 'y1', 2))
+        assert result == 'sat'
+        assert 0 < model['x1'] < model['y1'] < 2
+        assert cache.check(makeContext('x1', 'y1', 0)) == ('unsat', None)
+        assert (cache.hits, cache.misses) == (0, 2)
+    with ResultCache(path) as cache:
+        assert len(cache) == 2
+        result, renamed = cache.check(makeContext('a', 'b', 2))
+        assert result == 'sat'
+        assert renamed == { 'a': model['x1'], 'b': model['y1'] }
+        assert cache.get(makeContext('x1', 'y1', 5)) is None
+        assert (cache.hits, cache.misses) == (1, 1)
+
+def test_result_cache_eviction(tmpdir):
+    with ResultCache(str(tmpdir.join('results.db')), maxEntries=2) as cache:
+        contexts = [makeContext('x1', 'y1', bound) for bound in range(3)]
+        cache.put(contexts[0], 'unsat')
+        cache.put(contexts[1], 'sat', {'x1': 0.5, 'y1': 0.75})
+        cache.put(contexts[1], 'unknown')       # not stored
+        assert cache.get(contexts[0]) == ('unsat', None)
+        cache.put(contexts[2], 'sat', {'x1': 1, 'y1': 1.5})
+        assert len(cache) == 2
+        assert cache.get(contexts[1]) is None   # least recently used
+        assert cache.get(contexts[2]) == ('sat', {'x1': 1, 'y1': 1.5})
+        cache.clear()
+        assert len(cache) == 0
@@ -0,0 +1,44 @@
+import pytest
+
+from scenic.core.distributions import Constant
+from scenic.core.vectors import Vector
+from tests.utils import compileScenic, sampleEgo, sampleScene
+
+def test_conditioned():
+    scenario = compileScenic("""
+        ego = Object at Range(0, 10) @ 0, facing Range(0, 1)
+        other = Object at ego.position + 0 @ 20
+    """)
+    ego = scenario.egoObject
+    with scenario.conditioned({ego.position: Vector(3, 0), ego.heading: 0.5}) as view:
+        assert view is scenario
+        scene = sampleScene(scenario)
+        assert tuple(scene.egoObject.position) == (3, 0)
+        assert scene.egoObject.heading == 0.5
+        assert tuple(scene.objects[1].position) == (3, 20)
+    # conditioning is undone on exit
+    positions = {sampleEgo(scenario).position.x for i in range(30)}
+    assert len(positions) > 1
+    assert all(0 <= x <= 10 for x in positions)
+
+def test_conditioned_nested():
+    scenario = compileScenic('ego = Object at Range(0, 10) @ 0')
+    position = scenario.egoObject.position
+    with scenario.conditioned([(position, Vector(1, 0))]):
+        with scenario.conditioned([(position, Vector(2, 0))]):
+            assert sampleEgo(scenario).position.x == 2
+        assert sampleEgo(scenario).position.x == 1
+    assert sampleEgo(scenario).position.x != 1
+
+def test_conditioned_restored_on_error():
+    scenario = compileScenic('ego = Object at Range(0, 10) @ 0')
+    position = scenario.egoObject.position
+    with pytest.raises(ZeroDivisionError):
+        with scenario.conditioned({position: Vector(1, 0)}):
+            1 / 0
+    assert position._conditioned is position
+
+def test_constant():
+    c = Constant(3)
+    assert c.sample() == 3
+    assert c.supportInterval() == (3, 3)
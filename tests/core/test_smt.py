@@ -0,0 +1,191 @@
+import io
+
+import pytest
+
+from scenic.core.smt import EncodingContext, EncodingCache, DeclaredNames, Term, toSMTLIB
+from scenic.core.distributions import (Range, writeSMTtoFile, findVariableName,
+                                       smt_add, smt_subtract, smt_multiply, smt_or,
+                                       smt_equal, smt_lessThanEq, smt_assert, cacheVarName)
+from scenic.core.vectors import Vector
+
+def test_context_buffering():
+    context = EncodingContext()
+    cache = {'variables': []}
+    var = Range(0, 5).encodeToSMT(context, cache)
+    assert var == 'range1'
+    assert list(context.lines()) == [
+        '(set-logic QF_NRA)',
+        '(declare-fun range1 () Real)',
+        '(assert (and (<= 0.0 range1) (<= range1 5.0)))',
+    ]
+    assert context.numAssertions == 1
+
+def test_context_output_order():
+    context = EncodingContext(logic='QF_LRA')
+    cache = {'variables': []}
+    x = findVariableName(cache, context, cache['variables'], 'x')
+    writeSMTtoFile(context, '(assert (< 0 x1))')
+    writeSMTtoFile(context, 'debugging marker')
+    y = findVariableName(cache, context, cache['variables'], 'y')
+    writeSMTtoFile(context, ('(assert (< y1 1))', '(assert (< x1 y1))'))
+    writeSMTtoFile(context, '(check-sat)')
+    assert context.toString().splitlines() == [
+        '(set-logic QF_LRA)',
+        '(declare-fun x1 () Real)',
+        '(declare-fun y1 () Real)',
+        '(assert (< 0 x1))',
+        '; debugging marker',
+        '(assert (< y1 1))',
+        '(assert (< x1 y1))',
+        '(check-sat)',
+    ]
+    assert context.numAssertions == 3
+
+def test_context_write_invalid():
+    context = EncodingContext()
+    with pytest.raises(TypeError, match='float'):
+        context.write(1.5)
+
+def test_context_flush(tmpdir):
+    path = str(tmpdir.join('query.smt2'))
+    context = EncodingContext(path=path)
+    context.declare('d1', 'Int')
+    context.addAssertion('(<= 0 d1)')
+    context.flush()
+    with open(path) as f:
+        contents = f.read()
+    assert contents == context.toString()
+    stream = io.StringIO()
+    context.writeToStream(stream)
+    assert stream.getvalue() == contents
+    context.clear()
+    assert context.toString() == '(set-logic QF_NRA)\n'
+
+def test_legacy_file_path(tmpdir):
+    path = str(tmpdir.join('query.smt2'))
+    cache = {'variables': []}
+    Range(1, 2).encodeToSMT(path, cache)
+    with open(path) as f:
+        lines = [line for line in f.read().splitlines() if line]
+    assert lines == ['(declare-fun range1 () Real)',
+                     '(assert (and (<= 1.0 range1) (<= range1 2.0)))']
+
+def test_term_interning():
+    t1 = smt_subtract('x1', '2.5')
+    t2 = smt_subtract('x1', '2.5')
+    assert t1 is t2
+    assert smt_multiply(t1, t1) is smt_multiply(t2, t2)
+    assert smt_subtract('2.5', 'x1') is not t1
+    assert str(smt_add(t1, 'y1')) == '(+ (- x1 2.5) y1)'
+    assert '(abs ' + t1 + ')' == '(abs (- x1 2.5))'
+
+def test_let_sharing():
+    dx = smt_subtract('x1', '3')
+    dy = smt_subtract('y1', '4')
+    square = smt_add(smt_multiply(dx, dx), smt_multiply(dy, dy))
+    term = smt_assert(None, smt_lessThanEq(square, '25'))
+    assert str(term) == '(assert (<= (+ (* (- x1 3) (- x1 3)) (* (- y1 4) (- y1 4))) 25))'
+    assert toSMTLIB(term) == ('(assert (let ((?t1 (- x1 3)) (?t2 (- y1 4))) '
+                              '(<= (+ (* ?t1 ?t1) (* ?t2 ?t2)) 25)))')
+
+def test_let_sharing_nested():
+    inner = smt_subtract('x1', '1')
+    outer = smt_multiply(inner, inner)
+    term = smt_add(smt_add(outer, inner), outer)
+    assert toSMTLIB(term) == ('(let ((?t1 (- x1 1))) (let ((?t2 (* ?t1 ?t1))) '
+                              '(+ (+ ?t2 ?t1) ?t2)))')
+
+def test_deep_term():
+    disjunction = smt_equal('x1', '0')
+    for i in range(1, 5000):
+        disjunction = smt_or(disjunction, smt_equal('x1', str(i)))
+    context = EncodingContext(logic=None)
+    writeSMTtoFile(context, smt_assert(None, disjunction))
+    text = context.toString()
+    assert text.startswith('(assert (or (or')
+    assert text.count('(= x1 ') == 5000
+
+def test_cache_identity():
+    cache = EncodingCache(ego=Vector(1, 2))
+    r = Range(0, 1)
+    v1, v2 = Vector(r, 3), Vector(r, 3)
+    assert cacheVarName(cache, v1, ('x1', 'y1')) == ('x1', 'y1')
+    assert v1 in cache and v1 in cache.keys()
+    assert v2 not in cache
+    assert cacheVarName(cache, v1, ('x2', 'y2')) == ('x1', 'y1')
+    assert cacheVarName(cache, r, 'range1') == 'range1'
+    assert cache[r] == 'range1'
+    assert list(cache['variables']) == ['x1', 'y1', 'range1']
+    assert cache['ego'] == Vector(1, 2)
+    assert 'ego_visibleRegion' not in cache.keys()
+    del cache[v1]
+    assert v1 not in cache
+    assert len(cache) == 3
+
+def test_cache_variables():
+    cache = EncodingCache()
+    cache['variables'] = ['x1']
+    assert isinstance(cache['variables'], DeclaredNames)
+    x = findVariableName(cache, EncodingContext(), cache['variables'], 'x')
+    assert x == 'x2'
+    cache['variables'].append('x2')
+    assert list(cache.variables) == ['x1', 'x2']
+    assert 'x2' in cache.variables
+
+def test_name_allocator():
+    context = EncodingContext()
+    context.declare('x1')
+    names = context.names
+    assert names.fresh('x') == 'x2'
+    for i in range(9):
+        names.fresh('x')
+    assert names.fresh('x') == 'x12'
+    names.reserve('x13')
+    assert names.fresh('x1') == 'x14'   # x11 to x13 are already used
+    assert names.fresh('x') == 'x15'
+    fork = names.fork()
+    assert fork.fresh('x') == 'x16'
+    assert 'x2' in fork
+    assert names.fresh('x') == 'x16'    # forks are independent
+    context.clear()
+    assert 'x2' not in names
+    assert findVariableName({'variables': []}, context, [], 'x') == 'x1'
+
+def test_simplify_constants():
+    context = EncodingContext()
+    for name in ('x1', 'y1', 'x2', 'h1'):
+        context.declare(name)
+    context.write('(assert (= x1 (- (* (cos 0.0) 0) (* (sin 0.0) 50))))')
+    context.write('(assert (= y1 (+ x1 -2.5)))')
+    context.addAssertion(smt_lessThanEq(smt_multiply('y1', 'x2'), '10'))
+    context.write('(assert (= h1 x2))')
+    context.write('(check-sat)')
+    context.simplify()
+    assert context.logic == 'QF_LRA'
+    assert list(context.lines())[5:] == [
+        '(assert (= x1 0.0))',
+        '(assert (= y1 (- 2.5)))',
+        '(assert (<= (* (- 2.5) x2) 10))',
+        '(assert (= h1 x2))',
+        '(check-sat)',
+    ]
+    assert context.numAssertions == 4
+
+def test_simplify_abs():
+    context = EncodingContext()
+    context.declare('x1')
+    context.write('(assert (< (abs (- x1 2.5)) (abs (- 0.5))))')
+    context.simplify()
+    assert context.logic == 'QF_LRA'
+    assert list(context.lines())[2:] == [
+        '(assert (let ((?t1 (- x1 2.5))) (< (ite (< ?t1 0.0) (- ?t1) ?t1) 0.5)))',
+    ]
+
+def test_simplify_nonlinear():
+    context = EncodingContext()
+    context.declare('x1')
+    context.declare('y1')
+    context.addAssertion(smt_lessThanEq(smt_multiply('y1', 'x1'), '10'))
+    context.addAssertion(smt_equal('x1', 'x1'))
+    assert context.simplify().logic == 'QF_NRA'
+    assert context.numAssertions == 1
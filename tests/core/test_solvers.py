@@ -0,0 +1,52 @@
+import shutil
+
+import pytest
+
+from scenic.core.smt import EncodingContext
+from scenic.core.distributions import Range
+from scenic.core.solvers import Z3Solver, SubprocessSolver, SolverError
+
+def z3Solver():
+    pytest.importorskip('z3')
+    return Z3Solver()
+
+def subprocessSolver():
+    if shutil.which('z3') is None:
+        pytest.skip('z3 executable not found')
+    return SubprocessSolver(('z3', '-in'))
+
+@pytest.fixture(params=[z3Solver, subprocessSolver], ids=['z3', 'subprocess'])
+def solver(request):
+    with request.param() as solver:
+        yield solver
+
+def test_frames(solver):
+    base = EncodingContext()
+    r = Range(0, 5).encodeToSMT(base, {'variables': []})
+    solver.load(base)
+    assert solver.check() == 'sat'
+    context = base.fork()
+    x = context.declareFresh('x')
+    context.write(f'(assert (= {x} (* 2 {r})))')
+    context.write(f'(assert (> {x} 9))')
+    context.write('(check-sat)')
+    for i in range(2):
+        with solver.frame():
+            solver.load(context)
+            assert solver.check() == 'sat'
+            assert solver.model() == {'range1': 5.0, 'x1': 10.0}
+            solver.addAssertion(f'(> {x} 11)')
+            assert solver.check() == 'unsat'
+        assert solver.declaredNames == ['range1']
+        assert solver.check() == 'sat'
+
+def test_errors(solver):
+    with pytest.raises(SolverError):
+        solver.addAssertion('(> undeclared 1)')
+        solver.check()
+    solver.declare('x')
+    solver.addAssertion('(< x 0)')
+    assert solver.check() == 'sat'
+    assert solver.model()['x'] < 0
+    with pytest.raises(SolverError):
+        solver.pop()
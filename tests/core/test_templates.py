@@ -0,0 +1,158 @@
+import math
+
+import pytest
+
+from scenic.core.templates import ParametricSectorRegion, compileScenarioTemplate
+from tests.utils import compileScenic
+
+def makeTemplate():
+    scenario = compileScenic("""
+        from scenic.core.regions import PolygonalRegion
+        ego = Object at 0@0
+        region = PolygonalRegion([(-5, 5), (5, 5), (5, 15), (-5, 15)])
+        other = Object in region
+    """)
+    sector = ParametricSectorRegion(20, math.radians(90))
+    return scenario, compileScenarioTemplate(scenario, sector)
+
+frames = [
+    ((0, 0, 0), (0, 10), 'sat'),
+    ((0, 0, 0), (0, 20), 'unsat'),          # outside the region
+    ((0, 0, math.pi), (0, 10), 'unsat'),    # behind the ego
+    ((0, -5, 0), (4, 14), 'sat'),
+]
+
+def test_template_parameters():
+    scenario, template = makeTemplate()
+    assert template.labels == (('label1_x', 'label1_y'),)
+    values = template.values((1, 2, 0), [(3, 4)])
+    assert set(values) == set(template.parameters)
+    assert values['ego_lx'] == pytest.approx(-20 * math.sin(math.pi / 4))
+    with pytest.raises(RuntimeError):
+        template.values((1, 2, 0), [])
+    # the conditioning of the ego is undone after compilation
+    other = scenario.objects[1]
+    assert other.position._conditioned is other.position
+
+def test_template_instantiate():
+    scenario, template = makeTemplate()
+    context = template.instantiate(template.values((0, 0, 0), [(0, 10)]))
+    text = context.toString()
+    assert 'ego_x' not in text.split('(assert', 1)[1]
+    assert '(abs ' not in text
+    assert '(let ((?t1 (- y1 10.0)))' in text and '(ite (< ?t1 0.0) (- ?t1) ?t1)' in text
+
+def test_template_check():
+    pytest.importorskip('z3')
+    from scenic.core.solvers import Z3Solver
+    scenario, template = makeTemplate()
+    with Z3Solver() as solver:
+        template.load(solver)
+        for pose, label, expected in frames:
+            result, model = template.check(solver, template.values(pose, [label]))
+            assert result == expected
+            if result == 'sat':
+                assert model['x1'] == pytest.approx(label[0], abs=0.01)
+    for pose, label, expected in frames:
+        context = template.instantiate(template.values(pose, [label]))
+        with Z3Solver() as solver:
+            solver.load(context)
+            assert solver.check() == expected
+
+def test_template_feasible():
+    scenario, template = makeTemplate()
+    (box, reach), = template.bounds
+    assert box == ((-5, 5), (5, 15))
+    assert reach == pytest.approx(20 + math.hypot(0.5, 0.5))
+    for pose, label, expected in frames:
+        if expected == 'sat':
+            assert template.feasible(pose, [label])
+    assert not template.feasible((0, 0, 0), [(0, 20)])
+    assert not template.feasible((0, -30, 0), [(0, 10)])
+    assert template.feasible((0, 0, 0), [(5.005, 15)])      # within the tolerance
+
+def test_template_feasible_sound():
+    pytest.importorskip('z3')
+    from scenic.core.solvers import Z3Solver
+    scenario, template = makeTemplate()
+    frames = [((x, y, heading), (lx, ly))
+              for x, y in ((0, 0), (1, -3), (-4, 2))
+              for heading in (0, 1e-6, 0.3, -1, 3)
+              for lx, ly in ((0, 10), (3, 8), (-4, 14), (5, 6))]
+    numSat = 0
+    with Z3Solver() as solver:
+        template.load(solver)
+        for pose, label in frames:
+            if template.check(solver, template.values(pose, [label]))[0] == 'sat':
+                numSat += 1
+                assert template.feasible(pose, [label])
+    assert numSat > 10
+
+def test_template_builtin_requirements():
+    pytest.importorskip('z3')
+    from scenic.core.solvers import Z3Solver
+    scenario = compileScenic("""
+        from scenic.core.regions import PolygonalRegion
+        ego = Object at 0@0
+        region = PolygonalRegion([(-5, -1), (5, -1), (5, 15), (-5, 15)])
+        workspace = Workspace(region)
+        Object in region, with width 2, with length 2
+        Object in region
+    """)
+    sector = ParametricSectorRegion(20, math.radians(90))
+    template = compileScenarioTemplate(scenario, sector)
+    with Z3Solver() as solver:
+        template.load(solver)
+        for labels, expected in (
+            ([(0, 10), (2, 10)], 'sat'),
+            ([(0, 10), (1.4, 10)], 'unsat'),    # objects overlap
+            ([(-4.5, 10), (2, 10)], 'unsat'),   # first object crosses the boundary
+        ):
+            values = template.values((0, 0, 0), labels)
+            assert template.check(solver, values)[0] == expected
+
+def test_template_heading_axes():
+    from scenic.core.smt import numeral, numericValue, simplify
+    for angle in (1, 90, 180, 270, 360):
+        sector = ParametricSectorRegion(20, math.radians(angle))
+        c, s = sector.headingAxes()
+        for heading in (0, 0.5, 2, -2.5):
+            values = { name: numeral(value)
+                       for name, value in sector.parameterValues(3, 4, heading).items() }
+            assert numericValue(simplify(c, values)) == pytest.approx(math.cos(heading))
+            assert numericValue(simplify(s, values)) == pytest.approx(math.sin(heading))
+
+def test_template_ego_separation():
+    pytest.importorskip('z3')
+    from scenic.core.solvers import Z3Solver
+    scenario = compileScenic("""
+        from scenic.core.regions import PolygonalRegion
+        ego = Object at 0@0
+        region = PolygonalRegion([(-5, -1), (5, -1), (5, 15), (-5, 15)])
+        workspace = Workspace(region)
+        Object in region, with width 2, with length 2
+    """)
+    sector = ParametricSectorRegion(20, math.radians(180))
+    template = compileScenarioTemplate(scenario, sector)
+    with Z3Solver() as solver:
+        template.load(solver)
+        for pose, label, expected in (
+            ((0, 0, 0), (0, 3), 'sat'),
+            ((0, 0, 0), (0, 1.4), 'unsat'),             # object overlaps the ego
+            ((0, 0, 0), (0, 1.6), 'sat'),
+            ((0, 0, math.pi / 4), (0, 1.6), 'unsat'),   # ego rotated into the object
+        ):
+            values = template.values(pose, [label])
+            assert template.check(solver, values)[0] == expected
+
+def test_template_dropped_requirements():
+    scenario = compileScenic("""
+        from scenic.core.regions import PolygonalRegion
+        ego = Object at 0@0
+        region = PolygonalRegion([(-5, -1), (5, -1), (5, 15), (-5, 15)])
+        workspace = Workspace(region)
+        Object in region, facing Range(0, 1)
+    """)
+    sector = ParametricSectorRegion(20, math.radians(90))
+    with pytest.warns(UserWarning, match='random heading or size'):
+        compileScenarioTemplate(scenario, sector)
@@ -29,3 +29,14 @@ def test_distribution_method_encapsulation_lazy():
     assert not needsLazyEvaluation(evpt)
     assert isinstance(evpt, VectorMethodDistribution)
     assert evpt.method is underlyingFunction(vf.followFrom)
+
+def test_support_box():
+    from scenic.core.distributions import Range
+    v = Vector(Range(0, 1), 5) + Vector(-1, Range(2, 3))
+    assert supportBox(v) == ((-1, 7), (0, 8))
+    assert supportBox(Vector(1, 2) - Vector(Range(0, 1), 0)) == ((0, 2), (1, 2))
+    assert supportBox(Options([Vector(0, 0), Vector(1, Range(-1, 1))])) == ((0, -1), (1, 1))
+    assert supportBox(Vector('ego_x', 0)) == ((None, 0), (None, 0))
+    assert boxContains(((0, 0), (1, None)), (0.5, 100))
+    assert not boxContains(((0, 0), (1, 1)), (1.1, 0))
+    assert boxContains(((0, 0), (1, 1)), (1.1, 0), tolerance=0.2)
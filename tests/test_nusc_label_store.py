@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+from shapely.geometry import box
+
+from scenic.nusc_label_store import LabelStore
+
+class FakeQuery:
+    labels = {
+        'a.jpg': ('boston-seaport', '08:30', 'Rain, intersection', [(0, 5), (0, 50)]),
+        'b.jpg': ('boston-seaport', '23:10', 'Night, parking lot', []),
+        'c.jpg': ('singapore-onenorth', '12:00', 'rain', [(1, 1), (2, 2), (3, 3)]),
+    }
+
+    def get_img_filenames(self):
+        return set(self.labels)
+
+    def get_location(self, img_filename):
+        return self.labels[img_filename][0]
+
+    def get_img_data(self, img_filename):
+        location, time, description, positions = self.labels[img_filename]
+        vehicles = [{'heading': 90.0, 'position': pos, 'box': box(pos[0]-1, pos[1]-2, pos[0]+1, pos[1]+2)}
+                    for pos in positions]
+        return {'EgoCar': {'heading': 10.0, 'position': (0.0, 0.0)}, 'Vehicles': vehicles,
+                'time': time, 'description': description}
+
+def test_label_store(tmp_path):
+    query = FakeQuery()
+    LabelStore.extract(query, tmp_path / 'labels')
+    store = LabelStore.open(tmp_path / 'labels')
+    assert len(store) == 3
+    assert list(store.num_vehicles) == [2, 0, 3]
+    assert store.select(store.num_vehicles >= 2) == ['a.jpg', 'c.jpg']
+    assert store.select(store.at_location('boston-seaport')) == ['a.jpg', 'b.jpg']
+    assert store.select(store.time_between('06:00', '18:00')) == ['a.jpg', 'c.jpg']
+    assert store.select(store.time_between('22:00', '01:00')) == ['b.jpg']
+    assert store.select(store.description_contains('rain')) == ['a.jpg', 'c.jpg']
+    assert list(store.vehicles_within(10)) == [1, 0, 3]
+
+    label = store.label(0)
+    expected = query.get_img_data('a.jpg')
+    assert label['EgoCar'] == expected['EgoCar']
+    assert label['time'] == '08:30'
+    assert label['location'] == 'boston-seaport'
+    for vehicle, original in zip(label['Vehicles'], expected['Vehicles']):
+        assert vehicle['position'] == original['position']
+        assert vehicle['box'].equals(original['box'])
+
+def test_label_store_version(tmp_path):
+    LabelStore.extract(FakeQuery(), tmp_path, img_filenames=['b.jpg'])
+    (tmp_path / 'metadata.json').write_text('{"version": 0}')
+    with pytest.raises(ValueError):
+        LabelStore.open(tmp_path)
@@ -0,0 +1,507 @@
+import math
+import threading
+import time
+
+import numpy as np
+import pytest
+from shapely.geometry import Polygon, box
+
+pytest.importorskip('nuscenes.map_expansion.map_api')
+from pyquaternion import Quaternion
+from nuscenes.utils.data_classes import Box
+from nuscenes.utils.geometry_utils import view_points
+from nuscenes.scripts.export_2d_annotations_as_json import post_process_coords
+
+from scenic.core.vectors import Vector
+from scenic.nusc_query_api import NuscQueryAPI
+from tests.utils import compileScenic
+
+## Projection of annotations into the camera
+
+# Calibration of the front camera of a nuScenes vehicle
+CAMERA_RECORD = {
+    'translation': [1.70, 0.02, 1.51],
+    'rotation': [0.4998, -0.5031, 0.4998, -0.4972],
+}
+CAMERA_INTRINSIC = np.array([[1266.4, 0, 816.3], [0, 1266.4, 491.5], [0, 0, 1]])
+
+def devkitProjection(ann_rec, cs_rec, pose_rec):
+    """Corners in front of the camera and their projections, as the devkit computes them."""
+    box = Box(ann_rec['translation'], ann_rec['size'], Quaternion(ann_rec['rotation']))
+    box.translate(-np.array(pose_rec['translation']))
+    box.rotate(Quaternion(pose_rec['rotation']).inverse)
+    box.translate(-np.array(cs_rec['translation']))
+    box.rotate(Quaternion(cs_rec['rotation']).inverse)
+    corners = box.corners()
+    corners = corners[:, corners[2, :] > 0]
+    return view_points(corners, CAMERA_INTRINSIC, True).T[:, :2]
+
+def test_anns_in_view():
+    rng = np.random.default_rng(0)
+    pose_rec = {'translation': [400.0, 1100.0, 0.0],
+                'rotation': list(Quaternion(axis=(0, 0, 1), angle=0.7))}
+    ann_recs = []
+    for _ in range(400):
+        ann_recs.append({
+            'translation': list(np.array(pose_rec['translation']) + rng.uniform(-30, 30, 3)),
+            'size': list(rng.uniform(1, 6, 3)),
+            'rotation': list(Quaternion(rng.normal(size=4)).normalised),
+        })
+
+    corners = NuscQueryAPI._box_corners(ann_recs)
+    mask = NuscQueryAPI._anns_in_view(corners, CAMERA_RECORD, pose_rec, CAMERA_INTRINSIC)
+    assert corners.shape == (len(ann_recs), 3, 8)
+
+    partlyBehind = straddling = 0
+    for ann_rec, boxCorners, visible in zip(ann_recs, corners, mask):
+        box = Box(ann_rec['translation'], ann_rec['size'], Quaternion(ann_rec['rotation']))
+        assert np.allclose(boxCorners, box.corners())
+        assert np.allclose(boxCorners[:, [2, 3, 7, 6]], box.bottom_corners())
+
+        projected = devkitProjection(ann_rec, CAMERA_RECORD, pose_rec)
+        if len(projected) < 3:
+            continue    # the devkit cannot intersect degenerate hulls with the image
+        assert visible == (post_process_coords(projected.tolist()) is not None)
+        if len(projected) < 8:
+            partlyBehind += 1
+        inside = ((projected >= 0) & (projected <= (1600, 900))).all(axis=1)
+        if inside.any() and not inside.all():
+            straddling += 1
+    assert partlyBehind > 0 and straddling > 0
+
+def test_anns_in_view_empty():
+    corners = NuscQueryAPI._box_corners([])
+    pose_rec = {'translation': [0, 0, 0], 'rotation': [1, 0, 0, 0]}
+    mask = NuscQueryAPI._anns_in_view(corners, CAMERA_RECORD, pose_rec, CAMERA_INTRINSIC)
+    assert mask.shape == (0,)
+    assert corners[mask].shape == (0, 3, 8)
+
+## Traffic flow
+
+class FakeLaneMap:
+    """Map with rectangular lanes, each given by its bounds and direction of travel."""
+    def __init__(self, lanes):
+        self.lane = []
+        self.records = {}
+        for i, ((x_min, y_min, x_max, y_max), (dx, dy)) in enumerate(lanes):
+            corners = [(x_min, y_min), (x_max, y_min), (x_max, y_max), (x_min, y_max)]
+            cx, cy = (x_min + x_max) / 2, (y_min + y_max) / 2
+            fromEdge = [(cx - dy, cy + dx), (cx + dy, cy - dx)]
+            toEdge = [(cx + dx - dy, cy + dy + dx), (cx + dx + dy, cy + dy - dx)]
+            self.records[f'polygon{i}'] = Polygon(corners)
+            for name, nodes in ((f'from{i}', fromEdge), (f'to{i}', toEdge)):
+                tokens = [f'{name}.{j}' for j in range(len(nodes))]
+                self.records[name] = {'node_tokens': tokens}
+                for token, (x, y) in zip(tokens, nodes):
+                    self.records[token] = {'x': x, 'y': y}
+            self.lane.append({'token': f'lane{i}', 'polygon_token': f'polygon{i}',
+                              'from_edge_line_token': f'from{i}',
+                              'to_edge_line_token': f'to{i}'})
+
+    def extract_polygon(self, token):
+        return self.records[token]
+
+    def get(self, layer, token):
+        return self.records[token]
+
+def makeFlowIndex():
+    from scenic.nusc_query_api import _TrafficFlowIndex
+    return _TrafficFlowIndex(FakeLaneMap([
+        ((0, 0, 20, 4), (1, 0)),       # eastbound
+        ((10, 0, 14, 30), (0, 1)),     # northbound, crossing the first lane
+        ((0, 8, 20, 12), (-1, 0)),     # westbound
+    ]))
+
+def test_traffic_flow_lanes():
+    index = makeFlowIndex()
+    assert index.headings == pytest.approx([-math.pi/2, 0, math.pi/2])
+    points = [(5, 2), (12, 2), (12, 20), (5, 10), (5, 5.5), (3, 14), (40, 40)]
+    # the first lane of the map wins where lanes overlap; points off the lanes use
+    # the nearest lane within the radius, if any
+    assert list(index.lanes_at(points)) == [0, 0, 1, 2, 0, 2, -1]
+    assert list(index.lanes_at(points, radius=1)) == [0, 0, 1, 2, -1, -1, -1]
+    assert list(index.lanes_at([])) == []
+    flow = index.traffic_flow(points, radius=1)
+    assert flow[:4] == pytest.approx([-math.pi/2, -math.pi/2, 0, math.pi/2])
+    assert np.isnan(flow[4:]).all()
+
+def test_traffic_flow_rasterized():
+    index = makeFlowIndex()
+    rng = np.random.default_rng(0)
+    points = rng.uniform(-10, 40, (500, 2))
+    expected = index.traffic_flow(points)
+    index.rasterize(resolution=0.5)
+    grid, x_min, y_min, resolution = index.grid
+    assert (x_min, y_min, resolution) == (0, 0, 0.5)
+    assert grid.shape == (60, 40)
+    assert grid[3, 24] == pytest.approx(-math.pi/2)     # both lanes cover (12, 1.5)
+    assert np.isnan(grid[40, 4])
+    # the lanes are aligned with the grid, so lookups are exact
+    assert np.allclose(index.traffic_flow(points), expected, equal_nan=True)
+    assert np.isnan(index.traffic_flow([(100, 100)])).all()
+
+## Index of the dataset
+
+class FakeNuScenes:
+    """Tables of a tiny dataset with one scene of two samples in each location."""
+    def __init__(self):
+        self.scene = []
+        self.records = {}
+        for i, location in enumerate(['boston-seaport', 'singapore-onenorth', 'boston-seaport']):
+            self.records[f'log{i}'] = {'location': location}
+            self.scene.append({'token': f'scene{i}', 'log_token': f'log{i}', 'nbr_samples': 2,
+                               'first_sample_token': f'sample{i}.0', 'description': f'scene {i}'})
+            for j in range(2):
+                token = f'{i}.{j}'
+                self.records[f'sample{token}'] = {
+                    'token': f'sample{token}', 'data': {'CAM_FRONT': f'data{token}'},
+                    'next': f'sample{i}.{j+1}' if j == 0 else '',
+                }
+                self.records[f'data{token}'] = {
+                    'token': f'data{token}', 'filename': f'samples/CAM_FRONT/img{token}.jpg',
+                    'ego_pose_token': f'pose{token}', 'timestamp': 1000 * i + j,
+                }
+                self.records[f'pose{token}'] = {'translation': [10 * i, j, 0],
+                                                'rotation': [1, 0, 0, 0]}
+
+    def get(self, table, token):
+        return self.records[token]
+
+class FakeRoadMap:
+    """Map whose roads and sidewalks are the given lists of polygons."""
+    def __init__(self, roads, sidewalks=()):
+        self.polygons = list(roads) + list(sidewalks)
+        self.road_segment = [{'polygon_token': i} for i in range(len(roads))]
+        self.walkway = [{'polygon_token': i} for i in range(len(roads), len(self.polygons))]
+
+    def extract_polygon(self, token):
+        return self.polygons[token]
+
+def fakeQueryAPI(tables=None, formatVersion=1, maps={}):
+    """Make a NuscQueryAPI class using the given fake tables and maps."""
+    class FakeQueryAPI(NuscQueryAPI):
+        builds = saves = 0
+
+        @property
+        def nusc(self):
+            if tables is None:
+                raise AssertionError('nuScenes tables loaded unexpectedly')
+            return tables
+
+        @classmethod
+        def _index_format_version(cls):
+            return formatVersion
+
+        def _load_map(self, location):
+            return maps[location]
+
+        def _build_index(self):
+            type(self).builds += 1
+            super()._build_index()
+
+        def save_index(self, path=None):
+            type(self).saves += 1
+            super().save_index(path)
+    return FakeQueryAPI
+
+def test_index_round_trip(tmp_path):
+    api = fakeQueryAPI(FakeNuScenes())(dataroot=str(tmp_path))
+    assert api.img_filenames == {'img0.0.jpg', 'img0.1.jpg', 'img2.0.jpg', 'img2.1.jpg'}
+    assert api.img_metadata['img2.1.jpg']['ego_translation'] == (20, 1, 0)
+    path = tmp_path / ('v1.0-trainval' + NuscQueryAPI.INDEX_EXT)
+    assert api.index_path == str(path) and path.exists()
+
+    loaded = fakeQueryAPI()(dataroot=str(tmp_path))
+    assert loaded.img_filenames == api.img_filenames
+    assert loaded.img_filename_to_location == api.img_filename_to_location
+    assert loaded.img_metadata == api.img_metadata
+    assert loaded.img_filename_to_sample_data_token == api.img_filename_to_sample_data_token
+
+def test_index_rebuilt(tmp_path):
+    API = fakeQueryAPI(FakeNuScenes())
+    API(dataroot=str(tmp_path))
+    path = tmp_path / ('v1.0-trainval' + NuscQueryAPI.INDEX_EXT)
+    original = path.read_bytes()
+
+    # newer format
+    NewAPI = fakeQueryAPI(FakeNuScenes(), formatVersion=2)
+    api = NewAPI(dataroot=str(tmp_path))
+    assert NewAPI.builds == 1 and len(api.img_filenames) == 4
+    assert path.read_bytes()[:4] != original[:4]
+
+    # corrupted file
+    path.write_bytes(original[:len(original) // 2])
+    api = API(dataroot=str(tmp_path))
+    assert API.builds == 2 and len(api.img_filenames) == 4
+    fakeQueryAPI()(dataroot=str(tmp_path))
+    path.write_bytes(original[:40])
+    API(dataroot=str(tmp_path))
+    assert API.builds == 3
+
+    # modified dataset
+    (tmp_path / 'v1.0-trainval').mkdir()
+    (tmp_path / 'v1.0-trainval' / 'scene.json').write_text('[]')
+    API(dataroot=str(tmp_path))
+    assert API.builds == 4
+    assert path.read_bytes() != original
+    fakeQueryAPI()(dataroot=str(tmp_path))
+
+def test_index_geometry(tmp_path):
+    maps = {'boston-seaport': FakeRoadMap([box(0, 0, 10, 4), box(6, 0, 10, 20)], [box(0, 4, 6, 6)])}
+    API = fakeQueryAPI(FakeNuScenes(), maps=maps)
+    api = API(dataroot=str(tmp_path))
+    assert API.saves == 1
+    api.preload()
+    assert API.saves == 2
+    road = api.road['boston-seaport']
+    assert road.equals(box(0, 0, 10, 4).union(box(6, 0, 10, 20)))
+    assert api.sidewalk['boston-seaport'].equals(box(0, 4, 6, 6))
+    assert len(api.curb['boston-seaport'].geoms) == 1
+    api.preload()
+    assert API.saves == 2       # nothing new to save
+
+    loaded = fakeQueryAPI(maps={})(dataroot=str(tmp_path))
+    assert loaded.road['boston-seaport'].equals(road)
+    assert loaded.sidewalk['boston-seaport'].equals(api.sidewalk['boston-seaport'])
+
+    # geometry computed on demand is only saved explicitly
+    maps['singapore-onenorth'] = FakeRoadMap([box(0, 0, 1, 1)])
+    assert api.road['singapore-onenorth'].equals(box(0, 0, 1, 1))
+    assert API.saves == 2
+    assert 'singapore-onenorth' not in fakeQueryAPI()(dataroot=str(tmp_path))._index_geometry
+    api.save_index()
+    assert 'singapore-onenorth' in fakeQueryAPI()(dataroot=str(tmp_path))._index_geometry
+
+## Selecting images by ego position
+
+def test_ego_pose_index():
+    from scenic.nusc_query_api import _EgoPoseIndex
+    index = _EgoPoseIndex(['a', 'b', 'c', 'd'], [(0, 0), (3, 4), (10, 0), (-1, 0)])
+    assert list(index.near((0, 0), 1)) == [0, 3]
+    assert list(index.near((0, 0), 5)) == [0, 1, 3]
+    assert list(index.near((100, 100), 5)) == []
+    assert index.within(box(-2, -1, 4, 1)) == ['a', 'd']
+    assert index.within(box(1, -1, 9, 5)) == ['b']
+    assert sorted(index.within(box(1, -1, 9, 5), margin=1)) == ['a', 'b', 'c']
+    assert index.within(Polygon()) == []
+
+    empty = _EgoPoseIndex([], [])
+    assert list(empty.near((0, 0), 5)) == []
+    assert empty.within(box(0, 0, 1, 1)) == []
+
+def test_img_filenames_in(tmp_path):
+    from scenic.core.regions import CircularRegion, PolygonalRegion, everywhere, nowhere
+    api = fakeQueryAPI(FakeNuScenes())(dataroot=str(tmp_path))
+    location = 'boston-seaport'
+    assert api.get_img_filenames_near(location, (20, 0), 1) == ['img2.0.jpg', 'img2.1.jpg']
+    square = PolygonalRegion([(-1, -1), (1, -1), (1, 0.5), (-1, 0.5)])
+    assert api.get_img_filenames_in(location, square) == ['img0.0.jpg']
+    assert api.get_img_filenames_in(location, square, margin=1) == ['img0.0.jpg', 'img0.1.jpg']
+    assert api.get_img_filenames_in(location, box(19, 0.5, 21, 2)) == ['img2.1.jpg']
+    assert api.get_img_filenames_in(location, CircularRegion(Vector(20, 0), 0.5)) == ['img2.0.jpg']
+    assert sorted(api.get_img_filenames_in(location, everywhere)) == sorted(api.img_filenames)
+    assert api.get_img_filenames_in(location, nowhere) == []
+    with pytest.raises(RuntimeError):
+        api.get_img_filenames_in(location, nowhere, margin=1)
+    assert api.get_img_filenames_in('singapore-onenorth', everywhere) == []
+
+def test_candidate_img_filenames(tmp_path):
+    api = fakeQueryAPI(FakeNuScenes())(dataroot=str(tmp_path))
+    scenario = compileScenic('ego = Object at Range(-5, 5) @ Range(-1, 5)')
+    location = 'boston-seaport'
+    expected = ['img0.0.jpg', 'img0.1.jpg']
+    assert api.get_candidate_img_filenames(scenario, location) == expected
+    # conditioning the ego does not change the candidates
+    with scenario.conditioned({scenario.egoObject.position: Vector(20, 0)}):
+        assert api.get_candidate_img_filenames(scenario, location) == expected
+    assert api.get_candidate_img_filenames(scenario, location, margin=15) == sorted(api.img_filenames)
+
+    scenario = compileScenic('ego = Object at 20 @ 1')
+    assert api.get_candidate_img_filenames(scenario, location) == ['img2.1.jpg']
+
+## Cache of map tiles
+
+class FakePatchMap:
+    """Map supporting the record lookups of NuScenesMap used by _TileCache."""
+    def __init__(self, layers):
+        self.layers = {layer: list(polygons) for layer, polygons in layers.items()}
+        self.lookups = 0
+
+    def get_records_in_patch(self, box_coords, layer_names):
+        self.lookups += 1
+        patch = box(*box_coords)
+        return {layer: [i for i, polygon in enumerate(self.layers[layer]) if polygon.intersects(patch)]
+                for layer in layer_names}
+
+    def get(self, layer, token):
+        return {'polygon_token': (layer, token)}
+
+    def extract_polygon(self, token):
+        layer, index = token
+        return self.layers[layer][index]
+
+def test_tile_cache():
+    from shapely.ops import clip_by_rect, unary_union
+    from scenic.nusc_query_api import _TileCache
+    rng = np.random.default_rng(0)
+    def randomBoxes(count, size):
+        corners = rng.uniform(-50, 250, (count, 2))
+        return [box(x, y, x + w, y + h)
+                for (x, y), (w, h) in zip(corners, rng.uniform(1, size, (count, 2)))]
+    layers = {'road_segment': randomBoxes(60, 80), 'walkway': randomBoxes(60, 10)}
+    map_api = FakePatchMap(layers)
+    cache = _TileCache(map_api, tile_size=50, max_tiles=4)
+
+    coords = (-20, 10, 130, 95)     # 4 columns and 2 rows of tiles
+    patch = cache.patch(coords)
+    assert map_api.lookups == 8
+    for layer, polygons in layers.items():
+        expected = clip_by_rect(unary_union(polygons), *coords)
+        assert patch[layer].symmetric_difference(expected).area < 1e-6
+        assert patch[layer].area == pytest.approx(expected.area)
+
+    # only the most recently used tiles are kept
+    assert list(cache.tiles) == [(1, 0), (1, 1), (2, 0), (2, 1)]
+    cache.patch((60, 60, 90, 90))
+    assert map_api.lookups == 8
+    assert list(cache.tiles)[-1] == (1, 1)
+    cache.patch((0, 0, 10, 10))
+    assert map_api.lookups == 9
+    assert list(cache.tiles) == [(2, 0), (2, 1), (1, 1), (0, 0)]
+
+## Prefetching labels
+
+class StubQueryAPI(NuscQueryAPI):
+    """Query API whose labels are computed by a given function of the image name."""
+    def __init__(self, label=str):
+        self.label = label
+        self.started = []
+        self.lock = threading.Lock()
+
+    def get_img_data(self, img_filename):
+        with self.lock:
+            self.started.append(img_filename)
+        return self.label(img_filename)
+
+def test_iter_img_data_order():
+    rng = np.random.default_rng(0)
+    delays = rng.uniform(0, 0.01, 40)
+    api = StubQueryAPI(lambda name: time.sleep(delays[name]) or -name)
+    consumed = []
+    def names():
+        for i in range(40):
+            consumed.append(i)
+            yield i
+    results = []
+    for name, label in api.iter_img_data(names(), workers=3, prefetch=5):
+        assert label == -name
+        results.append(name)
+        assert len(consumed) <= len(results) + 5
+        assert len(api.started) <= len(results) + 5
+    assert results == list(range(40))
+    assert list(api.iter_img_data([])) == []
+    with pytest.raises(ValueError):
+        list(api.iter_img_data(range(3), workers=0))
+    with pytest.raises(ValueError):
+        list(api.iter_img_data(range(3), prefetch=0))
+
+def test_iter_img_data_error():
+    def label(name):
+        if name == 3:
+            raise KeyError(name)
+        return name
+    api = StubQueryAPI(label)
+    results = []
+    with pytest.raises(KeyError):
+        for name, _ in api.iter_img_data(range(10), workers=2):
+            results.append(name)
+    assert results == [0, 1, 2]
+
+def test_iter_img_data_close():
+    release = threading.Event()
+    def label(name):
+        if name == 1:
+            release.wait(5)
+        return name
+    api = StubQueryAPI(label)
+    labels = api.iter_img_data(range(10), workers=1, prefetch=4)
+    assert next(labels) == (0, 0)
+    threading.Timer(0.2, release.set).start()
+    labels.close()
+    assert release.is_set()
+    assert api.started == [0, 1]
+
+## Lazy loading
+
+def test_lazy_dict_threads():
+    from scenic.nusc_query_api import _LazyDict
+    calls = []
+    lock = threading.Lock()
+    def factory(key):
+        with lock:
+            calls.append(key)
+        time.sleep(0.05)
+        return [key]
+    values = _LazyDict(factory)
+    results = []
+    def worker(key):
+        results.append((key, values[key]))
+    threads = [threading.Thread(target=worker, args=(i % 3,)) for i in range(24)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(calls) == [0, 1, 2]
+    assert len(results) == 24
+    assert all(value is values[key] for key, value in results)
+
+def test_lazy_dict_keys(tmp_path):
+    from scenic.nusc_query_api import _LazyDict
+    calls = []
+    values = _LazyDict(lambda key: calls.append(key) or key.upper(), ['a', 'b', 'c'])
+    assert 'a' in values and 'd' not in values
+    assert list(values) == list(values.keys()) == ['a', 'b', 'c']
+    assert len(values) == 3 and calls == []
+    assert values.get('b') == 'B' and values.get('d') is None and values.get('d', 0) == 0
+    with pytest.raises(KeyError):
+        values['d']
+    assert dict(values.items()) == {'a': 'A', 'b': 'B', 'c': 'C'}
+    assert list(values.values()) == ['A', 'B', 'C']
+    assert calls == ['b', 'a', 'c']
+
+    maps = {'boston-seaport': FakeRoadMap([box(0, 0, 10, 4)])}
+    api = fakeQueryAPI(FakeNuScenes(), maps=maps)(dataroot=str(tmp_path))
+    assert list(api.road) == list(api.nusc_map) == NuscQueryAPI.LOCATIONS
+    assert 'boston-seaport' in api.road and 'boston-seaport' in api.curb
+    assert api.road.get('atlantis') is None
+    assert api.road.get('boston-seaport').equals(box(0, 0, 10, 4))
+    assert list(api._geometry) == ['boston-seaport']
+
+def test_preload_background(tmp_path):
+    maps = {'boston-seaport': FakeRoadMap([box(0, 0, 10, 4)])}
+    API = fakeQueryAPI(FakeNuScenes(), maps=maps)
+    api = API(dataroot=str(tmp_path))
+    thread = api.preload(background=True)
+    thread.join()
+    assert list(api._geometry) == ['boston-seaport']
+    assert api._geometry['boston-seaport']['road'].equals(box(0, 0, 10, 4))
+    assert API.saves == 2
+
+    # preloading on construction, with the geometry now read from the index
+    api = fakeQueryAPI(maps={})(dataroot=str(tmp_path), preload=True)
+    assert api.road['boston-seaport'].equals(box(0, 0, 10, 4))
+
+def test_prepared_road(tmp_path):
+    from shapely.geometry import Point
+    from shapely.prepared import PreparedGeometry
+    from scenic.core.geometry import pointsIntersecting
+    maps = {'boston-seaport': FakeRoadMap([box(0, 0, 10, 4), box(6, 0, 10, 20)])}
+    api = fakeQueryAPI(FakeNuScenes(), maps=maps)(dataroot=str(tmp_path))
+    prepared = api.road_prepared['boston-seaport']
+    assert isinstance(prepared, PreparedGeometry)
+    assert api.road_prepared['boston-seaport'] is prepared
+    assert prepared.context is api.road['boston-seaport']
+    points = [(1, 1), (8, 15), (2, 10), (10, 10), (0, 4), (11, 0), (5, 4.5)]
+    inside = pointsIntersecting(prepared, points)
+    assert list(inside) == [True, True, False, True, True, False, False]
+    assert list(inside) == [api.road['boston-seaport'].intersects(Point(p)) for p in points]